@@ -0,0 +1,57 @@
+'''
+Microbenchmark of the topology pass of CommitsFiller (commit_repos, commit_parents): pygit2 walk versus commit-graph walk,
+on a linear history generated with git fast-import.
+
+python benchmarks/commit_graph.py [nb_commits]
+'''
+
+import os
+import sys
+import time
+import logging
+import tempfile
+import subprocess
+
+import pygit2
+
+from repo_tools.fillers import commit_info
+
+def make_repo(path,nb_commits):
+	subprocess.check_call(['git','init','-q',path])
+	stream = []
+	for i in range(1,nb_commits+1):
+		content = 'line {}\n'.format(i)
+		stream.append('blob\nmark :{}\ndata {}\n{}\n'.format(2*i,len(content),content))
+		message = 'commit {}'.format(i)
+		stream.append('commit refs/heads/master\nmark :{}\nauthor a <a@a.a> {} +0000\ncommitter a <a@a.a> {} +0000\ndata {}\n{}\n'.format(2*i+1,1500000000+60*i,1500000000+60*i,len(message),message))
+		if i > 1:
+			stream.append('from :{}\n'.format(2*i-1))
+		stream.append('M 100644 :{} file{}.txt\n\n'.format(2*i,i%100))
+	subprocess.run(['git','-C',path,'fast-import','--quiet'],input=''.join(stream).encode(),check=True)
+	subprocess.check_call(['git','-C',path,'symbolic-ref','HEAD','refs/heads/master'])
+	subprocess.check_call(['git','-C',path,'repack','-a','-d','-q'])
+
+class LocalCommitsFiller(commit_info.CommitsFiller):
+	def get_repo(self,name,source,owner):
+		return pygit2.Repository(self.repo_path)
+
+def time_topology_pass(repo_path,use_commit_graph):
+	filler = LocalCommitsFiller(use_commit_graph=use_commit_graph)
+	filler.repo_path = repo_path
+	filler.logger = logging.getLogger()
+	if use_commit_graph:
+		# writing the commit-graph file is not timed
+		filler.get_commit_graph(pygit2.Repository(repo_path)).close()
+	start = time.time()
+	commits = list(filler.list_commits(name='repo',source='local',owner='local',repo_id=1,topology_only=True))
+	return time.time()-start,commits
+
+if __name__ == '__main__':
+	nb_commits = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+	with tempfile.TemporaryDirectory() as tmp_folder:
+		repo_path = os.path.join(tmp_folder,'repo')
+		make_repo(repo_path,nb_commits=nb_commits)
+		pygit2_time,pygit2_commits = time_topology_pass(repo_path,use_commit_graph=False)
+		graph_time,graph_commits = time_topology_pass(repo_path,use_commit_graph=True)
+		assert pygit2_commits == graph_commits
+		print('{} commits, pygit2 walk: {:.3f}s, commit-graph walk: {:.3f}s, speedup: x{:.1f}'.format(nb_commits,pygit2_time,graph_time,pygit2_time/graph_time))
@@ -0,0 +1,44 @@
+'''
+Microbenchmark of URL normalization: RepositoriesFiller.repo_formatting tried on every url_root in turn, versus UrlNormalizer.
+
+python benchmarks/url_normalization.py [nb_urls]
+'''
+
+import sys
+import time
+import random
+
+from repo_tools.fillers import generic
+from repo_tools.url_normalizer import UrlNormalizer
+
+url_roots = [(i+1,ur) for i,ur in enumerate(['gitlab.com','bitbucket.org','sourceforge.net','gitee.com','github.com'])]
+
+def make_urls(nb_urls,nb_distinct):
+	random.seed(0)
+	patterns = ['https://{}/{}/{}','http://www.{}/{}/{}.git','{}/{}/{}/','https://{}/{}/{}/tree/master','https://crates.io/{1}/{2}']
+	distinct = [random.choice(patterns).format(random.choice(url_roots)[1],'owner{}'.format(i%1000),'repo{}'.format(i)) for i in range(nb_distinct)]
+	return [random.choice(distinct) for _ in range(nb_urls)]
+
+def old_clean_url(filler,url):
+	for ur_id,ur in url_roots:
+		try:
+			return filler.repo_formatting(repo=url,source_urlroot=ur,output_cleaned_url=True),ur_id
+		except generic.RepoSyntaxError:
+			continue
+	return None,None
+
+if __name__ == '__main__':
+	nb_urls = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+	urls = make_urls(nb_urls=nb_urls,nb_distinct=nb_urls//2)
+	filler = generic.RepositoriesFiller()
+
+	start = time.time()
+	old_results = [(url,*old_clean_url(filler,url)) for url in urls]
+	old_time = time.time()-start
+
+	start = time.time()
+	new_results = UrlNormalizer(url_roots=url_roots).normalize_urls(urls)
+	new_time = time.time()-start
+
+	assert old_results == new_results
+	print('{} URLs, repo_formatting: {:.3f}s, UrlNormalizer: {:.3f}s, speedup: x{:.1f}'.format(nb_urls,old_time,new_time,old_time/new_time))
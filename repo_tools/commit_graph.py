@@ -0,0 +1,237 @@
+'''
+Reader of git commit-graph files (objects/info/commit-graph, or chains of split graphs in objects/info/commit-graphs),
+giving parents, commit times and generation numbers (topological levels) of commits without parsing commit objects.
+
+File format: gitformat-commit-graph(5) in the git documentation.
+'''
+
+import os
+import mmap
+import heapq
+import struct
+
+PARENT_NONE = 0x70000000
+EXTRA_EDGES = 0x80000000
+LAST_EDGE = 0x80000000
+
+HEADER = struct.Struct('>4sBBBB')
+CHUNK = struct.Struct('>4sQ')
+UINT32 = struct.Struct('>I')
+CDAT = struct.Struct('>IIII')
+
+
+class CommitGraphError(ValueError):
+	pass
+
+
+class CommitGraphLayer(object):
+	'''
+	One commit-graph file. Commit positions are local to the file, parent positions are global to the chain.
+	Empty, truncated or inconsistent files raise CommitGraphError.
+	'''
+	def __init__(self,path):
+		with open(path,'rb') as f:
+			if os.fstat(f.fileno()).st_size < HEADER.size:
+				raise CommitGraphError('Truncated commit-graph file: {}'.format(path))
+			self.data = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+		try:
+			self.parse(path)
+		except struct.error as e:
+			self.close()
+			raise CommitGraphError('Truncated commit-graph file: {} ({})'.format(path,e))
+		except CommitGraphError:
+			self.close()
+			raise
+
+	def parse(self,path):
+		signature,version,hash_version,nb_chunks,self.nb_base = HEADER.unpack_from(self.data,0)
+		if signature != b'CGPH' or version != 1:
+			raise CommitGraphError('Not a commit-graph file (version 1): {}'.format(path))
+		if hash_version == 1:
+			self.hash_len = 20
+		elif hash_version == 2:
+			self.hash_len = 32
+		else:
+			raise CommitGraphError('Unknown hash version {} in {}'.format(hash_version,path))
+		chunks = {}
+		for i in range(nb_chunks):
+			chunk_id,offset = CHUNK.unpack_from(self.data,HEADER.size+i*CHUNK.size)
+			chunks[chunk_id] = offset
+		try:
+			self.fanout_offset = chunks[b'OIDF']
+			self.oid_offset = chunks[b'OIDL']
+			self.cdat_offset = chunks[b'CDAT']
+		except KeyError as e:
+			raise CommitGraphError('Missing chunk {} in {}'.format(e,path))
+		self.edge_offset = chunks.get(b'EDGE')
+		self.nb_commits = UINT32.unpack_from(self.data,self.fanout_offset+255*4)[0]
+		self.cdat_size = self.hash_len+16
+		if self.oid_offset+self.nb_commits*self.hash_len > len(self.data) or self.cdat_offset+self.nb_commits*self.cdat_size > len(self.data):
+			raise CommitGraphError('Truncated commit-graph file: {}'.format(path))
+
+	def close(self):
+		self.data.close()
+
+	def oid(self,pos):
+		offset = self.oid_offset+pos*self.hash_len
+		return self.data[offset:offset+self.hash_len]
+
+	def position(self,oid):
+		'''
+		Local position of oid (bytes), None if absent, by binary search in the range given by the fanout table
+		'''
+		first_byte = oid[0]
+		lo = 0 if first_byte == 0 else UINT32.unpack_from(self.data,self.fanout_offset+(first_byte-1)*4)[0]
+		hi = UINT32.unpack_from(self.data,self.fanout_offset+first_byte*4)[0]
+		while lo < hi:
+			mid = (lo+hi)//2
+			mid_oid = self.oid(mid)
+			if mid_oid < oid:
+				lo = mid+1
+			elif mid_oid > oid:
+				hi = mid
+			else:
+				return mid
+		return None
+
+	def commit_data(self,pos):
+		'''
+		Returns (parent1,parent2,generation,commit_time), parents being raw values of the CDAT chunk
+		'''
+		parent1,parent2,word1,word2 = CDAT.unpack_from(self.data,self.cdat_offset+pos*self.cdat_size+self.hash_len)
+		return parent1,parent2,word1 >> 2,((word1 & 3) << 32) | word2
+
+	def extra_edges(self,index):
+		if self.edge_offset is None:
+			raise CommitGraphError('Missing chunk EDGE')
+		ans = []
+		while True:
+			try:
+				edge = UINT32.unpack_from(self.data,self.edge_offset+index*4)[0]
+			except struct.error as e:
+				raise CommitGraphError('Truncated EDGE chunk ({})'.format(e))
+			ans.append(edge & ~LAST_EDGE)
+			if edge & LAST_EDGE:
+				return ans
+			index += 1
+
+
+class CommitGraph(object):
+	'''
+	Commit graph of a repository, made of one or several layers (base first).
+	Commits are identified by their global position: positions of a layer follow those of the layers below it.
+	Layers are memory-mapped until close (also called when used as a context manager).
+	'''
+	def __init__(self,layers):
+		self.layers = layers
+		self.layer_starts = []
+		start = 0
+		for layer in layers:
+			self.layer_starts.append(start)
+			start += layer.nb_commits
+		self.nb_commits = start
+
+	@classmethod
+	def from_git_dir(cls,git_dir):
+		'''
+		Loads the commit graph of a git directory, None if it has no commit-graph file
+		'''
+		info_folder = os.path.join(git_dir,'objects','info')
+		chain_file = os.path.join(info_folder,'commit-graphs','commit-graph-chain')
+		# same precedence as git: single file first
+		if os.path.exists(os.path.join(info_folder,'commit-graph')):
+			return cls([CommitGraphLayer(os.path.join(info_folder,'commit-graph'))])
+		elif os.path.exists(chain_file):
+			with open(chain_file,'r') as f:
+				hashes = [h.strip() for h in f.read().splitlines() if h.strip()]
+			layers = []
+			try:
+				for h in hashes:
+					layers.append(CommitGraphLayer(os.path.join(info_folder,'commit-graphs','graph-{}.graph'.format(h))))
+			except Exception:
+				for layer in layers:
+					layer.close()
+				raise
+			return cls(layers)
+		else:
+			return None
+
+	def close(self):
+		for layer in self.layers:
+			layer.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self,*args):
+		self.close()
+
+	def __len__(self):
+		return self.nb_commits
+
+	def locate(self,pos):
+		'''
+		Returns (layer,local position) of a global position
+		'''
+		if len(self.layers) == 1:
+			return self.layers[0],pos
+		for layer,start in zip(reversed(self.layers),reversed(self.layer_starts)):
+			if pos >= start:
+				return layer,pos-start
+		raise IndexError(pos)
+
+	def position(self,oid):
+		'''
+		Global position of oid (bytes), None if the commit is not in the graph
+		'''
+		for layer,start in zip(self.layers,self.layer_starts):
+			pos = layer.position(oid)
+			if pos is not None:
+				return start+pos
+		return None
+
+	def oid(self,pos):
+		layer,local_pos = self.locate(pos)
+		return layer.oid(local_pos)
+
+	def commit(self,pos):
+		'''
+		Returns (parent positions,generation,commit_time)
+		'''
+		layer,local_pos = self.locate(pos)
+		parent1,parent2,generation,commit_time = layer.commit_data(local_pos)
+		if parent1 == PARENT_NONE:
+			parents = []
+		elif parent2 == PARENT_NONE:
+			parents = [parent1]
+		elif parent2 & EXTRA_EDGES:
+			parents = [parent1]+layer.extra_edges(parent2 & ~EXTRA_EDGES)
+		else:
+			parents = [parent1,parent2]
+		if any(p >= self.nb_commits for p in parents):
+			raise CommitGraphError('Parent position out of range for commit {}'.format(pos))
+		return parents,generation,commit_time
+
+	def walk(self,oid):
+		'''
+		Yields (oid,parent oids,commit_time) for the commits reachable from oid (bytes),
+		by decreasing commit time, children first for equal times (higher generation first).
+		Raises KeyError if oid is not in the graph.
+		'''
+		start = self.position(oid)
+		if start is None:
+			raise KeyError(oid.hex())
+		parents,generation,commit_time = self.commit(start)
+		queue = [(-commit_time,-generation,start,parents)]
+		# oids of seen commits, each read once
+		oids = {start:oid}
+		while queue:
+			neg_time,_,pos,parents = heapq.heappop(queue)
+			parent_oids = []
+			for p in parents:
+				if p not in oids:
+					oids[p] = self.oid(p)
+					p_parents,p_generation,p_time = self.commit(p)
+					heapq.heappush(queue,(-p_time,-p_generation,p,p_parents))
+				parent_oids.append(oids[p])
+			yield oids[pos],parent_oids,-neg_time
@@ -0,0 +1,157 @@
+'''
+Content-addressed cache of downloaded files, used by fillers to avoid re-fetching unchanged large files (e.g. database dumps).
+
+Files are stored once per content, under objects/<sha256>, and index.json maps each URL to the hash of its content,
+its fetch time and its last use.
+'''
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+
+from repo_tools import misc
+
+
+class DataCache(object):
+	'''
+	Cache stored in folder (fillers use <data_folder>/cache).
+
+	An URL fetched less than ttl seconds ago (ttl None: any time) is reused without downloading.
+	Identical contents fetched from different URLs, or again from the same URL, are stored once.
+	When the total size of stored objects exceeds max_size bytes, least recently used objects are evicted.
+	The last use of an URL is recorded with a resolution of last_used_resolution seconds, so that cache hits in a row do not rewrite the index.
+	'''
+	def __init__(self,folder,ttl=None,max_size=None,last_used_resolution=60):
+		self.folder = folder
+		self.objects_folder = os.path.join(folder,'objects')
+		self.downloads_folder = os.path.join(folder,'downloads')
+		self.index_file = os.path.join(folder,'index.json')
+		self.ttl = ttl
+		self.max_size = max_size
+		self.last_used_resolution = last_used_resolution
+		self.lock = threading.RLock()
+		os.makedirs(self.objects_folder,exist_ok=True)
+		os.makedirs(self.downloads_folder,exist_ok=True)
+		self.load_index()
+
+	def load_index(self):
+		try:
+			with open(self.index_file,'r') as f:
+				self.index = json.load(f)
+		except FileNotFoundError:
+			self.index = {}
+
+	def save_index(self):
+		tmp_file = self.index_file+'.tmp'
+		with open(tmp_file,'w') as f:
+			json.dump(self.index,f,indent=1,sort_keys=True)
+		os.replace(tmp_file,self.index_file)
+
+	def object_path(self,content_hash):
+		return os.path.join(self.objects_folder,content_hash)
+
+	def lookup(self,url,ttl=None):
+		'''
+		Returns the path of the cached content of url if present and fetched less than ttl seconds ago (default: self.ttl), None otherwise
+		'''
+		if ttl is None:
+			ttl = self.ttl
+		with self.lock:
+			entry = self.index.get(url)
+			if entry is None or not os.path.exists(self.object_path(entry['hash'])):
+				return None
+			if ttl is not None and time.time()-entry['fetched_at'] > ttl:
+				return None
+			now = time.time()
+			if now-entry['last_used'] >= self.last_used_resolution:
+				entry['last_used'] = now
+				self.save_index()
+			return self.object_path(entry['hash'])
+
+	def add(self,url,filepath):
+		'''
+		Moves filepath into the cache as the content of url, and returns its path in the cache.
+		The previous content of url is removed if no other URL has it.
+		'''
+		content_hash = misc.file_hash(filepath)
+		with self.lock:
+			if os.path.exists(self.object_path(content_hash)):
+				os.remove(filepath)
+			else:
+				os.replace(filepath,self.object_path(content_hash))
+			now = time.time()
+			previous = self.index.get(url)
+			self.index[url] = {'hash':content_hash,'size':os.path.getsize(self.object_path(content_hash)),'fetched_at':now,'last_used':now}
+			if previous is not None and previous['hash'] != content_hash and not any(entry['hash'] == previous['hash'] for entry in self.index.values()):
+				if os.path.exists(self.object_path(previous['hash'])):
+					os.remove(self.object_path(previous['hash']))
+			self.evict(keep=content_hash)
+			self.save_index()
+		return self.object_path(content_hash)
+
+	def fetch(self,url,download,ttl=None):
+		'''
+		Returns the path of the content of url in the cache, calling download(url=url,destination=...) if it is missing or stale
+		'''
+		path = self.lookup(url=url,ttl=ttl)
+		if path is not None:
+			return path
+		# stable name, so that interrupted downloads can be resumed by the next call
+		destination = os.path.join(self.downloads_folder,hashlib.sha256(url.encode('utf-8')).hexdigest())
+		download(url=url,destination=destination)
+		return self.add(url=url,filepath=destination)
+
+	def objects(self):
+		'''
+		Returns {content_hash:(size,last_used)} for stored objects, last_used being the latest use among URLs with this content
+		'''
+		ans = {}
+		for entry in self.index.values():
+			size,last_used = ans.get(entry['hash'],(entry['size'],entry['last_used']))
+			ans[entry['hash']] = (size,max(last_used,entry['last_used']))
+		return ans
+
+	def size(self):
+		return sum(size for size,last_used in self.objects().values())
+
+	def evict(self,max_size=None,keep=None):
+		'''
+		Removes least recently used objects (and their URLs) until the total size is at most max_size (default: self.max_size).
+		The object with hash keep is never removed.
+		Returns the number of removed objects.
+		'''
+		if max_size is None:
+			max_size = self.max_size
+		if max_size is None:
+			return 0
+		with self.lock:
+			objects = self.objects()
+			total_size = sum(size for size,last_used in objects.values())
+			removed = 0
+			for content_hash,(size,last_used) in sorted(objects.items(),key=lambda o:o[1][1]):
+				if total_size <= max_size:
+					break
+				if content_hash == keep:
+					continue
+				if os.path.exists(self.object_path(content_hash)):
+					os.remove(self.object_path(content_hash))
+				self.index = {url:entry for url,entry in self.index.items() if entry['hash'] != content_hash}
+				total_size -= size
+				removed += 1
+			self.save_index()
+		return removed
+
+	def copy_to(self,path,destination):
+		'''
+		Makes a cached file available at destination, as a hard link if possible (no extra space used), as a copy otherwise
+		'''
+		if os.path.exists(destination):
+			os.remove(destination)
+		try:
+			os.link(path,destination)
+		except OSError:
+			shutil.copyfile(path,destination)
+		return destination
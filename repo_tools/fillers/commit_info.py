@@ -1,11 +1,14 @@
 import datetime
 import os
+import subprocess
 import psycopg2
 from psycopg2 import extras
 import pygit2
 import json
 
 from repo_tools import fillers
+from repo_tools import misc
+from repo_tools.commit_graph import CommitGraph,CommitGraphError
 from repo_tools.fillers import generic
 import repo_tools as rp
 
@@ -15,10 +18,24 @@ class CommitsFiller(fillers.Filler):
 	"""
 
 
+	requires = ('repositories','clones','forks')
+	provides = ('identities','users','commits','commit_repos','commit_parents')
+
 	def __init__(self,
 			only_null_commit_origs=True,
+			sha_chunk_size=500,
+			use_commit_graph=True,
 					**kwargs):
+		'''
+		sha_chunk_size is the number of commits whose ids are resolved together by sha, when filling commit_repos and commit_parents
+
+		with use_commit_graph, passes needing only commit topology (commit_repos, commit_parents) walk the commit-graph file of the repo
+		(written with the git executable if missing or outdated) without reading commit objects.
+		Passes needing authors or diffs, or repos without usable commit-graph file, use pygit2 walks.
+		'''
 		self.only_null_commit_origs = only_null_commit_origs
+		self.sha_chunk_size = sha_chunk_size
+		self.use_commit_graph = use_commit_graph
 		fillers.Filler.__init__(self,**kwargs)
 
 	def prepare(self):
@@ -35,7 +52,7 @@ class CommitsFiller(fillers.Filler):
 	def apply(self):
 		self.fill_commit_info()
 		self.fill_commit_orig_repo(only_null=self.only_null_commit_origs)
-		self.db.connection.commit()
+		self.db.commit()
 
 
 	def fill_commit_info(self,force=False,all_commits=False):
@@ -46,7 +63,7 @@ class CommitsFiller(fillers.Filler):
 		self.db.cursor.execute('''SELECT MAX(updated_at) FROM full_updates WHERE update_type='commits';''')
 		last_fu = self.db.cursor.fetchone()[0]
 
-		self.db.cursor.execute('''SELECT MAX(updated_at) FROM table_updates WHERE table_name='clones' AND success;''')
+		self.db.cursor.execute('''SELECT MAX(last_success_at) FROM table_updates_latest WHERE table_name='clones';''')
 		last_dl = self.db.cursor.fetchone()[0]
 
 		if all_commits:
@@ -81,7 +98,7 @@ class CommitsFiller(fillers.Filler):
 
 			for repo_info in self.db.get_repo_list(option=option):
 				try:
-					self.fill_commit_repos(self.list_commits(basic_info_only=False,**repo_info))
+					self.fill_commit_repos(self.list_commits(topology_only=True,**repo_info))
 				except:
 					self.logger.error('Error with {}'.format(repo_info))
 					raise
@@ -90,21 +107,22 @@ class CommitsFiller(fillers.Filler):
 
 			for repo_info in self.db.get_repo_list(option=option):
 				try:
-					self.fill_commit_parents(self.list_commits(basic_info_only=True,**repo_info))
+					self.fill_commit_parents(self.list_commits(topology_only=True,**repo_info))
 				except:
 					self.logger.error('Error with {}'.format(repo_info))
 					raise
 			self.db.create_indexes(table='commit_parents')
 
 			self.db.cursor.execute('''INSERT INTO full_updates(update_type,updated_at) VALUES('commits',(SELECT CURRENT_TIMESTAMP));''')
-			self.db.connection.commit()
+			self.db.commit()
 		else:
 			self.logger.info('Skipping filling of commits info')
 
-	def list_commits(self,name,source,owner,basic_info_only=False,repo_id=None,after_time=None):
+	def list_commits(self,name,source,owner,basic_info_only=False,topology_only=False,repo_id=None,after_time=None):
 		'''
 		Listing the commits of a repository
 		if after time is set to an int (unix time def) or datetime.datetime instead of None, only commits strictly after given time. Commits are listed by default from most recent to least.
+		with topology_only, only sha, parents and time are given, without reading commit objects when the commit graph is used
 		'''
 		if isinstance(after_time,datetime.datetime):
 			after_time = datetime.datetime.timestamp(after_time)
@@ -116,21 +134,33 @@ class CommitsFiller(fillers.Filler):
 		# for commit in repo_obj.walk(repo_obj.head.target, pygit2.GIT_SORT_TIME | pygit2.GIT_SORT_REVERSE):
 
 		if not repo_obj.is_empty:
-			for commit in repo_obj.walk(repo_obj.head.target, pygit2.GIT_SORT_TIME):
-				if after_time is not None and commit.commit_time<after_time:
+			diff_stats = not basic_info_only and not self.is_partial_clone(repo_obj)
+			for sha,parents,commit_time,commit in self.walk_commits(repo_obj,use_graph=topology_only):
+				if after_time is not None and commit_time<after_time:
 					break
+				if topology_only:
+					yield {
+							'time':commit_time,
+							'sha':sha,
+							'parents':parents,
+							'repo_id':repo_id,
+							}
+					continue
 				if basic_info_only:
 					yield {
 							'author_email':commit.author.email,
 							'author_name':commit.author.name,
-							'time':commit.commit_time,
+							'time':commit_time,
 							'time_offset':commit.commit_time_offset,
-							'sha':commit.hex,
-							'parents':[pid.hex for pid in commit.parent_ids],
+							'sha':sha,
+							'parents':parents,
 							'repo_id':repo_id,
 							}
 				else:
-					if commit.parents:
+					if not diff_stats:
+						insertions = None
+						deletions = None
+					elif commit.parents:
 						diff_obj = repo_obj.diff(commit.parents[0],commit)# Inverted order wrt the expected one, to have expected values for insertions and deletions
 						insertions = diff_obj.stats.insertions
 						deletions = diff_obj.stats.deletions
@@ -142,16 +172,67 @@ class CommitsFiller(fillers.Filler):
 					yield {
 							'author_email':commit.author.email,
 							'author_name':commit.author.name,
-							'time':commit.commit_time,
+							'time':commit_time,
 							'time_offset':commit.commit_time_offset,
-							'sha':commit.hex,
-							'parents':[pid.hex for pid in commit.parent_ids],
+							'sha':sha,
+							'parents':parents,
 							'insertions':insertions,
 							'deletions':deletions,
-							'total':insertions+deletions,
+							'total':None if insertions is None else insertions+deletions,
 							'repo_id':repo_id,
 							}
 
+	def walk_commits(self,repo_obj,use_graph=False):
+		'''
+		Yields (sha,parent shas,commit_time,commit) for the commits reachable from HEAD, by decreasing commit time.
+		With use_graph, from the commit graph if available, commit being None; with pygit2 otherwise, commit being the pygit2 commit object.
+		If the commit graph turns out to be corrupt during the walk, the walk goes on with pygit2, skipping commits already yielded.
+		'''
+		graph = self.get_commit_graph(repo_obj) if use_graph else None
+		seen = set()
+		if graph is not None:
+			try:
+				with graph:
+					for oid,parents,commit_time in graph.walk(repo_obj.head.target.raw):
+						seen.add(oid)
+						yield oid.hex(),[p.hex() for p in parents],commit_time,None
+				return
+			except CommitGraphError as e:
+				self.logger.info('Corrupt commit graph for {}, walking with pygit2: {}'.format(repo_obj.path,e))
+		for commit in repo_obj.walk(repo_obj.head.target, pygit2.GIT_SORT_TIME):
+			if commit.id.raw in seen:
+				continue
+			yield commit.hex,[pid.hex for pid in commit.parent_ids],commit.commit_time,commit
+
+	def get_commit_graph(self,repo_obj):
+		'''
+		Returns the commit graph of the repo, written (git commit-graph write) if missing or not containing HEAD (e.g. after a fetch), to be closed by the caller.
+		None if use_commit_graph is False or if it is unavailable (including corrupt files).
+		'''
+		if not self.use_commit_graph:
+			return None
+		head = repo_obj.head.target.raw
+		graph = None
+		try:
+			graph = CommitGraph.from_git_dir(repo_obj.path)
+			if graph is None or graph.position(head) is None:
+				if graph is not None:
+					graph.close()
+					graph = None
+				subprocess.run(['git','-C',repo_obj.path,'commit-graph','write','--reachable','--no-progress'],check=True,stdout=subprocess.DEVNULL,stderr=subprocess.PIPE)
+				graph = CommitGraph.from_git_dir(repo_obj.path)
+		except (OSError,subprocess.CalledProcessError,CommitGraphError) as e:
+			self.logger.info('Commit graph unavailable for {}: {}'.format(repo_obj.path,e))
+			if graph is not None:
+				graph.close()
+			return None
+		if graph is None:
+			return None
+		if graph.position(head) is None:
+			graph.close()
+			return None
+		return graph
+
 	def get_repo(self,name,source,owner):
 		'''
 		Returns the pygit2 repository object
@@ -160,8 +241,33 @@ class CommitsFiller(fillers.Filler):
 		if not os.path.exists(repo_folder):
 			raise ValueError('Repository {}/{}/{} not found in cloned_repos folder'.format(source,owner,name))
 		else:
-			return pygit2.Repository(os.path.join(repo_folder,'.git'))
+			# opens both clones with working tree and bare clones (see ClonesFiller clone_mode)
+			return pygit2.Repository(repo_folder)
 
+	def is_partial_clone(self,repo_obj):
+		'''
+		True for partial (e.g. blobless) clones: libgit2 cannot fetch their missing blobs, so diffs cannot be computed
+		'''
+		try:
+			return repo_obj.config.get_bool('remote.origin.promisor')
+		except KeyError:
+			return False
+
+
+	def resolve_shas(self,sha_list,sha_map):
+		'''
+		Completes sha_map (sha -> commit id) with the shas of sha_list that are not in it yet, with one query per chunk of shas.
+		Shas absent from the commits table are mapped to None.
+		'''
+		missing = list(set(sha for sha in sha_list if sha not in sha_map))
+		cursor = self.db.connection.cursor()
+		for chunk in misc.chunked(missing,self.sha_chunk_size):
+			if self.db.db_type == 'postgres':
+				cursor.execute('''SELECT sha,id FROM commits WHERE sha=ANY(%s);''',(chunk,))
+			else:
+				cursor.execute('''SELECT sha,id FROM commits WHERE sha IN ({});'''.format(','.join('?'*len(chunk))),chunk)
+			sha_map.update((sha,None) for sha in chunk)
+			sha_map.update(cursor.fetchall())
 
 	def fill_authors(self,commit_info_list,autocommit=True):
 		'''
@@ -190,13 +296,14 @@ class CommitsFiller(fillers.Filler):
 				INSERT INTO identity_types(name) VALUES('email')
 				ON CONFLICT DO NOTHING
 				;''')
+			email_type_id = self.db.get_identity_type_id(identity_type='email')
 
 			extras.execute_batch(self.db.cursor,'''
 				INSERT INTO users(
 						creation_identity,
-						creation_identity_type_id) VALUES(%s,(SELECT id FROM identity_types WHERE name='email'))
+						creation_identity_type_id) VALUES(%s,%s)
 				ON CONFLICT DO NOTHING;
-				''',((c['author_email'],) for c in tr_gen))
+				''',((c['author_email'],email_type_id) for c in tr_gen))
 
 			extras.execute_batch(self.db.cursor,'''
 				INSERT INTO identities(
@@ -204,10 +311,10 @@ class CommitsFiller(fillers.Filler):
 						identity,
 						user_id,
 						identity_type_id) VALUES(%s,%s,
-						(SELECT id FROM users WHERE creation_identity=%s AND creation_identity_type_id=(SELECT id FROM identity_types WHERE name='email')),
-						(SELECT id FROM identity_types WHERE name='email'))
+						(SELECT id FROM users WHERE creation_identity=%s AND creation_identity_type_id=%s),
+						%s)
 				ON CONFLICT DO NOTHING;
-				''',((json.dumps({'name':c['author_name']}),c['author_email'],c['author_email']) for c in tr_gen))
+				''',((json.dumps({'name':c['author_name']}),c['author_email'],c['author_email'],email_type_id,email_type_id) for c in tr_gen))
 
 
 
@@ -215,13 +322,14 @@ class CommitsFiller(fillers.Filler):
 			self.db.cursor.execute('''
 				INSERT OR IGNORE INTO identity_types(name) VALUES('email')
 				;''')
+			email_type_id = self.db.get_identity_type_id(identity_type='email')
 
 			self.db.cursor.executemany('''
 				INSERT OR IGNORE INTO users(
 						creation_identity,
-						creation_identity_type_id) VALUES(?,(SELECT id FROM identity_types WHERE name='email'))
+						creation_identity_type_id) VALUES(?,?)
 				;
-				''',((c['author_email'],) for c in tr_gen))
+				''',((c['author_email'],email_type_id) for c in tr_gen))
 
 			self.db.cursor.executemany('''
 				INSERT OR IGNORE INTO identities(
@@ -229,24 +337,21 @@ class CommitsFiller(fillers.Filler):
 						identity,
 						user_id,
 						identity_type_id) VALUES(?,?,
-						(SELECT id FROM users WHERE creation_identity=? AND creation_identity_type_id=(SELECT id FROM identity_types WHERE name='email')),
-						(SELECT id FROM identity_types WHERE name='email'))
+						(SELECT id FROM users WHERE creation_identity=? AND creation_identity_type_id=?),
+						?)
 				;
-				''',((json.dumps({'name':c['author_name']}),c['author_email'],c['author_email']) for c in tr_gen))
+				''',((json.dumps({'name':c['author_name']}),c['author_email'],c['author_email'],email_type_id,email_type_id) for c in tr_gen))
 
 		# self.complete_id_users()
 
 		if not tracked_data['empty']:
 			repo_id = tracked_data['last_commit']['repo_id']
 			latest_commit_time = datetime.datetime.fromtimestamp(tracked_data['latest_commit_time'])
-			if self.db.db_type == 'postgres':
-				self.db.cursor.execute('''INSERT INTO table_updates(repo_id,table_name,latest_commit_time) VALUES(%s,'identities',%s) ;''',(repo_id,latest_commit_time))
-			else:
-				self.db.cursor.execute('''INSERT INTO table_updates(repo_id,table_name,latest_commit_time) VALUES(?,'identities',?) ;''',(repo_id,latest_commit_time))
+			self.db.insert_update(table='identities',repo_id=repo_id,latest_commit_time=latest_commit_time,autocommit=False)
 
 
 		if autocommit:
-			self.db.connection.commit()
+			self.db.commit()
 
 
 
@@ -269,41 +374,34 @@ class CommitsFiller(fillers.Filler):
 			extras.execute_batch(self.db.cursor,'''
 				INSERT INTO commits(sha,author_id,created_at,insertions,deletions)
 					VALUES(%s,
-							(SELECT i.id FROM identities i
-								INNER JOIN identity_types it
-							 ON i.identity=%s AND it.name='email' AND it.id=i.identity_type_id),
+							%s,
 							%s,
 							%s,
 							%s
 							)
 				ON CONFLICT DO NOTHING;
-				''',((c['sha'],c['author_email'],datetime.datetime.fromtimestamp(c['time']),c['insertions'],c['deletions'],) for c in tracked_gen(commit_info_list)))
+				''',((c['sha'],self.db.get_identity_id(identity=c['author_email'],identity_type='email'),datetime.datetime.fromtimestamp(c['time']),c['insertions'],c['deletions'],) for c in tracked_gen(commit_info_list)))
 
 		else:
 			self.db.cursor.executemany('''
 				INSERT OR IGNORE INTO commits(sha,author_id,created_at,insertions,deletions)
 					VALUES(?,
-							(SELECT i.id FROM identities i
-								INNER JOIN identity_types it
-							 ON i.identity=? AND it.name='email' AND it.id=i.identity_type_id),
+							?,
 							?,
 							?,
 							?
 							);
-				''',((c['sha'],c['author_email'],datetime.datetime.fromtimestamp(c['time']),c['insertions'],c['deletions'],) for c in tracked_gen(commit_info_list)))
+				''',((c['sha'],self.db.get_identity_id(identity=c['author_email'],identity_type='email'),datetime.datetime.fromtimestamp(c['time']),c['insertions'],c['deletions'],) for c in tracked_gen(commit_info_list)))
 
 		if not tracked_data['empty']:
 			repo_id = tracked_data['last_commit']['repo_id']
 			latest_commit_time = datetime.datetime.fromtimestamp(tracked_data['latest_commit_time'])
-			if self.db.db_type == 'postgres':
-				self.db.cursor.execute('''INSERT INTO table_updates(repo_id,table_name,latest_commit_time) VALUES(%s,'commits',%s) ;''',(repo_id,latest_commit_time))
-			else:
-				self.db.cursor.execute('''INSERT INTO table_updates(repo_id,table_name,latest_commit_time) VALUES(?,'commits',?) ;''',(repo_id,latest_commit_time))
+			self.db.insert_update(table='commits',repo_id=repo_id,latest_commit_time=latest_commit_time,autocommit=False)
 
 
 
 		if autocommit:
-			self.db.connection.commit()
+			self.db.commit()
 
 	def fill_commit_repos(self,commit_info_list,autocommit=True):
 		'''
@@ -318,38 +416,38 @@ class CommitsFiller(fillers.Filler):
 				tracked_data['latest_commit_time'] = max(tracked_data['latest_commit_time'],c['time'])
 				yield c
 
+		sha_map = {}
+		def id_list(orig_gen):
+			for chunk in misc.chunked(tracked_gen(orig_gen),self.sha_chunk_size):
+				self.resolve_shas(sha_list=(c['sha'] for c in chunk),sha_map=sha_map)
+				for c in chunk:
+					commit_id = sha_map[c['sha']]
+					if commit_id is not None:
+						yield (commit_id,c['repo_id'])
+
 		if self.db.db_type == 'postgres':
 			extras.execute_batch(self.db.cursor,'''
 				INSERT INTO commit_repos(commit_id,repo_id)
-					VALUES(
-							(SELECT id FROM commits WHERE sha=%s),
-							%s
-							)
+					VALUES(%s,%s)
 				ON CONFLICT DO NOTHING;
-				''',((c['sha'],c['repo_id'],) for c in tracked_gen(commit_info_list)))
+				''',id_list(commit_info_list))
 
 		else:
 			self.db.cursor.executemany('''
 				INSERT OR IGNORE INTO commit_repos(commit_id,repo_id)
-					VALUES(
-							(SELECT id FROM commits WHERE sha=?),
-							?
-							);
-				''',((c['sha'],c['repo_id'],) for c in tracked_gen(commit_info_list)))
+					VALUES(?,?);
+				''',id_list(commit_info_list))
 
 
 		if not tracked_data['empty']:
 			repo_id = tracked_data['last_commit']['repo_id']
 			latest_commit_time = datetime.datetime.fromtimestamp(tracked_data['latest_commit_time'])
-			if self.db.db_type == 'postgres':
-				self.db.cursor.execute('''INSERT INTO table_updates(repo_id,table_name,latest_commit_time) VALUES(%s,'commit_repos',%s) ;''',(repo_id,latest_commit_time))
-			else:
-				self.db.cursor.execute('''INSERT INTO table_updates(repo_id,table_name,latest_commit_time) VALUES(?,'commit_repos',?) ;''',(repo_id,latest_commit_time))
+			self.db.insert_update(table='commit_repos',repo_id=repo_id,latest_commit_time=latest_commit_time,autocommit=False)
 
 
 
 		if autocommit:
-			self.db.connection.commit()
+			self.db.commit()
 
 	def fill_commit_orig_repo(self,commit_info_list,autocommit=True):
 		'''
@@ -387,64 +485,69 @@ class CommitsFiller(fillers.Filler):
 		if not tracked_data['empty']:
 			repo_id = tracked_data['last_commit']['repo_id']
 			latest_commit_time = datetime.datetime.fromtimestamp(tracked_data['latest_commit_time'])
-			if self.db.db_type == 'postgres':
-				self.db.cursor.execute('''INSERT INTO table_updates(repo_id,table_name,latest_commit_time) VALUES(%s,'commit_repos',%s) ;''',(repo_id,latest_commit_time))
-			else:
-				self.db.cursor.execute('''INSERT INTO table_updates(repo_id,table_name,latest_commit_time) VALUES(?,'commit_repos',?) ;''',(repo_id,latest_commit_time))
+			self.db.insert_update(table='commit_repos',repo_id=repo_id,latest_commit_time=latest_commit_time,autocommit=False)
 
 
 
 		if autocommit:
-			self.db.connection.commit()
+			self.db.commit()
 
 	def fill_commit_parents(self,commit_info_list,autocommit=True):
 		'''
 		Creating table if necessary.
 		Filling commit parenthood in table.
+		Edges whose child or parent is not in the commits table (e.g. parents outside of a shallow history) cannot be stored with ids:
+		they are skipped, and their number is logged and returned.
 		'''
 
-		tracked_data = {'latest_commit_time':0,'empty':True}
-		def transformed_list(orig_gen):
+		tracked_data = {'latest_commit_time':0,'empty':True,'skipped':0}
+		def tracked_gen(orig_gen):
 			for c in orig_gen:
 				tracked_data['last_commit'] = c
 				tracked_data['empty'] = False
 				tracked_data['latest_commit_time'] = max(tracked_data['latest_commit_time'],c['time'])
-				c_id = c['sha']
-				for r,p_id in enumerate(c['parents']):
-					yield (c_id,p_id,r)
+				yield c
+
+		sha_map = {}
+		def transformed_list(orig_gen):
+			for chunk in misc.chunked(tracked_gen(orig_gen),self.sha_chunk_size):
+				self.resolve_shas(sha_list=(sha for c in chunk for sha in [c['sha'],*c['parents']]),sha_map=sha_map)
+				for c in chunk:
+					c_id = sha_map[c['sha']]
+					for r,p_sha in enumerate(c['parents']):
+						p_id = sha_map[p_sha]
+						if c_id is not None and p_id is not None:
+							yield (c_id,p_id,r)
+						else:
+							tracked_data['skipped'] += 1
 
 		if self.db.db_type == 'postgres':
 			extras.execute_batch(self.db.cursor,'''
 				INSERT INTO commit_parents(child_id,parent_id,rank)
-					VALUES(
-							(SELECT id FROM commits WHERE sha=%s),
-							(SELECT id FROM commits WHERE sha=%s),
-							%s)
+					VALUES(%s,%s,%s)
 				ON CONFLICT DO NOTHING;
 				''',transformed_list(commit_info_list))
 
 		else:
 			self.db.cursor.executemany('''
 				INSERT OR IGNORE INTO commit_parents(child_id,parent_id,rank)
-					VALUES(
-							(SELECT id FROM commits WHERE sha=?),
-							(SELECT id FROM commits WHERE sha=?),
-							?);
+					VALUES(?,?,?);
 				''',transformed_list(commit_info_list))
 
 		if not tracked_data['empty']:
 			repo_id = tracked_data['last_commit']['repo_id']
 			latest_commit_time = datetime.datetime.fromtimestamp(tracked_data['latest_commit_time'])
+			self.db.insert_update(table='commit_parents',repo_id=repo_id,latest_commit_time=latest_commit_time,autocommit=False)
 			if self.db.db_type == 'postgres':
-				self.db.cursor.execute('''INSERT INTO table_updates(repo_id,table_name,latest_commit_time) VALUES(%s,'commit_parents',%s) ;''',(repo_id,latest_commit_time))
 				self.db.cursor.execute('''UPDATE repositories SET latest_commit_time=%s WHERE id=%s;''',(latest_commit_time,repo_id))
 			else:
-				self.db.cursor.execute('''INSERT INTO table_updates(repo_id,table_name,latest_commit_time) VALUES(?,'commit_parents',?) ;''',(repo_id,latest_commit_time))
 				self.db.cursor.execute('''UPDATE repositories SET latest_commit_time=? WHERE id=?;''',(latest_commit_time,repo_id))
-
+			if tracked_data['skipped']:
+				self.logger.warning('Skipped {} commit parent edges of repo {} with commits missing from the commits table'.format(tracked_data['skipped'],repo_id))
 
 		if autocommit:
-			self.db.connection.commit()
+			self.db.commit()
+		return tracked_data['skipped']
 
 	def fill_commit_orig_repo(self,only_null=True):
 		'''
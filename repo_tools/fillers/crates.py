@@ -1,14 +1,25 @@
 import datetime
 import os
+import re
+import itertools
 import psycopg2
 
 from repo_tools import fillers
 from repo_tools.fillers import generic
+from repo_tools import misc
 import repo_tools as rp
 
 class CratesFiller(generic.PackageFiller):
 	"""
 	wrapper around generic.PackageFiller for a crates.io database
+
+	Crates are streamed from a server-side cursor, by chunks of chunk_size.
+	In incremental mode, only crates created or updated after the last sync are fetched, and already registered ones are updated.
+	The watermark is the latest created_at/updated_at of the crates database, stored in the full_updates table.
+
+	If dump_file is given, crates are read from the crates.io database dump (tar.gz, see https://crates.io/data-access) instead of a restored database:
+	data/crates.csv is streamed directly from the archive. If the file is not in data_folder and dump_url is not None, it is downloaded first.
+	With dump_ttl (seconds) set, the dump is fetched through the data cache instead, and refreshed when older than dump_ttl.
 	"""
 
 	def __init__(self,
@@ -20,10 +31,21 @@ class CratesFiller(generic.PackageFiller):
 			password=None,
 			host='localhost',
 			package_limit=None,
+			chunk_size=10000,
+			incremental=False,
+			dump_file=None,
+			dump_url='https://static.crates.io/db-dump.tar.gz',
+			dump_ttl=None,
 					**kwargs):
 		self.source = source
 		self.source_urlroot = source_urlroot
 		self.package_limit = package_limit
+		self.chunk_size = chunk_size
+		self.incremental = incremental
+		self.dump_file = dump_file
+		self.dump_url = dump_url
+		self.dump_ttl = dump_ttl
+		self.package_list = None
 		self.conninfo = {'database':database,
 						'port':port,
 						'user':user,
@@ -40,22 +62,37 @@ class CratesFiller(generic.PackageFiller):
 		if not os.path.exists(data_folder):
 			os.makedirs(data_folder)
 
+		if self.dump_file is not None and self.dump_url is not None:
+			if self.dump_ttl is not None:
+				self.cached_download(url=self.dump_url,destination=os.path.join(data_folder,self.dump_file),ttl=self.dump_ttl)
+			elif not os.path.exists(os.path.join(data_folder,self.dump_file)):
+				self.download(url=self.dump_url,destination=os.path.join(data_folder,self.dump_file))
+
 		self.db.register_source(source=self.source,source_urlroot=self.source_urlroot)
 		if self.source_urlroot is None:
 			self.source_url_root = self.db.get_source_info(source=self.source)[1]
 
-		crates_conn = psycopg2.connect(**self.conninfo)
-		try:
-			self.package_list = self.get_packages_from_crates(conn=crates_conn)
-		finally:
-			crates_conn.close()
+		self.update_type = 'packages_{}'.format(self.source)
+		if self.incremental:
+			self.last_sync = self.db.get_last_full_update(update_type=self.update_type)
+		else:
+			self.last_sync = None
+		self.sync_watermark = None
 
-	def get_packages_from_crates(self,conn,limit=None):
+	def get_packages_from_crates(self,conn,limit=None,since=None):
 		'''
 		From a connection to a crates.io database, output the list of packages as expected by RepoCrawler.add_packages()
 		package id, package name, created_at (datetime.datetime),repo_url
 		'''
-		cursor = conn.cursor()
+		return [p for chunk in self.iter_packages_from_crates(conn=conn,limit=limit,since=since) for p in chunk]
+
+	def iter_packages_from_crates(self,conn,limit=None,since=None,chunk_size=None):
+		'''
+		Same as get_packages_from_crates, but yields lists of at most chunk_size packages, fetched through a named (server-side) cursor.
+		If since is not None, only crates created or updated after since are fetched.
+		'''
+		if chunk_size is None:
+			chunk_size = self.chunk_size
 
 		if limit is None:
 			limit = self.package_limit
@@ -69,13 +106,96 @@ class CratesFiller(generic.PackageFiller):
 		else:
 			limit_str = ''
 
-		cursor.execute('''
-			SELECT id,name,created_at,repository FROM crates {}
-			;'''.format(limit_str))
+		cursor = conn.cursor(name='crates_packages')
+		cursor.itersize = chunk_size
+		try:
+			cursor.execute('''
+				SELECT id,name,created_at,repository FROM crates
+				WHERE %s::timestamp IS NULL OR created_at>%s OR updated_at>%s
+				ORDER BY id {}
+				;'''.format(limit_str),(since,since,since))
+			while True:
+				chunk = cursor.fetchmany(chunk_size)
+				if not chunk:
+					break
+				yield chunk
+		finally:
+			cursor.close()
+
+	def iter_package_chunks(self,chunk_size=None):
+		'''
+		Connects to the crates.io database and streams packages, see iter_packages_from_crates.
+		The watermark for the next incremental sync is read before streaming, and stored in self.sync_watermark once all crates are streamed.
+		With a dump file, see iter_packages_from_dump.
+		'''
+		if self.dump_file is not None:
+			yield from self.iter_packages_from_dump(chunk_size=chunk_size)
+			return
+		crates_conn = psycopg2.connect(**self.conninfo)
+		try:
+			cursor = crates_conn.cursor()
+			cursor.execute('''SELECT MAX(GREATEST(created_at,updated_at)) FROM crates;''')
+			watermark = cursor.fetchone()[0]
+			cursor.close()
+			yield from self.iter_packages_from_crates(conn=crates_conn,since=self.last_sync,chunk_size=chunk_size)
+			# a limited sync is partial, and does not move the watermark
+			if self.package_limit is None:
+				self.sync_watermark = watermark
+		finally:
+			crates_conn.close()
+
+	def iter_dump_csv(self,table):
+		'''
+		Streams the rows (as dicts) of a table of the crates.io database dump, e.g. crates, versions or dependencies
+		'''
+		return self.iter_tar_csv(orig_file=os.path.join(self.data_folder,self.dump_file),member_name='data/{}.csv'.format(table))
 
-		return cursor.fetchall()
+	def iter_packages_from_dump(self,chunk_size=None):
+		'''
+		Same as iter_packages_from_crates, reading crates.csv from the database dump.
+		The watermark is computed along the stream, and stored in self.sync_watermark once all crates are read.
+		'''
+		if chunk_size is None:
+			chunk_size = self.chunk_size
+		since = parse_dump_time(self.last_sync)
+		watermark = None
 
+		def package_gen():
+			nonlocal watermark
+			for row in self.iter_dump_csv(table='crates'):
+				created_at = parse_dump_time(row['created_at'])
+				updated_at = parse_dump_time(row['updated_at'])
+				latest = max(t for t in (created_at,updated_at,datetime.datetime.min) if t is not None)
+				if watermark is None or latest > watermark:
+					watermark = latest
+				if since is None or latest > since:
+					yield (int(row['id']),row['name'],created_at,row['repository'] or None)
+
+		packages = package_gen()
+		if self.package_limit is not None:
+			packages = itertools.islice(packages,self.package_limit)
+		yield from misc.chunked(packages,chunk_size)
+		if self.package_limit is None:
+			self.sync_watermark = watermark
 
 	def apply(self):
-		self.fill_packages()
-		self.db.connection.commit()
+		# incremental syncs do not skip sources already filled, and update changed packages
+		self.fill_packages(force=self.incremental,update=self.incremental)
+		if self.sync_watermark is not None:
+			self.db.record_full_update(update_type=self.update_type,updated_at=self.sync_watermark)
+		self.db.commit()
+
+
+def parse_dump_time(t):
+	'''
+	Parses timestamps of the crates.io dump (e.g. 2015-12-13 14:36:55.150432+00) into naive datetimes, as in the crates database.
+	Datetimes and None are returned as is.
+	'''
+	if t is None or isinstance(t,datetime.datetime):
+		return t
+	if not t:
+		return None
+	m = re.match(r'^(\d{4}-\d{2}-\d{2})[ T](\d{2}:\d{2}:\d{2})(\.\d+)?',t)
+	if m is None:
+		raise ValueError('Unknown timestamp format: {}'.format(t))
+	return datetime.datetime.strptime('{} {}{}'.format(m.group(1),m.group(2),(m.group(3) or '.0')[:7]),'%Y-%m-%d %H:%M:%S.%f')
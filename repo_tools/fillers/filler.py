@@ -1,12 +1,20 @@
 import os
+import sys
+import codecs
 import requests
 import zipfile
-import pandas as pd
+import tarfile
+import openpyxl
 import logging
 import csv
 from psycopg2 import extras
 import json
 import subprocess
+import threading
+from concurrent import futures
+
+from repo_tools import misc
+from repo_tools.data_cache import DataCache
 
 logger = logging.getLogger(__name__)
 ch = logging.StreamHandler()
@@ -16,6 +24,29 @@ ch.setFormatter(formatter)
 logger.addHandler(ch)
 logger.setLevel(logging.INFO)
 
+thread_sessions = threading.local()
+
+def get_session(pool_maxsize=10):
+	'''
+	Returns a requests session for the current thread and pool_maxsize, created at first call and then reused,
+	so that successive downloads from the same host reuse pooled connections
+	'''
+	if not hasattr(thread_sessions,'sessions'):
+		thread_sessions.sessions = {}
+	if pool_maxsize not in thread_sessions.sessions:
+		session = requests.Session()
+		adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_maxsize)
+		session.mount('http://',adapter)
+		session.mount('https://',adapter)
+		thread_sessions.sessions[pool_maxsize] = session
+	return thread_sessions.sessions[pool_maxsize]
+
+class DownloadError(IOError):
+	'''
+	raised when a download cannot be completed or does not match the expected checksum
+	'''
+	pass
+
 class Filler(object):
 	"""
 	The Filler class and its children provide methods to fill the database, potentially from different sources.
@@ -24,12 +55,24 @@ class Filler(object):
 
 	For writing children, just change the 'apply' method, and do not forget the commit at the end.
 	This class is just an abstract 'mother' class
+
+	requires and provides list the tables (or names of other fillers, for requires) a filler reads and writes.
+	They are used by Database.fill_db to run independent fillers concurrently; None (the default) means unknown,
+	and the filler then runs after all previously added fillers and before all following ones.
+	Incidental writes shared by all fillers (table_updates, registration of their own source) are not listed.
 	"""
 
-	def __init__(self,db=None,name=None,data_folder=None):#,file_info=None):
+	requires = None
+	provides = None
+
+	def __init__(self,db=None,name=None,data_folder=None,requires=None,provides=None):#,file_info=None):
 		if name is None:
 			name = self.__class__.__name__
 		self.name = name
+		if requires is not None:
+			self.requires = requires
+		if provides is not None:
+			self.provides = provides
 		if db is not None:
 			db.add_filler(self)
 		self.data_folder = data_folder
@@ -48,7 +91,7 @@ class Filler(object):
 
 	def apply(self):
 		# filling script here
-		self.db.connection.commit()
+		self.db.commit()
 
 	def prepare(self,**kwargs):
 		'''
@@ -68,14 +111,120 @@ class Filler(object):
 
 
 
-	def download(self,url,destination,wget=False):
+	def download(self,url,destination,wget=False,checksum=None,checksum_type='sha256',resume=True,timeout=60,retries=3,chunk_size=2**20):
+		'''
+		Downloads url to destination. The content is streamed by chunks of chunk_size bytes to destination+'.part',
+		which is moved to destination once complete (and checked against checksum, a hexdigest of type checksum_type, if given).
+
+		If resume is True, an existing .part file (e.g. from an interrupted run) is completed with an HTTP Range request,
+		and interrupted transfers are resumed the same way, up to retries times. timeout is in seconds, for connection and between chunks.
+		The validator (strong ETag or Last-Modified) of the response that started the .part file is kept in destination+'.part.validator'
+		and sent as If-Range, so that a .part file of an older version of the file is downloaded again from scratch;
+		a .part file without validator is discarded.
+		'''
 		self.logger.info('Downloading {}'.format(url))
-		if not wget:
-			r = requests.get(url, allow_redirects=True)
-			with open(destination, 'wb') as f:
-				f.write(r.content)
-		else:
+		if wget:
 			subprocess.check_call('wget -O {} {}'.format(destination,url).split(' '))
+		else:
+			part_file = destination+'.part'
+			if not resume:
+				self.remove_part(part_file)
+			for attempt in range(retries+1):
+				try:
+					self.download_part(url=url,part_file=part_file,timeout=timeout,chunk_size=chunk_size,resume_unvalidated=(attempt>0))
+					break
+				except (requests.exceptions.ConnectionError,requests.exceptions.ChunkedEncodingError,requests.exceptions.Timeout,DownloadError) as e:
+					if attempt == retries:
+						raise
+					self.logger.info('Download of {} interrupted ({}), resuming'.format(url,e))
+			if checksum is not None:
+				part_hash = misc.file_hash(part_file,algorithm=checksum_type)
+				if part_hash != checksum:
+					self.remove_part(part_file)
+					raise DownloadError('Checksum mismatch for {}: expected {}, got {}'.format(url,checksum,part_hash))
+			os.replace(part_file,destination)
+			self.remove_part(part_file)
+
+	def remove_part(self,part_file):
+		'''
+		Removes a .part file and its validator, if present
+		'''
+		for filename in (part_file,part_file+'.validator'):
+			if os.path.exists(filename):
+				os.remove(filename)
+
+	def download_part(self,url,part_file,timeout=60,chunk_size=2**20,resume_unvalidated=False):
+		'''
+		Completes part_file with the content of url, starting from its current size.
+		The part is resumed only if the content did not change since it was started (If-Range with its validator),
+		or without validator if resume_unvalidated (retries within the same download).
+		'''
+		validator_file = part_file+'.validator'
+		offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+		validator = None
+		if offset and os.path.exists(validator_file):
+			with open(validator_file,'r') as f:
+				validator = f.read().strip() or None
+		if offset and validator is None and not resume_unvalidated:
+			self.logger.info('Discarding {} bytes of {}: no validator to check that the content did not change'.format(offset,part_file))
+			offset = 0
+		headers = {}
+		if offset:
+			headers['Range'] = 'bytes={}-'.format(offset)
+			if validator is not None:
+				headers['If-Range'] = validator
+		with get_session().get(url,headers=headers,stream=True,timeout=timeout,allow_redirects=True) as r:
+			if r.status_code == 416 and offset:
+				# range not satisfiable: the part file is already complete
+				return
+			r.raise_for_status()
+			if r.status_code == 206:
+				mode = 'ab'
+				expected_size = int(r.headers['Content-Range'].split('/')[-1]) if r.headers.get('Content-Range','*').split('/')[-1] != '*' else None
+			else:
+				# no offset, content changed since the part was started (If-Range), or server ignoring Range requests: restarting from scratch
+				mode = 'wb'
+				expected_size = int(r.headers['Content-Length']) if 'Content-Length' in r.headers and not r.headers.get('Content-Encoding') else None
+				etag = r.headers.get('ETag')
+				# If-Range needs a strong validator
+				new_validator = etag if etag is not None and not etag.startswith('W/') else r.headers.get('Last-Modified')
+				with open(validator_file,'w') as f:
+					f.write(new_validator or '')
+			with open(part_file,mode) as f:
+				for chunk in r.iter_content(chunk_size=chunk_size):
+					f.write(chunk)
+		if expected_size is not None and os.path.getsize(part_file) != expected_size:
+			raise DownloadError('Incomplete download of {}: {} bytes out of {}'.format(url,os.path.getsize(part_file),expected_size))
+
+	def cached_download(self,url,destination,ttl=None,max_size=None,**kwargs):
+		'''
+		Same as download, going through the data cache of data_folder (see repo_tools.data_cache.DataCache):
+		the file is downloaded only if it was not fetched in the last ttl seconds (ttl None: never refetched),
+		and the cache is limited to max_size bytes if given. kwargs are passed to download.
+		'''
+		cache = DataCache(folder=os.path.join(self.data_folder,'cache'),ttl=ttl,max_size=max_size)
+		path = cache.fetch(url=url,download=lambda url,destination: self.download(url=url,destination=destination,**kwargs))
+		return cache.copy_to(path=path,destination=destination)
+
+	def download_many(self,downloads,workers=4,**kwargs):
+		'''
+		Downloads several files concurrently, with workers threads (each reusing its own pooled session).
+		downloads is a list of (url,destination) or of dicts of arguments for download; kwargs are common arguments.
+		Returns the list of destinations, raises the first error encountered once all downloads are done.
+		'''
+		def download_one(d):
+			d_kwargs = dict(kwargs)
+			if isinstance(d,dict):
+				d_kwargs.update(d)
+			else:
+				d_kwargs['url'],d_kwargs['destination'] = d
+			self.download(**d_kwargs)
+			return d_kwargs['destination']
+
+		with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+			jobs = [executor.submit(download_one,d) for d in downloads]
+			futures.wait(jobs)
+		return [j.result() for j in jobs]
 
 	def unzip(self,orig_file,destination,clean_zip=False):
 		self.logger.info('Unzipping {}'.format(orig_file))
@@ -84,10 +233,48 @@ class Filler(object):
 		if clean_zip:
 			os.remove(orig_file)
 
-	def convert_xlsx(self,orig_file,destination,clean_xlsx=False):
+	def iter_tar_csv(self,orig_file,member_name):
+		'''
+		Streams the rows (as dicts) of a CSV file with header inside a possibly compressed tar archive, without extracting it.
+		The archive is read sequentially, and the first member whose path is member_name or ends with /member_name is used.
+		'''
+		self.logger.info('Reading {} from {}'.format(member_name,orig_file))
+		# dumps can contain very large fields (e.g. readmes)
+		csv.field_size_limit(min(sys.maxsize,2**31-1))
+		with tarfile.open(orig_file,'r|*') as tar:
+			for member in tar:
+				if member.isfile() and (member.name == member_name or member.name.endswith('/'+member_name)):
+					# members of streamed archives are not seekable, which io.TextIOWrapper requires
+					with tar.extractfile(member) as f:
+						yield from csv.DictReader(codecs.iterdecode(f,'utf-8'))
+					return
+		raise ValueError('No file {} in archive {}'.format(member_name,orig_file))
+
+	def iter_xlsx_rows(self,orig_file,sheet=None):
+		'''
+		Streams the rows (as tuples of cell values, None for empty cells) of a sheet of an XLSX file (default: the first one),
+		using the read-only mode of openpyxl so that memory does not depend on the size of the sheet
+		'''
+		wb = openpyxl.load_workbook(orig_file,read_only=True,data_only=True)
+		try:
+			ws = wb.worksheets[0] if sheet is None else wb[sheet]
+			yield from ws.iter_rows(values_only=True)
+		finally:
+			wb.close()
+
+	def convert_xlsx(self,orig_file,destination,clean_xlsx=False,header=False):
+		'''
+		Converts the first sheet of an XLSX file to CSV, row by row.
+		The first row (header) is not written unless header is True.
+		'''
 		self.logger.info('Converting {} to CSV'.format(orig_file))
-		data_xls = pd.read_excel(orig_file, index_col=None, engine='openpyxl')
-		data_xls.to_csv(destination,index=False,header=None ,encoding='utf-8')
+		with open(destination,'w',newline='',encoding='utf-8') as f:
+			writer = csv.writer(f)
+			rows = self.iter_xlsx_rows(orig_file)
+			if not header:
+				next(rows,None)
+			for row in rows:
+				writer.writerow(['' if v is None else v for v in row])
 		if clean_xlsx:
 			os.remove(orig_file)
 
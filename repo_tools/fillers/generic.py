@@ -5,8 +5,15 @@ import copy
 import pygit2
 import shutil
 import datetime
+import time
+import subprocess
+import contextlib
+import threading
+from concurrent import futures
 
 from repo_tools import fillers
+from repo_tools import misc
+from repo_tools.url_normalizer import UrlNormalizer
 import repo_tools as rp
 
 
@@ -25,10 +32,18 @@ class PackageFiller(fillers.Filler):
 	external_id,name,created_at,repository
 	or
 	name,created_at,repository
+
+	The file can also be an XLSX file (first sheet, same columns).
+	It is not loaded in memory: it is hashed by blocks, and rows are streamed and registered by chunks of chunk_size,
+	in a single transaction.
 	"""
-	def __init__(self,package_list=None,package_list_file=None,**kwargs):
+	requires = ('sources','repositories')
+	provides = ('urls','packages')
+
+	def __init__(self,package_list=None,package_list_file=None,chunk_size=10000,**kwargs):
 		self.package_list = package_list
 		self.package_list_file = package_list_file
+		self.chunk_size = chunk_size
 		fillers.Filler.__init__(self,**kwargs)
 
 	def prepare(self):
@@ -36,35 +51,58 @@ class PackageFiller(fillers.Filler):
 			self.data_folder = self.db.data_folder
 
 		if self.package_list is None:
-			with open(os.path.join(self.data_folder,self.package_list_file),"rb") as f:
-				filehash = hashlib.sha256(f.read()).hexdigest()
+			filehash = misc.file_hash(os.path.join(self.data_folder,self.package_list_file))
 			self.source = '{}_{}'.format(self.package_list_file,filehash)
 			self.db.register_source(source=self.source)
-			with open(os.path.join(self.data_folder,self.package_list_file),'r') as f:
-				reader = csv.reader(f)
-				headers = next(reader) #remove header
-				if len(headers) == 4:
-					self.package_list = [r for r in reader]
-				elif len(headers) == 3:
-					self.package_list = [(i,r[0],r[1],r[2]) for i,r in enumerate(reader)]
-				else:
-					raise ValueError('''Expected syntax:
+			with contextlib.closing(self.iter_package_file()) as rows:
+				self.check_headers(next(rows))
+
+	def check_headers(self,headers):
+		if len(headers) not in (3,4):
+			raise ValueError('''Expected syntax:
 external_id,name,created_at,repository
 or
 name,created_at,repository
 
 got: {}'''.format(headers))
 
+	def iter_package_chunks(self,chunk_size=None):
+		'''
+		Yields lists of at most chunk_size packages (package id, package name, created_at, repo_url) read from package_list_file
+		'''
+		if chunk_size is None:
+			chunk_size = self.chunk_size
+		with contextlib.closing(self.iter_package_file()) as reader:
+			headers = next(reader) #remove header
+			self.check_headers(headers)
+			if len(headers) == 4:
+				rows = reader
+			else:
+				rows = ((i,r[0],r[1],r[2]) for i,r in enumerate(reader))
+			yield from misc.chunked(rows,chunk_size)
+
+	def iter_package_file(self):
+		'''
+		Streams the rows of package_list_file, header included, from CSV or directly from XLSX (no intermediate CSV file)
+		'''
+		filepath = os.path.join(self.data_folder,self.package_list_file)
+		if filepath.endswith('.xlsx'):
+			yield from self.iter_xlsx_rows(filepath)
+		else:
+			with open(filepath,'r',newline='') as f:
+				yield from csv.reader(f)
 
 	def apply(self):
 		self.fill_packages()
-		self.db.connection.commit()
+		self.db.commit()
 
-	def fill_packages(self,package_list=None,source=None,force=False,clean_urls=True):
+	def fill_packages(self,package_list=None,source=None,force=False,clean_urls=True,update=False):
 		'''
 		adds repositories from a package repository database (eg crates)
 		syntax of package list:
 		package id (in source), package name, created_at (datetime.datetime),repo_url
+		If no package list is given or prepared, packages are streamed from iter_package_chunks
+		With update=True, already registered packages are updated (see Database.register_packages)
 
 		see .misc for wrappers
 		'''
@@ -74,33 +112,43 @@ got: {}'''.format(headers))
 		if source is None:
 			source = self.source
 		if not force:
+			source_id = self.db.get_source_id(source=source)
 			if self.db.db_type == 'postgres':
-				self.db.cursor.execute('SELECT * FROM packages WHERE source_id=(SELECT id FROM sources WHERE name=%s) LIMIT 1;',(source,))
+				self.db.cursor.execute('SELECT * FROM packages WHERE source_id=%s LIMIT 1;',(source_id,))
 			else:
-				self.db.cursor.execute('SELECT * FROM packages WHERE source_id=(SELECT id FROM sources WHERE name=?) LIMIT 1;',(source,))
+				self.db.cursor.execute('SELECT * FROM packages WHERE source_id=? LIMIT 1;',(source_id,))
 			sample_package = self.db.cursor.fetchone()
 			if sample_package is not None:
 				self.logger.info('Skipping packages from {}'.format(source))
 			else:
-				self.fill_packages(package_list=package_list,source=source,force=True,clean_urls=clean_urls)
+				self.fill_packages(package_list=package_list,source=source,force=True,clean_urls=clean_urls,update=update)
 		else:
 			self.logger.info('Filling packages from {}'.format(source))
 			self.db.register_source(source)
-			self.db.register_urls(source=source,url_list=[p[3] for p in package_list if p[3] is not None])
-
-			self.logger.info('Filled URLs')
+			if package_list is None:
+				package_chunks = self.iter_package_chunks()
+			else:
+				package_chunks = misc.chunked(package_list,self.chunk_size)
 
+			nb_packages = 0
+			# single transaction, so that an interrupted filling is not skipped at the next run
+			with self.db.batch():
+				for chunk in package_chunks:
+					self.db.register_urls(source=source,url_list=[p[3] for p in chunk if p[3] is not None])
 
-			# self.db.register_repositories(repo_info_list=[(self.clean_url(p[3])[1],self.clean_url(p[3])[0].split('/')[-2],self.clean_url(p[3])[0].split('/')[-1],self.clean_url(p[3])[0]) for p in package_list if p[3] is not None and self.clean_url(p[3])[0] is not None])
-			# self.logger.info('Filled repositories')
+					# self.db.register_repositories(repo_info_list=[(self.clean_url(p[3])[1],self.clean_url(p[3])[0].split('/')[-2],self.clean_url(p[3])[0].split('/')[-1],self.clean_url(p[3])[0]) for p in package_list if p[3] is not None and self.clean_url(p[3])[0] is not None])
 
-			self.db.register_packages(source=source,package_list=package_list)
-			self.logger.info('Filled packages')
+					self.db.register_packages(source=source,package_list=chunk,update=update)
+					nb_packages += len(chunk)
+			self.logger.info('Filled URLs and packages ({} packages)'.format(nb_packages))
 
 class SourcesFiller(fillers.Filler):
 	'''
 	Register given sources in the database
 	'''
+	requires = ()
+	provides = ('sources',)
+
 	def __init__(self,source,source_urlroot,**kwargs):
 		'''
 		source and source_urlroot can be strings or lists.
@@ -124,40 +172,116 @@ class SourcesFiller(fillers.Filler):
 		for s,su in self.source_list:
 			self.db.register_source(source=s,source_urlroot=su)
 
+class UpdatesCompactionFiller(fillers.Filler):
+	'''
+	Compacts the table_updates log, see Database.compact_table_updates.
+	A relative archive_file is taken in the data folder.
+	'''
+	def __init__(self,older_than=365*24*3600,archive_file=None,**kwargs):
+		self.older_than = older_than
+		self.archive_file = archive_file
+		fillers.Filler.__init__(self,**kwargs)
+
+	def prepare(self):
+		fillers.Filler.prepare(self)
+		if self.archive_file is not None and not os.path.isabs(self.archive_file):
+			self.archive_file = os.path.join(self.data_folder,self.archive_file)
+
+	def apply(self):
+		self.db.compact_table_updates(older_than=self.older_than,archive_file=self.archive_file)
+
 class RepositoriesFiller(fillers.Filler):
 	'''
 	From currently set sources, fills repositories with recognized URL
 	Also cleans URLs in url table
 	Goes through packages to associate them back with the created repos
 	Uses sources already in the database, dont forget to register them beforehand
+
+	URLs are processed in chunks of chunk_size, by increasing id, and marked as processed in urls.cleaned_at.
+	In incremental mode, only URLs that were never processed are, so that URLs that cannot be cleaned are not scanned again at each run;
+	a non incremental run processes all URLs again (e.g. after registering new sources).
 	'''
-	def __init__(self,source='autofill_repos_from_urls',**kwargs):
+	requires = ('sources','urls')
+	provides = ('urls','repositories')
+
+	def __init__(self,source='autofill_repos_from_urls',incremental=False,chunk_size=10000,**kwargs):
 		'''
 
 		'''
 		self.source = source
+		self.incremental = incremental
+		self.chunk_size = chunk_size
 		fillers.Filler.__init__(self,**kwargs)
 
 	def prepare(self):
 		if self.data_folder is None:
 			self.data_folder = self.db.data_folder
 
-		self.db.cursor.execute('SELECT id,url_root FROM sources WHERE url_root IS NOT NULL;')
-		self.url_roots = list(self.db.cursor.fetchall())
-
-		self.db.cursor.execute('SELECT url FROM urls;')
-		# self.urls = [(raw_url,cleaned_url,source_id)]
-		self.urls = list(set([(u[0],*self.clean_url(u[0])) for u in self.db.cursor.fetchall()]))
-		self.cleaned_urls = list(set([(cleaned_url,source_id) for (raw_url,cleaned_url,source_id) in self.urls]))
+		self.normalizer = UrlNormalizer.from_db(self.db)
 
-		# source_id,owner,name,cleaned_url
-		self.repo_info_list = [(source_id,cleaned_url.split('/')[-2],cleaned_url.split('/')[-1],cleaned_url) for (cleaned_url,source_id) in self.cleaned_urls ]
+		self.db.cursor.execute('SELECT MAX(id) FROM urls;')
+		self.max_url_id = self.db.cursor.fetchone()[0]
 
 	def apply(self):
 		self.fill_source()
-		self.fill_cleaned_urls()
-		self.fill_repositories()
-		self.logger.info('Filled repositories')
+		nb_urls = 0
+		for first_id,last_id,url_chunk in self.iter_url_chunks():
+			# self.urls = [(raw_url,cleaned_url,source_id)]
+			self.urls = list(set(self.normalizer.normalize_urls(url_chunk)))
+			self.cleaned_urls = list(set([(cleaned_url,source_id) for (raw_url,cleaned_url,source_id) in self.urls if cleaned_url is not None]))
+			# source_id,owner,name,cleaned_url
+			self.repo_info_list = [(source_id,cleaned_url.split('/')[-2],cleaned_url.split('/')[-1],cleaned_url) for (cleaned_url,source_id) in self.cleaned_urls ]
+			self.fill_cleaned_urls()
+			self.fill_repositories()
+			self.mark_processed(first_id=first_id,last_id=last_id)
+			nb_urls += len(url_chunk)
+		self.logger.info('Filled repositories, processed {} URLs'.format(nb_urls))
+
+	def iter_url_chunks(self):
+		'''
+		Yields (first id,last id,URLs) for chunks of at most chunk_size URLs to process, by keyset pagination on urls.id (up to the max id at preparation time)
+		'''
+		if self.max_url_id is None:
+			return
+		last_id = 0
+		while True:
+			if self.db.db_type == 'postgres':
+				self.db.cursor.execute('''
+					SELECT id,url FROM urls
+					WHERE id>%s AND id<=%s
+					AND (%s OR cleaned_at IS NULL)
+					ORDER BY id
+					LIMIT %s
+					;''',(last_id,self.max_url_id,not self.incremental,self.chunk_size))
+			else:
+				self.db.cursor.execute('''
+					SELECT id,url FROM urls
+					WHERE id>? AND id<=?
+					AND (? OR cleaned_at IS NULL)
+					ORDER BY id
+					LIMIT ?
+					;''',(last_id,self.max_url_id,not self.incremental,self.chunk_size))
+			rows = self.db.cursor.fetchall()
+			if not rows:
+				return
+			last_id = rows[-1][0]
+			yield rows[0][0],last_id,[url for url_id,url in rows]
+
+	def mark_processed(self,first_id,last_id):
+		'''
+		Sets cleaned_at for the URLs of a processed chunk, and for the cleaned URLs inserted by register_urls while processing it (their own cleaned version, already registered as repositories)
+		'''
+		if self.db.db_type == 'postgres':
+			self.db.cursor.execute('''
+				UPDATE urls SET cleaned_at=CURRENT_TIMESTAMP
+				WHERE ((id>=%s AND id<=%s) OR (id>%s AND cleaned_url=id AND cleaned_at IS NULL))
+				;''',(first_id,last_id,self.max_url_id))
+		else:
+			self.db.cursor.execute('''
+				UPDATE urls SET cleaned_at=CURRENT_TIMESTAMP
+				WHERE ((id>=? AND id<=?) OR (id>? AND cleaned_url=id AND cleaned_at IS NULL))
+				;''',(first_id,last_id,self.max_url_id))
+		self.db.commit()
 
 	def fill_source(self):
 		'''
@@ -189,14 +313,9 @@ class RepositoriesFiller(fillers.Filler):
 		getting a clean url based on what is available as sources, using source_urlroot values
 		returns clean_url,source_id
 		'''
-		if url is None:
-			return None
-		for ur_id,ur in self.url_roots:
-			try:
-				return self.repo_formatting(repo=url,source_urlroot=ur,output_cleaned_url=True),ur_id
-			except RepoSyntaxError:
-				continue
-		return None,None
+		if not hasattr(self,'normalizer'):
+			self.normalizer = UrlNormalizer.from_db(self.db)
+		return self.normalizer.normalize(url)
 
 	def repo_formatting(self,repo,source_urlroot,output_cleaned_url=False,raise_error=False):
 		'''
@@ -244,18 +363,64 @@ class ClonesFiller(fillers.Filler):
 	'''
 	Tries to clone all repositories present in the DB
 	'''
-	def __init__(self,force=False,update=False,failed=False,ssh_sources=None,ssh_key=os.path.join(os.environ['HOME'],'.ssh','id_rsa'),sources=None,rm_first=False,**kwargs):
+	requires = ('repositories',)
+	provides = ('clones',)
+	# lowercase parts of git error messages meaning that the repo is gone (deleted, private, blocked), retrying is pointless
+	permanent_errors = ('404','410','not found','does not exist','repository disabled','access to this repository has been disabled')
+	# over HTTPS, a repo that became private asks for credentials; over SSH (ssh_sources), these rather point to a key or configuration problem, and are transient
+	auth_errors = ('authentication required','authentication failed','could not read username','permission denied (publickey)')
+
+	def __init__(self,force=False,update=False,failed=False,ssh_sources=None,ssh_key=os.path.join(os.environ['HOME'],'.ssh','id_rsa'),sources=None,rm_first=False,workers=1,max_per_host=4,commit_every=100,clone_mode='full',use_alternates=False,time_budget=None,retry_delay=3600,max_retry_delay=30*86400,**kwargs):
 		'''
 		if sources is None, repositories of all sources are cloned. Otherwise, considered as a whitelist of sources to batch-clone.
 
 		sources listed in ssh_sources will be retrieved through SSH protocol, others with HTTPS
 		syntax: {source_name:source_ssh_key_path}
 		if the value source_ssh_key_path is None, it uses the main ssh_key arg
+
+		with workers>1, clones and fetches run in worker threads, at most max_per_host at a time for a given host (url root),
+		and results are written by the main thread, committed every commit_every writes
+
+		clone_mode is one of:
+		 - 'full': clone with checked out working tree (default)
+		 - 'bare': no working tree, the repo folder is the git directory
+		 - 'blobless': bare partial clone without file contents (git clone --filter=blob:none, needs the git executable);
+		   commits are parsed without insertions/deletions, as libgit2 cannot fetch missing blobs
+		Submodules and LFS files are never fetched.
+		In bare modes, fetches update local branches directly (refspec +refs/heads/*:refs/heads/*).
+
+		with use_alternates, forks (according to the forks table) are cloned with git clone --reference-if-able,
+		borrowing the objects of the most upstream fork ancestor already cloned (git alternates), so that only divergent objects are fetched.
+		Repos of the network are cloned roots first. Alternates are absolute paths: such clones depend on their ancestor's clone,
+		and moving data_folder breaks them.
+
+		with update, repos are fetched by decreasing priority (see update_priority), so that with a time_budget (in seconds,
+		after which no new clone or fetch is started) the most stale and active repos are kept current.
+
+		Failed clones and fetches are recorded in clone_failures, as permanent (see permanent_errors) or transient (timeouts, server errors...).
+		with failed, repos with transient failures are retried only retry_delay*2**(attempts-1) seconds (at most max_retry_delay) after their last attempt,
+		and repos with a permanent failure only max_retry_delay seconds after it. A success clears the failures.
 		'''
+		if clone_mode not in ('full','bare','blobless'):
+			raise ValueError('Unknown clone_mode: {}, expected full, bare or blobless'.format(clone_mode))
+		self.clone_mode = clone_mode
+		self.use_alternates = use_alternates
+		self.time_budget = time_budget
+		self.start_time = None
+		self.retry_delay = retry_delay
+		self.max_retry_delay = max_retry_delay
+		self.clone_errors = {}
+		self.fork_ancestors = {}
+		self.in_progress = set()
 		self.force = force
 		self.update = update
 		self.failed = failed
 		self.rm_first = rm_first
+		self.workers = workers
+		self.max_per_host = max_per_host
+		self.commit_every = commit_every
+		self.host_semaphores = {}
+		self.host_semaphores_lock = threading.Lock()
 
 		self.ssh_key = ssh_key
 		if ssh_sources is None:
@@ -296,16 +461,171 @@ class ClonesFiller(fillers.Filler):
 		if self.force or self.update:
 			option = 'all'
 		elif self.failed:
-			option = 'only_not_cloned'
+			option = 'retry_failed'
 		else:
 			option = 'no_dl'
 
-		repo_list = self.db.get_repo_list(option=option)
+		self.start_time = time.time()
+		if self.update:
+			repo_list = [(r['source'],r['source_urlroot'],r['owner'],r['name']) for r in sorted(self.db.get_repo_list(option='updateinfo'),key=self.update_priority,reverse=True)]
+		else:
+			repo_list = self.db.get_repo_list(option=option)
+		if self.use_alternates:
+			self.load_fork_ancestors()
+			# roots of fork networks first, so that they can be referenced by their forks
+			repo_list = sorted(repo_list,key=lambda r:len(self.fork_ancestors.get((r[0],r[2],r[3]),[])))
+		if self.workers > 1:
+			self.clone_all_parallel(repo_list=repo_list)
+			return
 		for i,r in enumerate(repo_list):
+			if self.budget_exceeded():
+				self.logger.info('Time budget exceeded, skipping {} repos'.format(len(repo_list)-i))
+				break
 			source,source_urlroot,owner,name = r
 			self.logger.info('Repo {}/{}'.format(i+1,len(repo_list)))
 			self.clone(source=source,name=name,owner=owner,source_urlroot=source_urlroot,update=self.update)
 
+	def budget_exceeded(self):
+		return self.time_budget is not None and time.time()-self.start_time >= self.time_budget
+
+	def update_priority(self,repo_info,min_activity=1./365):
+		'''
+		Priority of a repo for updates, from a dict of the 'updateinfo' repo list (ages in seconds, recent stars):
+		roughly the number of changes expected since the last successful fetch, i.e. staleness (in days) times an activity rate.
+		The activity rate is 1/(1+days since the latest commit) plus the number of stars in the last 30 days divided by 30,
+		and at least min_activity so that dormant repos are eventually fetched. Repos never fetched come first.
+		'''
+		if repo_info['fetch_age'] is None:
+			return float('inf')
+		staleness = max(float(repo_info['fetch_age']),0.)/86400
+		if repo_info['commit_age'] is None:
+			activity = 0.
+		else:
+			activity = 1./(1.+max(float(repo_info['commit_age']),0.)/86400)
+		activity += (repo_info['recent_stars'] or 0)/30.
+		return staleness*max(activity,min_activity)
+
+	def clone_all_parallel(self,repo_list):
+		'''
+		Same as the loop of clone_all, with the network part (clone_worker) run in self.workers threads.
+		Results are collected on the main thread, which does all database writes in a batch.
+
+		with use_alternates, a fork to be cloned whose fork ancestor is also in repo_list is submitted once the job of this ancestor is done,
+		so that it can borrow its objects.
+		'''
+		source_urlroots = {(source,owner,name):source_urlroot for source,source_urlroot,owner,name in repo_list}
+		# repos being cloned cannot be used as alternates
+		self.in_progress = set(source_urlroots)
+		waiting = {}
+		ready = []
+		for source,source_urlroot,owner,name in repo_list:
+			ancestor = self.blocking_ancestor(source=source,owner=owner,name=name,run_repos=source_urlroots)
+			if ancestor is None:
+				ready.append((source,owner,name))
+			else:
+				waiting.setdefault(ancestor,[]).append((source,owner,name))
+		with futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+			jobs = {}
+			def submit(source,owner,name):
+				jobs[executor.submit(self.clone_worker,source=source,name=name,owner=owner,source_urlroot=source_urlroots[(source,owner,name)],update=self.update)] = (source,owner,name)
+			for r in ready:
+				submit(*r)
+			nb_done = 0
+			with self.db.batch(commit_every=self.commit_every):
+				while jobs:
+					finished,_ = futures.wait(jobs,return_when=futures.FIRST_COMPLETED)
+					for job in finished:
+						source,owner,name = jobs.pop(job)
+						nb_done += 1
+						self.logger.info('Repo {}/{}'.format(nb_done,len(repo_list)))
+						action,success = job.result()
+						self.in_progress.discard((source,owner,name))
+						for r in waiting.pop((source,owner,name),[]):
+							submit(*r)
+						self.submit_result(action=action,success=success,source=source,owner=owner,name=name)
+
+	def blocking_ancestor(self,source,owner,name,run_repos):
+		'''
+		Most upstream fork ancestor of a repo to be cloned that is also in run_repos, whose job has to be done before cloning the repo with alternates.
+		None without use_alternates, if the repo is already cloned, or if a more upstream ancestor is already cloned outside of the run.
+		'''
+		if not self.use_alternates or os.path.exists(os.path.join(self.data_folder,'cloned_repos',source,owner,name)):
+			return None
+		for ancestor in self.fork_ancestors.get((source,owner,name),[]):
+			if ancestor in run_repos:
+				return ancestor
+			if os.path.exists(os.path.join(self.data_folder,'cloned_repos',*ancestor)):
+				return None
+		return None
+
+	def submit_result(self,action,success,source,owner,name):
+		'''
+		Database writes for the result of clone_worker
+		'''
+		if action == 'skipped':
+			return
+		elif action == 'exists':
+			repo_id = self.db.get_repo_id(source=source,name=name,owner=owner)
+			self.set_init_dl(repo_id=repo_id,source=source,repo=name,owner=owner)
+			self.db.set_cloned(repo_id=repo_id)
+		else:
+			self.submit_attempt(success=success,source=source,name=name,owner=owner)
+
+	def load_fork_ancestors(self):
+		'''
+		Loads from the forks table {(source,owner,name):[(source,owner,name) of fork ancestors, most upstream first]}
+		'''
+		self.db.cursor.execute('''
+			SELECT s1.name,r1.owner,r1.name,s2.name,r2.owner,r2.name
+			FROM forks f
+			INNER JOIN repositories r1 ON r1.id=f.forking_repo_id
+			INNER JOIN sources s1 ON s1.id=r1.source
+			INNER JOIN repositories r2 ON r2.id=f.forked_repo_id
+			INNER JOIN sources s2 ON s2.id=r2.source
+			ORDER BY f.fork_rank DESC
+			;''')
+		self.fork_ancestors = {}
+		for source,owner,name,anc_source,anc_owner,anc_name in self.db.cursor.fetchall():
+			self.fork_ancestors.setdefault((source,owner,name),[]).append((anc_source,anc_owner,anc_name))
+
+	def fork_reference(self,source,owner,name):
+		'''
+		Folder of the most upstream fork ancestor of the repo that is cloned (and not being cloned), None if there is none
+		'''
+		for anc_source,anc_owner,anc_name in self.fork_ancestors.get((source,owner,name),[]):
+			anc_folder = os.path.join(self.data_folder,'cloned_repos',anc_source,anc_owner,anc_name)
+			if (anc_source,anc_owner,anc_name) not in self.in_progress and os.path.exists(anc_folder):
+				return anc_folder
+		return None
+
+	def host_semaphore(self,source_urlroot):
+		'''
+		Semaphore limiting concurrent network operations on a given host to max_per_host
+		'''
+		with self.host_semaphores_lock:
+			if source_urlroot not in self.host_semaphores:
+				self.host_semaphores[source_urlroot] = threading.Semaphore(self.max_per_host)
+			return self.host_semaphores[source_urlroot]
+
+	def clone_worker(self,source,name,owner,source_urlroot,update=False):
+		'''
+		Network part of clone/update_repo, without database access, run in worker threads.
+		Returns (action,success), action being 'exists' (folder already present, nothing done), 'cloned', 'updated' or 'skipped' (time budget exceeded).
+		'''
+		if self.budget_exceeded():
+			return 'skipped',None
+		repo_folder = os.path.join(self.data_folder,'cloned_repos',source,owner,name)
+		if os.path.exists(repo_folder) and not update:
+			self.logger.info('Repo {}/{}/{} already exists'.format(source,owner,name))
+			return 'exists',True
+		with self.host_semaphore(source_urlroot):
+			if os.path.exists(repo_folder):
+				self.logger.info('Updating repo {}/{}/{}'.format(source,owner,name))
+				return 'updated',self.git_fetch(source=source,name=name,owner=owner)
+			else:
+				self.logger.info('Cloning repo {}/{}/{}'.format(source,owner,name))
+				return 'cloned',self.git_clone(source=source,name=name,owner=owner,source_urlroot=source_urlroot)
+
 
 	def build_url(self,name,owner,source_urlroot,ssh_mode):
 		'''
@@ -355,43 +675,127 @@ class ClonesFiller(fillers.Filler):
 
 			# if (self.db.cursor.fetchone() is None) or force:
 			self.logger.info('Cloning repo {}/{}/{}'.format(source,owner,name))
-			try:
-				try:
-					callbacks = self.callbacks[source]
-					ssh_mode = True
-				except KeyError:
-					callbacks = None
-					ssh_mode = False
-				pygit2.clone_repository(url=self.build_url(source_urlroot=source_urlroot,name=name,owner=owner,ssh_mode=ssh_mode),path=repo_folder,callbacks=callbacks)
-				success = True
-			except pygit2.GitError as e:
-				self.logger.info('Git Error for repo {}/{}/{}'.format(source,owner,name))
-				success = False
-			self.db.submit_download_attempt(success=success,source=source,repo=name,owner=owner)
+			success = self.git_clone(source=source,name=name,owner=owner,source_urlroot=source_urlroot)
+			self.submit_attempt(success=success,source=source,name=name,owner=owner)
 			# else:
 			# 	self.logger.info('Skipping repo {}/{}/{}, already failed to download'.format(source,owner,name))
 
-	def update_repo(self,name,source,source_urlroot,owner):
+	def git_clone(self,source,name,owner,source_urlroot):
 		'''
-		git fetch on repo
-		cloning if folder not existing
+		Clones the repo in its folder, returns True if successful
 		'''
-		self.logger.info('Updating repo {}/{}/{}'.format(source,owner,name))
 		repo_folder = os.path.join(self.data_folder,'cloned_repos',source,owner,name)
+		try:
+			try:
+				callbacks = self.callbacks[source]
+				ssh_mode = True
+			except KeyError:
+				callbacks = None
+				ssh_mode = False
+			url = self.build_url(source_urlroot=source_urlroot,name=name,owner=owner,ssh_mode=ssh_mode)
+			reference = self.fork_reference(source=source,owner=owner,name=name) if self.use_alternates else None
+			if self.clone_mode == 'blobless' or reference is not None:
+				args = ['clone','--quiet','--no-recurse-submodules']
+				if self.clone_mode != 'full':
+					args.append('--bare')
+				if self.clone_mode == 'blobless':
+					args.append('--filter=blob:none')
+				if reference is not None:
+					self.logger.info('Using objects of {} for repo {}/{}/{}'.format(reference,source,owner,name))
+					args += ['--reference-if-able',reference]
+				self.run_git(*args,url,repo_folder,source=source)
+			else:
+				pygit2.clone_repository(url=url,path=repo_folder,callbacks=callbacks,bare=(self.clone_mode == 'bare'))
+			if self.clone_mode != 'full':
+				pygit2.Repository(repo_folder).config['remote.origin.fetch'] = '+refs/heads/*:refs/heads/*'
+			return True
+		except (pygit2.GitError,subprocess.CalledProcessError) as e:
+			self.logger.info('Git Error for repo {}/{}/{}'.format(source,owner,name))
+			self.clone_errors[(source,owner,name)] = self.error_message(e)
+			return False
+
+	def run_git(self,*args,source=None):
+		'''
+		Runs the git executable, with the SSH key of source if in ssh_sources, without prompts, LFS downloads or submodules
+		'''
+		env = dict(os.environ,GIT_TERMINAL_PROMPT='0',GIT_LFS_SKIP_SMUDGE='1')
+		if source in self.ssh_sources:
+			env['GIT_SSH_COMMAND'] = 'ssh -i {} -o IdentitiesOnly=yes'.format(self.ssh_sources[source])
+		subprocess.run(['git',*args],env=env,check=True,stdout=subprocess.DEVNULL,stderr=subprocess.PIPE)
 
-		repo_obj = pygit2.Repository(os.path.join(repo_folder,'.git'))
+	def is_partial_clone(self,repo_folder):
+		'''
+		True if the repo was cloned with a filter (e.g. blobless), whatever the current clone_mode
+		'''
+		try:
+			return pygit2.Repository(repo_folder).config.get_bool('remote.origin.promisor')
+		except KeyError:
+			return False
+
+	def git_fetch(self,source,name,owner):
+		'''
+		Fetches origin for an existing clone, returns True if successful
+		'''
+		repo_folder = os.path.join(self.data_folder,'cloned_repos',source,owner,name)
 		try:
+			if self.is_partial_clone(repo_folder):
+				# libgit2 does not handle partial clones, the filter is kept by git fetch
+				self.run_git('-C',repo_folder,'fetch','--quiet','--no-recurse-submodules','origin',source=source)
+				return True
+			repo_obj = pygit2.Repository(repo_folder)
 			try:
 				callbacks = self.callbacks[source]
 			except KeyError:
 				callbacks = None
 			repo_obj.remotes["origin"].fetch(callbacks=callbacks)
-			success = True
-		except pygit2.GitError as e:
+			return True
+		except (pygit2.GitError,subprocess.CalledProcessError) as e:
 			self.logger.info('Git Error for repo {}/{}/{}'.format(source,owner,name))
-			success = False
+			self.clone_errors[(source,owner,name)] = self.error_message(e)
+			return False
 
+	def update_repo(self,name,source,source_urlroot,owner):
+		'''
+		git fetch on repo
+		cloning if folder not existing
+		'''
+		self.logger.info('Updating repo {}/{}/{}'.format(source,owner,name))
+		success = self.git_fetch(source=source,name=name,owner=owner)
+
+		self.submit_attempt(success=success,source=source,name=name,owner=owner)
+
+	def submit_attempt(self,source,name,owner,success):
+		'''
+		Records a clone or fetch attempt, and for failures the error (set by git_clone/git_fetch) and its classification
+		'''
 		self.db.submit_download_attempt(success=success,source=source,repo=name,owner=owner)
+		repo_id = self.db.get_repo_id(source=source,name=name,owner=owner)
+		error = self.clone_errors.pop((source,owner,name),None)
+		if success:
+			self.db.clear_clone_failure(repo_id=repo_id)
+		else:
+			permanent = self.is_permanent_error(error,source=source)
+			attempts = self.db.record_clone_failure(repo_id=repo_id,permanent=permanent,error=error,retry_delay=self.retry_delay,max_retry_delay=self.max_retry_delay)
+			self.logger.info('{} failure for repo {}/{}/{} (attempt {}): {}'.format('Permanent' if permanent else 'Transient',source,owner,name,attempts,error))
+
+	def is_permanent_error(self,error,source=None):
+		'''
+		True if the git error message means that the repo is gone; unknown errors, and authentication errors for sources in ssh_sources, are considered transient
+		'''
+		if error is None:
+			return False
+		error = error.lower()
+		if source not in self.ssh_sources and any(e in error for e in self.auth_errors):
+			return True
+		return any(e in error for e in self.permanent_errors)
+
+	def error_message(self,error):
+		'''
+		Message of a pygit2.GitError or of a failed git command (its stderr)
+		'''
+		if isinstance(error,subprocess.CalledProcessError) and error.stderr:
+			return error.stderr.decode('utf-8',errors='replace').strip()
+		return str(error)
 
 	def get_repo(self,name,source,owner):
 		'''
@@ -401,4 +805,196 @@ class ClonesFiller(fillers.Filler):
 		if not os.path.exists(repo_folder):
 			raise ValueError('Repository {}/{}/{} not found in cloned_repos folder'.format(source,owner,name))
 		else:
-			return pygit2.Repository(os.path.join(repo_folder,'.git'))
+			# opens both clones with working tree and bare clones
+			return pygit2.Repository(repo_folder)
+
+class ClonesQuotaFiller(fillers.Filler):
+	'''
+	Keeps the size of cloned_repos under quota (in bytes), removing least recently used clones.
+	Last access is the latest clone/fetch or commits ingestion (table_updates), size is the disk usage of the repo folder.
+
+	Only clones whose commits were filled after their last clone/fetch are removed, and never clones used as alternates by other clones (see ClonesFiller use_alternates).
+	Removed repos are set as not cloned in repositories: they are cloned again by ClonesFiller with failed=True or update=True.
+	'''
+	requires = ('clones','commits')
+	provides = ('clones',)
+
+	def __init__(self,quota,**kwargs):
+		self.quota = quota
+		fillers.Filler.__init__(self,**kwargs)
+
+	def prepare(self):
+		if self.data_folder is None:
+			self.data_folder = self.db.data_folder
+
+	def apply(self):
+		self.enforce_quota()
+
+	def repo_folder(self,source,owner,name):
+		return os.path.join(self.data_folder,'cloned_repos',source,owner,name)
+
+	def folder_size(self,folder):
+		'''
+		Disk usage of a folder in bytes, without following symlinks
+		'''
+		size = 0
+		for root,dirs,files in os.walk(folder):
+			for f in files:
+				try:
+					size += os.lstat(os.path.join(root,f)).st_blocks*512
+				except FileNotFoundError:
+					pass
+		return size
+
+	def alternates_references(self,folders):
+		'''
+		Set of the real paths of object folders used as alternates by clones in folders
+		'''
+		ans = set()
+		for folder in folders:
+			for git_dir in (os.path.join(folder,'.git'),folder):
+				alternates_file = os.path.join(git_dir,'objects','info','alternates')
+				if os.path.exists(alternates_file):
+					with open(alternates_file,'r') as f:
+						for line in f.read().splitlines():
+							if line.strip() and not line.startswith('#'):
+								ans.add(os.path.realpath(os.path.join(git_dir,'objects',line.strip())))
+					break
+		return ans
+
+	def enforce_quota(self):
+		'''
+		Removes clones until the total size is at most quota, returns the number of removed clones
+		'''
+		usage = [r for r in self.db.get_repo_list(option='clone_usage') if os.path.exists(self.repo_folder(r['source'],r['owner'],r['name']))]
+		for r in usage:
+			r['size'] = self.folder_size(self.repo_folder(r['source'],r['owner'],r['name']))
+		total_size = sum(r['size'] for r in usage)
+		self.logger.info('Clones use {} bytes, quota {} bytes'.format(total_size,self.quota))
+		if total_size <= self.quota:
+			return 0
+		referenced = self.alternates_references([self.repo_folder(r['source'],r['owner'],r['name']) for r in usage])
+		candidates = []
+		for r in usage:
+			folder = self.repo_folder(r['source'],r['owner'],r['name'])
+			if not r['ingested']:
+				continue
+			if any(os.path.realpath(os.path.join(git_dir,'objects')) in referenced for git_dir in (os.path.join(folder,'.git'),folder)):
+				continue
+			candidates.append(r)
+		# never accessed first, then least recently used
+		candidates.sort(key=lambda r:(r['last_access'] is not None,r['last_access'] or 0))
+		removed = 0
+		for r in candidates:
+			if total_size <= self.quota:
+				break
+			self.logger.info('Removing clone {}/{}/{} ({} bytes)'.format(r['source'],r['owner'],r['name'],r['size']))
+			# committed before removing the folder, also inside a batch: a repo set as cloned always has its folder
+			self.db.set_cloned(repo_id=r['repo_id'],cloned=False,autocommit=False)
+			self.db.commit(force=True)
+			shutil.rmtree(self.repo_folder(r['source'],r['owner'],r['name']))
+			total_size -= r['size']
+			removed += 1
+		if total_size > self.quota:
+			self.logger.warning('Clones still use {} bytes, above quota {} bytes: remaining clones are not ingested or used as alternates'.format(total_size,self.quota))
+		return removed
+
+class RepackFiller(fillers.Filler):
+	'''
+	Maintenance of cloned repos, which accumulate loose objects and small packs with fetches, slowing down walks and diffs:
+	repos with more than max_packs packs or max_loose loose objects are repacked into one pack (git repack -a -d -l, needs the git executable),
+	and their commit-graph file is written. Repos without commit-graph file only get it written.
+
+	Unreachable objects are kept (--keep-unreachable): clones may use them as alternates (see ClonesFiller use_alternates).
+	Repos are processed by workers threads, each git process using one thread, with idle I/O priority if idle_io and ionice is available.
+	'''
+	requires = ('clones',)
+	provides = ('clones',)
+
+	def __init__(self,max_packs=20,max_loose=1000,workers=1,idle_io=True,**kwargs):
+		self.max_packs = max_packs
+		self.max_loose = max_loose
+		self.workers = workers
+		self.idle_io = idle_io
+		fillers.Filler.__init__(self,**kwargs)
+
+	def prepare(self):
+		if self.data_folder is None:
+			self.data_folder = self.db.data_folder
+
+	def apply(self):
+		self.repack_all()
+
+	def git_dir(self,source,owner,name):
+		'''
+		git directory of a clone, with working tree (.git) or bare
+		'''
+		repo_folder = os.path.join(self.data_folder,'cloned_repos',source,owner,name)
+		if os.path.isdir(os.path.join(repo_folder,'.git')):
+			return os.path.join(repo_folder,'.git')
+		return repo_folder
+
+	def count_packs(self,git_dir):
+		pack_folder = os.path.join(git_dir,'objects','pack')
+		if not os.path.isdir(pack_folder):
+			return 0
+		return len([f for f in os.listdir(pack_folder) if f.endswith('.pack')])
+
+	def count_loose(self,git_dir):
+		ans = 0
+		objects_folder = os.path.join(git_dir,'objects')
+		for d in os.listdir(objects_folder):
+			if len(d) == 2 and os.path.isdir(os.path.join(objects_folder,d)):
+				ans += len(os.listdir(os.path.join(objects_folder,d)))
+		return ans
+
+	def has_commit_graph(self,git_dir):
+		return os.path.exists(os.path.join(git_dir,'objects','info','commit-graph')) or os.path.exists(os.path.join(git_dir,'objects','info','commit-graphs','commit-graph-chain'))
+
+	def run_git(self,git_dir,*args):
+		cmd = ['git','-C',git_dir,'-c','pack.threads=1',*args]
+		if self.idle_io and shutil.which('ionice') is not None:
+			cmd = ['ionice','-c','3',*cmd]
+		subprocess.run(cmd,check=True,stdout=subprocess.DEVNULL,stderr=subprocess.PIPE)
+
+	def repack(self,source,owner,name):
+		'''
+		Repacks one repo if needed, without database access, run in worker threads.
+		Returns (action,success), action being 'repacked', 'commit_graph' (only the commit-graph file written) or 'skipped'.
+		'''
+		git_dir = self.git_dir(source=source,owner=owner,name=name)
+		if not os.path.isdir(os.path.join(git_dir,'objects')):
+			return 'skipped',None
+		if self.count_packs(git_dir) > self.max_packs or self.count_loose(git_dir) > self.max_loose:
+			action = 'repacked'
+		elif not self.has_commit_graph(git_dir):
+			action = 'commit_graph'
+		else:
+			return 'skipped',None
+		try:
+			if action == 'repacked':
+				self.logger.info('Repacking repo {}/{}/{}'.format(source,owner,name))
+				self.run_git(git_dir,'repack','-a','-d','-l','-q','--keep-unreachable')
+			self.run_git(git_dir,'commit-graph','write','--reachable','--no-progress')
+			return action,True
+		except subprocess.CalledProcessError as e:
+			self.logger.info('Git Error for repo {}/{}/{}: {}'.format(source,owner,name,e.stderr.decode('utf-8',errors='replace').strip()))
+			return action,False
+
+	def repack_all(self):
+		'''
+		Repacks cloned repos, repacks are recorded in table_updates (table 'repack'). Returns the number of repacked repos.
+		'''
+		repo_list = self.db.get_repo_list(option='basicinfo_dict_cloned')
+		repacked = 0
+		with futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+			jobs = {executor.submit(self.repack,source=r['source'],owner=r['owner'],name=r['name']):r for r in repo_list}
+			with self.db.batch():
+				for job in futures.as_completed(jobs):
+					action,success = job.result()
+					if action == 'repacked':
+						self.db.insert_update(table='repack',repo_id=jobs[job]['repo_id'],success=success)
+						if success:
+							repacked += 1
+		self.logger.info('Repacked {} repos'.format(repacked))
+		return repacked
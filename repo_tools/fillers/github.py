@@ -45,7 +45,7 @@ class GithubFiller(fillers.Filler):
 			self.db.cursor.execute(''' INSERT INTO identity_types(name) VALUES('github_login') ON CONFLICT DO NOTHING;''')
 		else:
 			self.db.cursor.execute(''' INSERT OR IGNORE INTO identity_types(name) VALUES('github_login');''')
-		self.db.connection.commit()
+		self.db.commit()
 
 	def set_github_requesters(self):
 		'''
@@ -101,6 +101,9 @@ class StarsFiller(GithubFiller):
 	"""
 	Fills in star information
 	"""
+	requires = ('repositories',)
+	provides = ('stars',)
+
 	def __init__(self,force=False,retry=False,repo_list=None,**kwargs):
 		self.force = force
 		self.retry = retry
@@ -110,7 +113,7 @@ class StarsFiller(GithubFiller):
 
 	def apply(self):
 		self.fill_stars(force=self.force,retry=self.retry,repo_list=self.repo_list,workers=self.workers)
-		self.db.connection.commit()
+		self.db.commit()
 
 	def fill_stars(self,force=False,retry=False,repo_list=None,workers=1,in_thread=False):
 		'''
@@ -179,7 +182,7 @@ class StarsFiller(GithubFiller):
 						else:
 							self.logger.info('Filled stars for repo {}/{}: {}'.format(owner,repo_name,nb_stars))
 							db.insert_update(repo_id=repo_id,table='stars',success=True)
-							db.connection.commit()
+							db.commit()
 							repo_list.pop(0)
 							new_repo = True
 							break
@@ -205,35 +208,39 @@ class StarsFiller(GithubFiller):
 		'''
 		if db is None:
 			db = self.db
+		gh_type_id = db.get_identity_type_id(identity_type='github_login')
 		if db.db_type == 'postgres':
 			extras.execute_batch(db.cursor,'''
 				INSERT INTO stars(starred_at,login,repo_id,identity_type_id,identity_id)
 				VALUES(%s,
 						%s,
 						%s,
-						(SELECT id FROM identity_types WHERE name='github_login'),
-						(SELECT id FROM identities WHERE identity=%s AND identity_type_id=(SELECT id FROM identity_types WHERE name='github_login'))
+						%s,
+						(SELECT id FROM identities WHERE identity=%s AND identity_type_id=%s)
 					)
 				ON CONFLICT DO NOTHING
-				;''',((s['starred_at'],s['login'],s['repo_id'],s['login']) for s in stars_list))
+				;''',((s['starred_at'],s['login'],s['repo_id'],gh_type_id,s['login'],gh_type_id) for s in stars_list))
 		else:
 			db.cursor.executemany('''
 					INSERT OR IGNORE INTO stars(starred_at,login,repo_id,identity_type_id,identity_id)
 					VALUES(?,
 							?,
 							?,
-							(SELECT id FROM identity_types WHERE name='github_login'),
-							(SELECT id FROM identities WHERE identity=? AND identity_type_id=(SELECT id FROM identity_types WHERE name='github_login'))
-						);''',((s['starred_at'],s['login'],s['repo_id'],s['login']) for s in stars_list))
+							?,
+							(SELECT id FROM identities WHERE identity=? AND identity_type_id=?)
+						);''',((s['starred_at'],s['login'],s['repo_id'],gh_type_id,s['login'],gh_type_id) for s in stars_list))
 
 		if commit:
-			db.connection.commit()
+			db.commit()
 
 
 class GHLoginsFiller(GithubFiller):
 	"""
 	Fills in github login information
 	"""
+	requires = ('identities','commits')
+	provides = ('identities','users')
+
 	def __init__(self,force=False,info_list=None,**kwargs):
 		self.force = force
 		self.info_list = info_list
@@ -243,7 +250,7 @@ class GHLoginsFiller(GithubFiller):
 
 	def apply(self):
 		self.fill_gh_logins(info_list=self.info_list)
-		self.db.connection.commit()
+		self.db.commit()
 
 	def prepare(self):
 		GithubFiller.prepare(self)
@@ -251,31 +258,31 @@ class GHLoginsFiller(GithubFiller):
 
 			if self.force:
 				if self.db.db_type == 'postgres':
-					self.db.cursor.execute('''
+					query = '''
 						SELECT i.id,c.repo_id,r.owner,r.name,c.sha
 						FROM identities i
 						JOIN LATERAL (SELECT cc.sha,cc.repo_id FROM commits cc
 							WHERE cc.author_id=i.id ORDER BY cc.created_at DESC LIMIT 1) AS c
-						ON (SELECT i2.id FROM identities i2 WHERE i2.user_id=i.user_id AND i2.identity_type_id=(SELECT it.id FROM identity_types WHERE name='github_login')) IS NULL
+						ON (SELECT i2.id FROM identities i2 WHERE i2.user_id=i.user_id AND i2.identity_type_id=(SELECT it.id FROM identity_types it WHERE it.name='github_login')) IS NULL
 						INNER JOIN repositories r
 						ON r.id=c.repo_id
-						;''')
+						;'''
 				else:
-					self.db.cursor.execute('''
-						SELECT u.id,c.repo_id,r.owner,r.name,c.sha
+					query = '''
+						SELECT i.id,c.repo_id,r.owner,r.name,c.sha
 						FROM identities i
 						JOIN commits c
-							ON (SELECT i2.id FROM identities i2 WHERE i2.user_id=i.user_id AND i2.identity_type_id=(SELECT it.id FROM identity_types WHERE name='github_login')) IS NULL AND
+							ON (SELECT i2.id FROM identities i2 WHERE i2.user_id=i.user_id AND i2.identity_type_id=(SELECT it.id FROM identity_types it WHERE it.name='github_login')) IS NULL AND
 							c.id IN (SELECT cc.id FROM commits cc
 								WHERE cc.author_id=i.id ORDER BY cc.created_at DESC LIMIT 1)
 						INNER JOIN repositories r
 						ON r.id=c.repo_id
-						;''')
+						;'''
 
 
 			else:
 				if self.db.db_type == 'postgres':
-					self.db.cursor.execute('''
+					query = '''
 						SELECT i.id,c.repo_id,r.owner,r.name,c.sha
 						FROM (
 							SELECT ii.id FROM
@@ -283,8 +290,8 @@ class GHLoginsFiller(GithubFiller):
 								WHERE (SELECT iiii.id FROM identities iiii
 									INNER JOIN identity_types iiiit
 									ON iiii.user_id=iii.user_id AND iiiit.id=iiii.identity_type_id AND iiiit.name='github_login') IS NULL) AS ii
-								LEFT JOIN table_updates tu
-								ON tu.identity_id=ii.id AND tu.table_name='login'
+								LEFT JOIN table_updates_latest tu
+								ON tu.identity_id=ii.id AND tu.repo_id IS NULL AND tu.table_name='login'
 								GROUP BY ii.id,tu.identity_id
 								HAVING tu.identity_id IS NULL
 							) AS i
@@ -293,9 +300,9 @@ class GHLoginsFiller(GithubFiller):
 						ON true
 						INNER JOIN repositories r
 						ON r.id=c.repo_id
-						;''')
+						;'''
 				else:
-					self.db.cursor.execute('''
+					query = '''
 						SELECT i.id,c.repo_id,r.owner,r.name,c.sha
 						FROM (
 							SELECT ii.id FROM
@@ -303,8 +310,8 @@ class GHLoginsFiller(GithubFiller):
 								WHERE (SELECT iiii.id FROM identities iiii
 									INNER JOIN identity_types iiiit
 									ON iiii.user_id=iii.user_id AND iiiit.id=iiii.identity_type_id AND iiiit.name='github_login') IS NULL) AS ii
-								LEFT JOIN table_updates tu
-								ON tu.identity_id=ii.id AND tu.table_name='login'
+								LEFT JOIN table_updates_latest tu
+								ON tu.identity_id=ii.id AND tu.repo_id IS NULL AND tu.table_name='login'
 								GROUP BY ii.id,tu.identity_id
 								HAVING tu.identity_id IS NULL
 							) AS i
@@ -314,9 +321,9 @@ class GHLoginsFiller(GithubFiller):
 								WHERE cc.author_id=i.id ORDER BY cc.created_at DESC LIMIT 1)
 						INNER JOIN repositories r
 						ON r.id=c.repo_id
-						;''')
+						;'''
 
-			self.info_list = list(self.db.cursor.fetchall())
+			self.info_list = self.db.iter_query(query=query)
 
 	def fill_gh_logins(self,info_list=None,workers=1,in_thread=False):
 		'''
@@ -382,60 +389,58 @@ class GHLoginsFiller(GithubFiller):
 		'''
 		if db is None:
 			db = self.db
+		gh_type_id = db.get_identity_type_id(identity_type='github_login')
 		if db.db_type == 'postgres':
 			if login is not None:
 				db.cursor.execute(''' INSERT INTO users(creation_identity_type_id,creation_identity) VALUES(
-											(SELECT id FROM identity_types WHERE name='github_login'),
+											%s,
 											%s
-											) ON CONFLICT DO NOTHING;''',(login,))
+											) ON CONFLICT DO NOTHING;''',(gh_type_id,login,))
 
 				db.cursor.execute(''' INSERT INTO identities(identity_type_id,user_id,identity)
-												VALUES((SELECT id FROM identity_types WHERE name='github_login'),
+												VALUES(%s,
 														(SELECT id FROM users
-														WHERE creation_identity_type_id=(SELECT id FROM identity_types WHERE name='github_login')
+														WHERE creation_identity_type_id=%s
 															AND creation_identity=%s),
 														%s)
-												ON CONFLICT DO NOTHING;''',(login,login,))
+												ON CONFLICT DO NOTHING;''',(gh_type_id,gh_type_id,login,login,))
 
-				db.cursor.execute('''SELECT id FROM identities
-											WHERE identity_type_id=(SELECT id FROM identity_types WHERE name='github_login')
-											AND identity=%s;''',(login,))
-				identity2 = db.cursor.fetchone()[0]
+				identity2 = db.get_identity_id(identity=login,identity_type='github_login')
 				db.merge_identities(identity1=identity_id,identity2=identity2,autocommit=False,reason=reason)
-			db.cursor.execute('''INSERT INTO table_updates(identity_id,table_name,success) VALUES(%s,'login',%s);''',(identity_id,(login is not None)))
+			db.insert_update(identity_id=identity_id,table='login',success=(login is not None),autocommit=False)
 		else:
 			if login is not None:
 
 
 				db.cursor.execute(''' INSERT OR IGNORE INTO users(creation_identity_type_id,creation_identity) VALUES(
-											(SELECT id FROM identity_types WHERE name='github_login'),
+											?,
 											?
-											);''',(login,))
+											);''',(gh_type_id,login,))
 
 				db.cursor.execute(''' INSERT OR IGNORE INTO identities(identity_type_id,user_id,identity)
-												VALUES((SELECT id FROM identity_types WHERE name='github_login'),
+												VALUES(?,
 														(SELECT id FROM users
-														WHERE creation_identity_type_id=(SELECT id FROM identity_types WHERE name='github_login')
+														WHERE creation_identity_type_id=?
 															AND creation_identity=?),
-														?);''',(login,login,))
+														?);''',(gh_type_id,gh_type_id,login,login,))
 
-				db.cursor.execute('''SELECT id FROM identities
-											WHERE identity_type_id=(SELECT id FROM identity_types WHERE name='github_login')
-											AND identity=?;''',(login,))
-				identity2 = db.cursor.fetchone()[0]
+				identity2 = db.get_identity_id(identity=login,identity_type='github_login')
 
 
 				db.merge_identities(identity1=identity_id,identity2=identity2,autocommit=False,reason=reason)
 
-			db.cursor.execute('''INSERT INTO table_updates(identity_id,table_name,success) VALUES(?,'login',?);''',(identity_id,(login is not None)))
+			db.insert_update(identity_id=identity_id,table='login',success=(login is not None),autocommit=False)
 		if autocommit:
-			db.connection.commit()
+			db.commit()
 
 
 class ForksFiller(GithubFiller):
 	"""
 	Fills in forks info for github repositories
 	"""
+	requires = ('repositories',)
+	provides = ('forks',)
+
 	def __init__(self,force=False,repo_list=None,**kwargs):
 		self.force = force
 		self.repo_list = repo_list
@@ -446,7 +451,7 @@ class ForksFiller(GithubFiller):
 	def apply(self):
 		self.fill_forks(repo_list=self.repo_list,force=self.force)
 		self.fill_fork_ranks()
-		self.db.connection.commit()
+		self.db.commit()
 
 
 	def fill_forks(self,repo_list=None,force=False,workers=1,in_thread=False):
@@ -505,6 +510,7 @@ class ForksFiller(GithubFiller):
 						# sg_list = list(repo_apiobj.get_stargazers_with_dates()[nb_stars:nb_stars+per_page])
 						sg_list = list(repo_apiobj.get_forks().get_page(int(nb_forks/self.per_page)))
 						forks_list=[{'repo_id':repo_id,'source':source,'repo':repo_name,'owner':owner,'repo_fullname':sg.full_name,'created_at':sg.created_at} for sg in sg_list]
+						source_id = db.get_source_id(source=source)
 
 						if nb_forks < self.per_page*(int(nb_forks/self.per_page))+len(sg_list):
 							# if in_thread:
@@ -514,29 +520,27 @@ class ForksFiller(GithubFiller):
 								extras.execute_batch(db.cursor,'''
 									INSERT INTO forks(forking_repo_id,forked_repo_id,forking_repo_url,forked_at)
 									VALUES((SELECT r.id FROM repositories r
-												INNER JOIN sources s
-												ON s.name=%s AND s.id=r.source AND CONCAT(r.owner,'/',r.name)=%s),
+												WHERE r.source=%s AND r.owner=%s AND r.name=%s),
 											%s,
 											%s,
 											%s)
 									ON CONFLICT DO NOTHING
-									;''',((s['source'],s['repo_fullname'],s['repo_id'],'github.com/'+s['repo_fullname'],s['created_at']) for s in forks_list))
+									;''',((source_id,*s['repo_fullname'].split('/',1),s['repo_id'],'github.com/'+s['repo_fullname'],s['created_at']) for s in forks_list))
 							else:
 								db.cursor.executemany('''
 									INSERT OR IGNORE INTO forks(forking_repo_id,forked_repo_id,forking_repo_url,forked_at)
 									VALUES((SELECT r.id FROM repositories r
-												INNER JOIN sources s
-												ON s.name=? AND s.id=r.source AND r.owner || '/' || r.name =?),
+												WHERE r.source=? AND r.owner=? AND r.name=?),
 											?,
 											?,
 											?)
-									;''',((s['source'],s['repo_fullname'],s['repo_id'],'github.com/'+s['repo_fullname'],s['created_at']) for s in forks_list))
+									;''',((source_id,*s['repo_fullname'].split('/',1),s['repo_id'],'github.com/'+s['repo_fullname'],s['created_at']) for s in forks_list))
 
 							#db.insert_forks(,commit=False)
 						else:
 							self.logger.info('Filled forks for repo {}/{}: {}'.format(owner,repo_name,nb_forks))
 							db.insert_update(repo_id=repo_id,table='forks',success=True)
-							db.connection.commit()
+							db.commit()
 							repo_list.pop(0)
 							new_repo = True
 							break
@@ -587,6 +591,9 @@ class FollowersFiller(GithubFiller):
 	Fills in follower information
 	"""
 
+	requires = ('identities',)
+	provides = ('followers',)
+
 	def __init__(self,force=False,retry=False,login_list=None,**kwargs):
 		self.force = force
 		self.retry = retry
@@ -596,7 +603,7 @@ class FollowersFiller(GithubFiller):
 
 	def apply(self):
 		self.fill_followers(retry=self.retry,login_list=self.login_list,workers=self.workers)
-		self.db.connection.commit()
+		self.db.commit()
 
 
 	# def fill_followers(self,login_list=None,workers=1,in_thread=False,time_delay=24*3600):
@@ -651,13 +658,13 @@ class FollowersFiller(GithubFiller):
 		if self.login_list is None:
 			#build login list
 			if self.force:
-				self.db.cursor.execute('''
+				query = '''
 					SELECT i.id,i.identity,i.identity_type_id FROM identities i
 					INNER JOIN identity_types it
 					ON it.id=i.identity_type_id AND it.name='github_login';
-					''')
+					'''
 			else:
-				self.db.cursor.execute('''
+				query = '''
 					SELECT i.id,i.identity,i.identity_type_id FROM identities i
 					INNER JOIN identity_types it
 					ON it.id=i.identity_type_id AND it.name='github_login'
@@ -665,10 +672,10 @@ class FollowersFiller(GithubFiller):
 					SELECT i.id,i.identity,i.identity_type_id FROM identities i
 					INNER JOIN identity_types it
 					ON it.id=i.identity_type_id AND it.name='github_login'
-					INNER JOIN table_updates tu
-					ON tu.success AND tu.identity_id=i.id AND tu.table_name='followers';
-					''')
-			self.login_list = list(self.db.cursor.fetchall())
+					INNER JOIN table_updates_latest tu
+					ON tu.last_success_at IS NOT NULL AND tu.identity_id=i.id AND tu.repo_id IS NULL AND tu.table_name='followers';
+					'''
+			self.login_list = self.db.iter_query(query=query)
 
 	def fill_followers(self,retry=False,login_list=None,workers=1,in_thread=False):
 		'''
@@ -684,37 +691,33 @@ class FollowersFiller(GithubFiller):
 				db = self.db.copy()
 			else:
 				db = self.db
-			new_login = True
-			while len(login_list):
-				login_id,login,identity_type_id = login_list[0]
-
-				if new_login:
-					new_login = False
-					self.logger.info('Filling followers for login {}'.format(login))
-				requester = next(requester_gen)
-				try:
-					login_apiobj = requester.get_user('{}'.format(login))
-				except github.GithubException:
-					self.logger.info('No such login: {}'.format(login))
-					db.insert_update(identity_id=login_id,table='followers',success=False)
-					login_list.pop(0)
-					new_login = True
-				else:
-					while requester.get_rate_limit().core.remaining > self.querymin_threshold:
-						nb_followers = db.count_followers(login_id=login_id)
-						sg_list = list(login_apiobj.get_followers().get_page(int(nb_followers/self.per_page)))
-
-						if nb_followers < self.per_page*(int(nb_followers/self.per_page))+len(sg_list):
-							if db.db_type == 'sqlite' and in_thread:
-								time.sleep(1+random.random()) # to avoid database locked issues, and smooth a bit concurrency
-							self.insert_followers(db=db,followers_list=[{'login_id':login_id,'identity_type_id':identity_type_id,'login':login,'follower_login':sg.login} for sg in sg_list],commit=False)
-						else:
-							self.logger.info('Filled followers for login {}: {}'.format(login,nb_followers))
-							db.insert_update(identity_id=login_id,table='followers',success=True)
-							db.connection.commit()
-							login_list.pop(0)
-							new_login = True
-							break
+			for login_id,login,identity_type_id in login_list:
+				self.logger.info('Filling followers for login {}'.format(login))
+				login_done = False
+				# looping on requesters until the login is done, switching when the rate limit of the current one is reached
+				while not login_done:
+					requester = next(requester_gen)
+					try:
+						login_apiobj = requester.get_user('{}'.format(login))
+					except github.GithubException:
+						self.logger.info('No such login: {}'.format(login))
+						db.insert_update(identity_id=login_id,table='followers',success=False)
+						login_done = True
+					else:
+						while requester.get_rate_limit().core.remaining > self.querymin_threshold:
+							nb_followers = db.count_followers(login_id=login_id)
+							sg_list = list(login_apiobj.get_followers().get_page(int(nb_followers/self.per_page)))
+
+							if nb_followers < self.per_page*(int(nb_followers/self.per_page))+len(sg_list):
+								if db.db_type == 'sqlite' and in_thread:
+									time.sleep(1+random.random()) # to avoid database locked issues, and smooth a bit concurrency
+								self.insert_followers(db=db,followers_list=[{'login_id':login_id,'identity_type_id':identity_type_id,'login':login,'follower_login':sg.login} for sg in sg_list],commit=False)
+							else:
+								self.logger.info('Filled followers for login {}: {}'.format(login,nb_followers))
+								db.insert_update(identity_id=login_id,table='followers',success=True)
+								db.commit()
+								login_done = True
+								break
 			if in_thread:
 				db.cursor.close()
 				db.connection.close()
@@ -757,5 +760,5 @@ class FollowersFiller(GithubFiller):
 					)
 				;''',((f['identity_type_id'],f['follower_login'],f['follower_login'],f['identity_type_id'],f['login_id'],) for f in followers_list))
 		if commit:
-			db.connection.commit()
+			db.commit()
 
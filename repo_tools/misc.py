@@ -1,5 +1,7 @@
 import os
 import datetime
+import itertools
+import hashlib
 
 def get_packages_from_crates(conn,limit=None):
 	'''
@@ -27,3 +29,27 @@ def get_packages_from_crates(conn,limit=None):
 
 
 	return cursor.fetchall()
+
+
+
+def file_hash(filepath,block_size=2**20,algorithm='sha256'):
+	'''
+	hexdigest of a file (sha256 by default, any hashlib algorithm), read by blocks of block_size bytes so that memory stays bounded for large files
+	'''
+	h = hashlib.new(algorithm)
+	with open(filepath,'rb') as f:
+		for block in iter(lambda: f.read(block_size),b''):
+			h.update(block)
+	return h.hexdigest()
+
+def chunked(iterable,chunk_size):
+	'''
+	Yields lists of at most chunk_size consecutive elements of iterable, which can be a generator.
+	Used to process large inputs with bounded memory.
+	'''
+	iterator = iter(iterable)
+	while True:
+		chunk = list(itertools.islice(iterator,chunk_size))
+		if not chunk:
+			return
+		yield chunk
@@ -18,6 +18,7 @@ from concurrent.futures import ThreadPoolExecutor
 
 from .repo_database import Database
 from . import misc
+from .url_normalizer import UrlNormalizer
 
 logger = logging.getLogger(__name__)
 ch = logging.StreamHandler()
@@ -92,6 +93,123 @@ class RepoCrawler(object):
 		# 	if r_f not in self.repo_list:
 		# 		self.repo_list.append(r_f)
 
+	def bulk_add_list(self,repo_list,source,source_urlroot=None,cloned=False):
+		'''
+		Same as add_list, but registering URLs, repositories and initial download attempts with set-based statements, in one transaction
+		'''
+		if source_urlroot is None:
+			source_id,source_urlroot = self.db.get_source_info(source=source) # throws ValueError if source not registered
+		else:
+			self.db.register_source(source=source,source_urlroot=source_urlroot)
+			source_id = self.db.get_source_id(source=source)
+
+		url_list = []
+		repo_info_list = []
+		for r in repo_list:
+			clean_info = self.clean_url(r)
+			if clean_info is None:
+				continue
+			url_list.append((r,*clean_info))
+			cleaned_url,url_source_id = clean_info
+			if cleaned_url is None or url_source_id != source_id:
+				self.logger.info('Repo syntax error for {} {}, skipping'.format(r,source_urlroot))
+			else:
+				owner,repo = cleaned_url.split('/')[-2:]
+				repo_info_list.append((source_id,owner,repo,cleaned_url))
+
+		with self.db.batch():
+			self.db.register_urls(source=source,url_list=url_list)
+			self.db.register_repositories(repo_info_list=repo_info_list,cloned=cloned)
+			if cloned:
+				self.bulk_set_init_dl(source=source,repo_list=[(owner,repo) for _,owner,repo,_ in repo_info_list])
+
+	def bulk_set_init_dl(self,source,repo_list):
+		'''
+		Same as set_init_dl for a list of (owner,name) of a given source.
+		Repository ids and existing successful downloads are read in one query, and repositories already downloaded are not opened.
+		The time of the last commit of the others is read from their clone, and the download attempts are written with Database.submit_download_attempts.
+		'''
+		source_id = self.db.get_source_id(source=source)
+		if self.db.db_type == 'postgres':
+			self.db.cursor.execute('''
+				SELECT r.owner,r.name,r.id,tu.last_success_at IS NOT NULL FROM repositories r
+				LEFT JOIN table_updates_latest tu
+				ON tu.repo_id=r.id AND tu.identity_id IS NULL AND tu.table_name='clones'
+				WHERE r.source=%s
+				;''',(source_id,))
+		else:
+			self.db.cursor.execute('''
+				SELECT r.owner,r.name,r.id,tu.last_success_at IS NOT NULL FROM repositories r
+				LEFT JOIN table_updates_latest tu
+				ON tu.repo_id=r.id AND tu.identity_id IS NULL AND tu.table_name='clones'
+				WHERE r.source=?
+				;''',(source_id,))
+		repo_info = {(owner,name):(repo_id,bool(already_dl)) for owner,name,repo_id,already_dl in self.db.cursor.fetchall()}
+		attempt_list = []
+		for owner,repo in set(repo_list):
+			repo_id,already_dl = repo_info[(owner,repo)]
+			if not already_dl:
+				repo_obj = self.get_repo(source=source,owner=owner,name=repo)
+				last_commit_time = datetime.datetime.fromtimestamp(repo_obj.revparse_single('HEAD').commit_time)
+				attempt_list.append((repo_id,True,last_commit_time))
+		self.db.submit_download_attempts(attempt_list=attempt_list)
+
+	def scan_cloned_repos(self,clean=True,rename=True):
+		'''
+		Walks cloned_repos/<source>/<owner>/<repo> once with os.scandir, renaming folders with a .git extension and deleting empty folders on the way (see add_all_from_folder).
+		Returns a dict {source:[(owner,repo)]}
+		'''
+		ans = {}
+		nb_renamed = nb_cleaned = 0
+		root = os.path.join(self.folder,'cloned_repos')
+		for source_entry in list(os.scandir(root)):
+			if not source_entry.is_dir():
+				continue
+			source_repos = []
+			nb_owners = 0
+			for owner_entry in list(os.scandir(source_entry.path)):
+				if not owner_entry.is_dir():
+					continue
+				nb_repos = 0
+				for repo_entry in list(os.scandir(owner_entry.path)):
+					if not repo_entry.is_dir():
+						continue
+					repo_path = repo_entry.path
+					name = repo_entry.name
+					if rename and name.endswith('.git'):
+						name = name[:-4]
+						repo_path = os.path.join(owner_entry.path,name)
+						shutil.move(repo_entry.path,repo_path)
+						nb_renamed += 1
+					if clean and not any(True for _ in os.scandir(repo_path)):
+						shutil.rmtree(repo_path)
+						nb_cleaned += 1
+						continue
+					nb_repos += 1
+					source_repos.append((owner_entry.name,name))
+				if clean and nb_repos == 0 and not any(True for _ in os.scandir(owner_entry.path)):
+					shutil.rmtree(owner_entry.path)
+					nb_cleaned += 1
+					continue
+				nb_owners += 1
+			if clean and nb_owners == 0 and not any(True for _ in os.scandir(source_entry.path)):
+				shutil.rmtree(source_entry.path)
+				nb_cleaned += 1
+				continue
+			ans[source_entry.name] = source_repos
+		if nb_renamed or nb_cleaned:
+			self.logger.info('Renamed {} repository folders, cleaned {} empty folders'.format(nb_renamed,nb_cleaned))
+		return ans
+
+	def bulk_add_all_from_folder(self,clean=True,rename=True):
+		'''
+		Same as add_all_from_folder, scanning the folder tree once and registering repositories with bulk_add_list
+		'''
+		for source,repos in self.scan_cloned_repos(clean=clean,rename=rename).items():
+			source_id,source_urlroot = self.db.get_source_info(source=source)
+			self.bulk_add_list(repo_list=['/'.join([source_urlroot,owner,name]) for owner,name in repos],source=source,cloned=True)
+			self.logger.info('Found {} repositories for source {}'.format(len(repos),source))
+
 	# def set_db(self,db=None,db_folder=None,db_name='',db_user='postgres',db_host='localhost',db_type='sqlite',db_port=5432):
 	def set_db(self,db=None,**db_cfg):
 		'''
@@ -151,19 +269,13 @@ class RepoCrawler(object):
 		INTEGRATED TO FILLERS
 		getting a clean url based on what is available as sources, using source_urlroot values
 		returns clean_url,source_id
-		'''
-		if url is None:
-			return None
 
-		if not hasattr(self,'url_roots'):
-			self.db.cursor.execute('SELECT id,url_root FROM sources WHERE url_root IS NOT NULL;')
-			self.url_roots = list(self.db.cursor.fetchall())
-		for ur_id,ur in self.url_roots:
-			try:
-				return self.repo_formatting(repo=url,source_urlroot=ur,output_cleaned_url=True),ur_id
-			except RepoSyntaxError:
-				continue
-		return None,None
+		The normalizer is rebuilt when sources are registered through the database object.
+		'''
+		if getattr(self,'normalizer_version',None) != self.db.sources_version:
+			self.normalizer = UrlNormalizer.from_db(self.db)
+			self.normalizer_version = self.db.sources_version
+		return self.normalizer.normalize(url)
 
 	def list_missing_repos(self):
 		'''
@@ -355,7 +467,7 @@ class RepoCrawler(object):
 		self.logger.info('Updating repo {}/{}/{}'.format(source,owner,name))
 		repo_folder = os.path.join(self.folder,'cloned_repos',source,owner,name)
 
-		repo_obj = pygit2.Repository(os.path.join(repo_folder,'.git'))
+		repo_obj = pygit2.Repository(repo_folder)
 		try:
 			repo_obj.remotes["origin"].fetch(callbacks=self.callbacks)
 			success = True
@@ -373,7 +485,7 @@ class RepoCrawler(object):
 		if not os.path.exists(repo_folder):
 			raise ValueError('Repository {}/{}/{} not found in cloned_repos folder'.format(source,owner,name))
 		else:
-			return pygit2.Repository(os.path.join(repo_folder,'.git'))
+			return pygit2.Repository(repo_folder)
 
 
 	def list_commits(self,name,source,owner,basic_info_only=False,repo_id=None,after_time=None):
@@ -436,7 +548,7 @@ class RepoCrawler(object):
 		self.db.cursor.execute('''SELECT MAX(updated_at) FROM full_updates WHERE update_type='commits';''')
 		last_fu = self.db.cursor.fetchone()[0]
 
-		self.db.cursor.execute('''SELECT MAX(updated_at) FROM table_updates WHERE table_name='clones' AND success;''')
+		self.db.cursor.execute('''SELECT MAX(last_success_at) FROM table_updates_latest WHERE table_name='clones';''')
 		last_dl = self.db.cursor.fetchone()[0]
 
 		if all_commits:
@@ -477,7 +589,7 @@ class RepoCrawler(object):
 			self.db.create_indexes(table='commit_parents')
 
 			self.db.cursor.execute('''INSERT INTO full_updates(update_type,updated_at) VALUES('commits',(SELECT CURRENT_TIMESTAMP));''')
-			self.db.connection.commit()
+			self.db.commit()
 		else:
 			self.logger.info('Skipping filling of commits info')
 
@@ -566,7 +678,7 @@ class RepoCrawler(object):
 						else:
 							self.logger.info('Filled stars for repo {}/{}: {}'.format(owner,repo_name,nb_stars))
 							db.insert_update(repo_id=repo_id,table='stars',success=True)
-							db.connection.commit()
+							db.commit()
 							repo_list.pop(0)
 							new_repo = True
 							break
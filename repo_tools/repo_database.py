@@ -1,11 +1,14 @@
 import os
+import time
 import datetime
+import contextlib
 import logging
 import sqlite3
 
 import csv
 import copy
 import json
+from concurrent import futures
 import numpy as np
 
 logger = logging.getLogger(__name__)
@@ -71,6 +74,16 @@ class Database(object):
 		else:
 			raise ValueError('Unknown DB type: {}'.format(db_type))
 
+		self.read_connection = None
+		self.cursor_count = 0
+		self.open_iterators = 0
+		self.batch_depth = 0
+		self.commit_every = None
+		self.commit_interval = None
+		self.pending_writes = 0
+		self.last_commit_time = time.time()
+		self.sources_version = 0 # incremented when sources change, so that objects built from sources (e.g. UrlNormalizer) know when to be rebuilt
+		self.clear_cache()
 		if clean_first:
 			self.clean_db()
 		if do_init:
@@ -96,7 +109,76 @@ class Database(object):
 		'''
 		Returns a copy, without init, with independent connection and cursor
 		'''
-		return self.__class__(do_init=False,timeout=timeout,**self.db_conninfo)
+		return self.__class__(do_init=False,timeout=timeout,data_folder=self.data_folder,**self.db_conninfo)
+
+	def close(self):
+		'''
+		Closes the connections of the object
+		'''
+		if self.read_connection is not None:
+			self.read_connection.close()
+			self.read_connection = None
+		self.connection.close()
+
+	def clear_cache(self,table=None):
+		'''
+		Emptying the in-process caches mapping keys (source names, identity types, repositories, identities) to ids.
+		If table is None, all caches are emptied.
+
+		Only ids found in the database are cached, so inserting rows does not make the cache stale.
+		It has to be cleared when rows are deleted or a transaction is rolled back.
+		'''
+		if table is None:
+			self.id_cache = {
+					'sources':{},
+					'identity_types':{},
+					'repositories':{},
+					'identities':{},
+			}
+		else:
+			self.id_cache[table] = {}
+
+	def commit(self,force=False):
+		'''
+		Commits the current transaction, following the commit policy set by batch.
+		Outside of a batch, every call commits. Inside a batch, calls are counted as writes, and a commit happens every commit_every writes or commit_interval seconds, or only at the end of the batch if both are None.
+		force commits in any case.
+		'''
+		if self.batch_depth and not force:
+			self.pending_writes += 1
+			if not ((self.commit_every is not None and self.pending_writes >= self.commit_every)
+					or (self.commit_interval is not None and time.time()-self.last_commit_time >= self.commit_interval)):
+				return
+		self.connection.commit()
+		self.pending_writes = 0
+		self.last_commit_time = time.time()
+
+	@contextlib.contextmanager
+	def batch(self,commit_every=None,commit_interval=None):
+		'''
+		Context manager grouping the writes of all methods (and fillers) in larger transactions, committed every commit_every writes and/or every commit_interval seconds.
+		With both None, the whole batch is one transaction. It is committed at the end of the batch.
+
+		Nested batches are merged into the outermost one, whose policy applies.
+		On exception, the current transaction is rolled back and the id caches are cleared, as they may contain ids of rolled back rows.
+		'''
+		if self.batch_depth == 0:
+			self.commit_every = commit_every
+			self.commit_interval = commit_interval
+			self.pending_writes = 0
+			self.last_commit_time = time.time()
+		self.batch_depth += 1
+		try:
+			yield self
+		except BaseException:
+			self.connection.rollback()
+			self.clear_cache()
+			raise
+		else:
+			if self.batch_depth == 1:
+				self.commit(force=True)
+		finally:
+			self.batch_depth -= 1
 
 	def init_db(self):
 		'''
@@ -117,7 +199,8 @@ class Database(object):
 				source_root INTEGER REFERENCES sources(id) ON DELETE CASCADE,
 				url TEXT NOT NULL UNIQUE,
 				cleaned_url INTEGER REFERENCES urls(id) ON DELETE CASCADE,
-				inserted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+				inserted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+				cleaned_at TIMESTAMP
 				);
 
 				CREATE TABLE IF NOT EXISTS repositories(
@@ -224,11 +307,58 @@ class Database(object):
 				CREATE INDEX IF NOT EXISTS table_updates_idx ON table_updates(repo_id,table_name,updated_at);
 				CREATE INDEX IF NOT EXISTS table_updates_identity_idx ON table_updates(identity_id,table_name,updated_at);
 
+				CREATE TABLE IF NOT EXISTS table_updates_latest(
+				repo_id INTEGER REFERENCES repositories(id) ON DELETE CASCADE,
+				identity_id INTEGER REFERENCES identities(id) ON DELETE CASCADE,
+				table_name TEXT,
+				updated_at TIMESTAMP,
+				success BOOLEAN,
+				latest_commit_time TIMESTAMP DEFAULT NULL,
+				last_success_at TIMESTAMP DEFAULT NULL
+				);
+
+				CREATE UNIQUE INDEX IF NOT EXISTS table_updates_latest_repo_idx ON table_updates_latest(repo_id,table_name) WHERE identity_id IS NULL;
+				CREATE UNIQUE INDEX IF NOT EXISTS table_updates_latest_identity_idx ON table_updates_latest(identity_id,table_name) WHERE repo_id IS NULL;
+
+				CREATE TABLE IF NOT EXISTS table_updates_summary(
+				repo_id INTEGER REFERENCES repositories(id) ON DELETE CASCADE,
+				identity_id INTEGER REFERENCES identities(id) ON DELETE CASCADE,
+				table_name TEXT,
+				updates_count INTEGER DEFAULT 0,
+				success_count INTEGER DEFAULT 0,
+				first_update_at TIMESTAMP,
+				last_update_at TIMESTAMP,
+				last_success_at TIMESTAMP DEFAULT NULL
+				);
+
+				CREATE UNIQUE INDEX IF NOT EXISTS table_updates_summary_repo_idx ON table_updates_summary(repo_id,table_name) WHERE identity_id IS NULL;
+				CREATE UNIQUE INDEX IF NOT EXISTS table_updates_summary_identity_idx ON table_updates_summary(identity_id,table_name) WHERE repo_id IS NULL;
+
+				CREATE TABLE IF NOT EXISTS table_updates_archive(
+				id INTEGER PRIMARY KEY,
+				repo_id INTEGER,
+				identity_id INTEGER,
+				table_name TEXT,
+				updated_at TIMESTAMP,
+				success BOOLEAN,
+				latest_commit_time TIMESTAMP DEFAULT NULL,
+				archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+				);
+
 				CREATE TABLE IF NOT EXISTS full_updates(
 				update_type TEXT,
 				updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 				);
 
+				CREATE TABLE IF NOT EXISTS clone_failures(
+				repo_id INTEGER PRIMARY KEY REFERENCES repositories(id) ON DELETE CASCADE,
+				permanent BOOLEAN DEFAULT false,
+				attempts INTEGER DEFAULT 0,
+				error TEXT,
+				last_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+				next_retry_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+				);
+
 				CREATE TABLE IF NOT EXISTS followers(
 				follower_identity_type_id INTEGER REFERENCES identity_types(id) ON DELETE CASCADE,
 				follower_login TEXT,
@@ -274,7 +404,7 @@ class Database(object):
 		'''
 			for q in DB_INIT.split(';')[:-1]:
 				self.cursor.execute(q)
-			self.connection.commit()
+			self.commit(force=True)
 		elif self.db_type == 'postgres':
 			self.cursor.execute('''
 				CREATE TABLE IF NOT EXISTS sources(
@@ -289,7 +419,8 @@ class Database(object):
 				source_root BIGINT REFERENCES sources(id) ON DELETE CASCADE,
 				url TEXT NOT NULL UNIQUE,
 				cleaned_url BIGINT REFERENCES urls(id) ON DELETE CASCADE,
-				inserted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+				inserted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+				cleaned_at TIMESTAMP
 				);
 
 				CREATE TABLE IF NOT EXISTS repositories(
@@ -397,11 +528,58 @@ class Database(object):
 				CREATE INDEX IF NOT EXISTS table_updates_idx ON table_updates(repo_id,table_name,updated_at);
 				CREATE INDEX IF NOT EXISTS table_updates_identity_idx ON table_updates(identity_id,table_name,updated_at);
 
+				CREATE TABLE IF NOT EXISTS table_updates_latest(
+				repo_id BIGINT REFERENCES repositories(id) ON DELETE CASCADE,
+				identity_id BIGINT REFERENCES identities(id) ON DELETE CASCADE,
+				table_name TEXT,
+				updated_at TIMESTAMP,
+				success BOOLEAN,
+				latest_commit_time TIMESTAMP DEFAULT NULL,
+				last_success_at TIMESTAMP DEFAULT NULL
+				);
+
+				CREATE UNIQUE INDEX IF NOT EXISTS table_updates_latest_repo_idx ON table_updates_latest(repo_id,table_name) WHERE identity_id IS NULL;
+				CREATE UNIQUE INDEX IF NOT EXISTS table_updates_latest_identity_idx ON table_updates_latest(identity_id,table_name) WHERE repo_id IS NULL;
+
+				CREATE TABLE IF NOT EXISTS table_updates_summary(
+				repo_id BIGINT REFERENCES repositories(id) ON DELETE CASCADE,
+				identity_id BIGINT REFERENCES identities(id) ON DELETE CASCADE,
+				table_name TEXT,
+				updates_count BIGINT DEFAULT 0,
+				success_count BIGINT DEFAULT 0,
+				first_update_at TIMESTAMP,
+				last_update_at TIMESTAMP,
+				last_success_at TIMESTAMP DEFAULT NULL
+				);
+
+				CREATE UNIQUE INDEX IF NOT EXISTS table_updates_summary_repo_idx ON table_updates_summary(repo_id,table_name) WHERE identity_id IS NULL;
+				CREATE UNIQUE INDEX IF NOT EXISTS table_updates_summary_identity_idx ON table_updates_summary(identity_id,table_name) WHERE repo_id IS NULL;
+
+				CREATE TABLE IF NOT EXISTS table_updates_archive(
+				id BIGINT PRIMARY KEY,
+				repo_id BIGINT,
+				identity_id BIGINT,
+				table_name TEXT,
+				updated_at TIMESTAMP,
+				success BOOLEAN,
+				latest_commit_time TIMESTAMP DEFAULT NULL,
+				archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+				);
+
 				CREATE TABLE IF NOT EXISTS full_updates(
 				update_type TEXT,
 				updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 				);
 
+				CREATE TABLE IF NOT EXISTS clone_failures(
+				repo_id BIGINT PRIMARY KEY REFERENCES repositories(id) ON DELETE CASCADE,
+				permanent BOOLEAN DEFAULT false,
+				attempts INTEGER DEFAULT 0,
+				error TEXT,
+				last_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+				next_retry_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+				);
+
 
 				CREATE TABLE IF NOT EXISTS stars(
 				repo_id BIGINT REFERENCES repositories(id) ON DELETE CASCADE,
@@ -447,7 +625,21 @@ class Database(object):
 				CREATE INDEX IF NOT EXISTS packages_repo_idx ON packages(repo_id);
 				''')
 
-			self.connection.commit()
+			self.commit(force=True)
+		self.migrate_db()
+		self.fill_table_updates_latest()
+
+	def migrate_db(self):
+		'''
+		Adding to tables of existing databases the columns introduced after their creation
+		'''
+		if self.db_type == 'postgres':
+			self.cursor.execute('''ALTER TABLE urls ADD COLUMN IF NOT EXISTS cleaned_at TIMESTAMP;''')
+		else:
+			self.cursor.execute('''PRAGMA table_info(urls);''')
+			if 'cleaned_at' not in [r[1] for r in self.cursor.fetchall()]:
+				self.cursor.execute('''ALTER TABLE urls ADD COLUMN cleaned_at TIMESTAMP;''')
+		self.commit(force=True)
 
 	def clean_db(self,sqlite_del=True):
 		'''
@@ -455,6 +647,8 @@ class Database(object):
 		If there is a change in structure in the init script, this method should be called to 'reset' the state of the database
 		'''
 		logger.info('Cleaning database')
+		self.clear_cache()
+		self.sources_version += 1
 		if self.db_type == 'sqlite' and not self.in_ram and sqlite_del:
 			del self.cursor
 			del self.connection
@@ -469,24 +663,96 @@ class Database(object):
 			self.cursor.execute('DROP TABLE IF EXISTS commit_repos;')
 			self.cursor.execute('DROP TABLE IF EXISTS commit_parents;')
 			self.cursor.execute('DROP TABLE IF EXISTS commits;')
+			self.cursor.execute('DROP TABLE IF EXISTS table_updates_latest;')
+			self.cursor.execute('DROP TABLE IF EXISTS table_updates_summary;')
+			self.cursor.execute('DROP TABLE IF EXISTS table_updates_archive;')
 			self.cursor.execute('DROP TABLE IF EXISTS table_updates;')
 			self.cursor.execute('DROP TABLE IF EXISTS merged_identities;')
 			self.cursor.execute('DROP TABLE IF EXISTS identities;')
 			self.cursor.execute('DROP TABLE IF EXISTS users;')
 			self.cursor.execute('DROP TABLE IF EXISTS identity_types;')
 			self.cursor.execute('DROP TABLE IF EXISTS full_updates;')
+			self.cursor.execute('DROP TABLE IF EXISTS clone_failures;')
 			self.cursor.execute('DROP TABLE IF EXISTS download_attempts;')
 			self.cursor.execute('DROP TABLE IF EXISTS repositories;')
 			self.cursor.execute('DROP TABLE IF EXISTS urls;')
 			self.cursor.execute('DROP TABLE IF EXISTS sources;')
-			self.connection.commit()
+			self.commit(force=True)
 
 
-	def fill_db(self):
-		for f in self.fillers:
+	def fill_db(self,workers=1):
+		'''
+		Runs the fillers (prepare then apply).
+		With workers=1, they run one after the other, in the order they were added.
+		With workers>1, up to workers fillers run concurrently, each on its own copy of the database (independent connection),
+		as soon as the fillers they depend on are done (see filler_dependencies).
+		If a filler fails, no new filler is started, and the first error is raised once running ones are done.
+		'''
+		if workers > 1 and self.db_type == 'sqlite' and self.in_ram:
+			self.logger.warning('In-memory SQLite database cannot be shared between connections, running fillers sequentially')
+			workers = 1
+		if workers <= 1:
+			for f in self.fillers:
+				f.prepare()
+				f.apply()
+				self.logger.info('Filled with filler {}'.format(f.name))
+			return
+
+		dependencies = self.filler_dependencies()
+		done = set()
+		running = {}
+		errors = []
+		with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+			while True:
+				if not errors:
+					for f in self.fillers:
+						if f.name not in done and f.name not in running.values() and dependencies[f.name] <= done:
+							running[executor.submit(self.run_filler,f)] = f.name
+				if not running:
+					break
+				finished,_ = futures.wait(running,return_when=futures.FIRST_COMPLETED)
+				for job in finished:
+					name = running.pop(job)
+					try:
+						job.result()
+					except Exception as e:
+						self.logger.error('Filler {} failed: {}'.format(name,e))
+						errors.append(e)
+					else:
+						done.add(name)
+		if errors:
+			raise errors[0]
+
+	def run_filler(self,f):
+		'''
+		Runs a filler on a copy of the database, used by fill_db with workers>1
+		'''
+		db = self.copy()
+		f.db = db
+		try:
 			f.prepare()
 			f.apply()
+			db.commit(force=True)
 			self.logger.info('Filled with filler {}'.format(f.name))
+		finally:
+			f.db = self
+			db.close()
+
+	def filler_dependencies(self):
+		'''
+		Returns {filler name:set of names of previously added fillers it has to wait for}.
+		A filler waits for a previous one if it requires the name of the previous one, if one writes a table the other reads or writes,
+		or if any of the two does not declare its requires/provides.
+		'''
+		dependencies = {}
+		for i,f in enumerate(self.fillers):
+			dependencies[f.name] = set()
+			for g in self.fillers[:i]:
+				if f.requires is None or f.provides is None or g.requires is None or g.provides is None:
+					dependencies[f.name].add(g.name)
+				elif g.name in f.requires or set(f.requires) & set(g.provides) or set(f.provides) & set(g.provides) or set(f.provides) & set(g.requires):
+					dependencies[f.name].add(g.name)
+		return dependencies
 
 	def add_filler(self,f):
 		if f.name in [ff.name for ff in self.fillers]:
@@ -501,19 +767,20 @@ class Database(object):
 		'''
 		Putting a repo in the database
 		'''
+		source_id = self.get_source_id(source=source)
 		if self.db_type == 'postgres':
 			self.cursor.execute(''' INSERT INTO repositories(source,owner,name,cloned)
-				 VALUES((SELECT id FROM sources WHERE name=%s),
+				 VALUES(%s,
 								%s,
 								%s,
-								%s) ON CONFLICT DO NOTHING; ''',(source,owner,repo,cloned))
+								%s) ON CONFLICT DO NOTHING; ''',(source_id,owner,repo,cloned))
 		else:
 			self.cursor.execute(''' INSERT OR IGNORE INTO repositories(source,owner,name,cloned)
-				 VALUES((SELECT id FROM sources WHERE name=?),
+				 VALUES(?,
 								?,
 								?,
-								?);''',(source,owner,repo,cloned))
-		self.connection.commit()
+								?);''',(source_id,owner,repo,cloned))
+		self.commit()
 
 	def register_source(self,source,source_urlroot=None):
 		'''
@@ -525,46 +792,92 @@ class Database(object):
 		else:
 			self.cursor.execute(''' INSERT OR IGNORE INTO sources(name,url_root)
 				 VALUES(?,?);''',(source,source_urlroot))
-		self.connection.commit()
+		self.id_cache['sources'].pop(source,None)
+		self.sources_version += 1
+		self.commit()
 
 	def register_urls(self,source,url_list):
 		'''
 		Registering URLs and potentially their cleaned version in the database
 		url_list should be [(url,cleaned_url,source_root_id)] # source is the source of the url (eg crates), source_root is the repository system source (eg github)
-		but if [url], completed by [(url,None,None)]
+		but plain urls are completed to (url,None,None)
+
+		The batch is loaded in a temporary staging table, and merged into urls with three set-based statements:
+		upserting cleaned URLs, linking cleaned URLs to themselves, upserting raw URLs with the id of their cleaned version.
+		When a URL appears several times in the batch, its last occurrence is kept.
+		Registering again a URL without cleaned version keeps the cleaned version, source and source_root it already has;
+		a new cleaned version resets cleaned_at, so that the URL is processed again by incremental runs of RepositoriesFiller.
 		'''
-		if len(url_list)>0 and isinstance(url_list[0],str):
-			url_list = [(url,None,None) for url in url_list]
+		url_list = [(url,None,None) if isinstance(url,str) else url for url in url_list]
 
+		source_id = self.get_source_id(source=source)
+
+		self.cursor.execute('''CREATE TEMP TABLE IF NOT EXISTS urls_staging(
+				rank BIGINT PRIMARY KEY,
+				url TEXT NOT NULL,
+				cleaned_url TEXT,
+				source_root BIGINT
+				);''')
+		self.cursor.execute('''DELETE FROM urls_staging;''')
 
 		if self.db_type == 'postgres':
-			extras.execute_batch(self.cursor,''' INSERT INTO urls(source,source_root,url)
-				 VALUES((SELECT id FROM sources WHERE name=%s),
-				 				%s,
-								%s) ON CONFLICT(url) DO NOTHING;''',((source,source_root_id,url_cleaned) for url,url_cleaned,source_root_id  in url_list if url_cleaned is not None))
-			extras.execute_batch(self.cursor,''' UPDATE urls SET cleaned_url=id WHERE url=%s ;''',((url_cleaned,) for url,url_cleaned,source_root_id  in url_list if url_cleaned is not None))
-			extras.execute_batch(self.cursor,''' UPDATE urls SET source=(SELECT id FROM sources WHERE name=%s),source_root=%s WHERE url=%s ;''',((source,source_root_id,url,) for url,url_cleaned,source_root_id  in url_list if url_cleaned is not None))
-			extras.execute_batch(self.cursor,''' UPDATE urls SET source=(SELECT id FROM sources WHERE name=%s),source_root=%s WHERE url=%s ;''',((source,source_root_id,url_cleaned,) for url,url_cleaned,source_root_id  in url_list if url_cleaned is not None))
-			extras.execute_batch(self.cursor,''' INSERT INTO urls(source,source_root,url,cleaned_url)
-				 VALUES((SELECT id FROM sources WHERE name=%s),
-				 				%s,
-								%s,(SELECT id FROM urls WHERE url=%s)) ON CONFLICT(url) DO UPDATE
-								SET cleaned_url=excluded.cleaned_url;''',((source,source_root_id,url,url_cleaned) for url,url_cleaned,source_root_id  in url_list))
+			extras.execute_values(self.cursor,'''INSERT INTO urls_staging(rank,url,cleaned_url,source_root) VALUES %s;''',((i,url,url_cleaned,source_root_id) for i,(url,url_cleaned,source_root_id) in enumerate(url_list)),page_size=1000)
+
+			self.cursor.execute('''
+				INSERT INTO urls(source,source_root,url)
+				SELECT %s,MAX(s.source_root),s.cleaned_url FROM urls_staging s
+				WHERE s.cleaned_url IS NOT NULL
+				GROUP BY s.cleaned_url
+				ON CONFLICT(url) DO UPDATE
+					SET source=excluded.source,source_root=excluded.source_root
+				;''',(source_id,))
+			self.cursor.execute('''
+				UPDATE urls SET cleaned_url=id
+				WHERE url IN (SELECT s.cleaned_url FROM urls_staging s WHERE s.cleaned_url IS NOT NULL)
+				;''')
+			self.cursor.execute('''
+				INSERT INTO urls(source,source_root,url,cleaned_url)
+				SELECT %s,s.source_root,s.url,cu.id FROM urls_staging s
+				LEFT OUTER JOIN urls cu
+				ON cu.url=s.cleaned_url
+				WHERE s.rank IN (SELECT MAX(ss.rank) FROM urls_staging ss GROUP BY ss.url)
+				ON CONFLICT(url) DO UPDATE
+					SET cleaned_url=COALESCE(excluded.cleaned_url,urls.cleaned_url),
+						cleaned_at=CASE WHEN excluded.cleaned_url IS NULL OR excluded.cleaned_url=urls.cleaned_url THEN urls.cleaned_at ELSE NULL END,
+						source=CASE WHEN excluded.cleaned_url IS NULL THEN urls.source ELSE excluded.source END,
+						source_root=CASE WHEN excluded.cleaned_url IS NULL THEN urls.source_root ELSE excluded.source_root END
+				;''',(source_id,))
 		else:
-			self.cursor.executemany(''' INSERT OR IGNORE INTO urls(source,source_root,url)
-				 VALUES((SELECT id FROM sources WHERE name=?),
-				 				?,
-								?);''',((source,source_root_id,url_cleaned) for url,url_cleaned,source_root_id in url_list if url_cleaned is not None))
-			self.cursor.executemany(''' UPDATE urls SET cleaned_url=id WHERE url=?;''',((url_cleaned,) for url,url_cleaned,source_root_id in url_list if url_cleaned is not None))
-			self.cursor.executemany(''' UPDATE urls SET source=(SELECT id FROM sources WHERE name=?),source_root=? WHERE url=?;''',((source,source_root_id,url,) for url,url_cleaned,source_root_id in url_list if url_cleaned is not None))
-			self.cursor.executemany(''' UPDATE urls SET source=(SELECT id FROM sources WHERE name=?),source_root=? WHERE url=?;''',((source,source_root_id,url_cleaned,) for url,url_cleaned,source_root_id in url_list if url_cleaned is not None))
-			self.cursor.executemany(''' INSERT INTO urls(source,source_root,url,cleaned_url)
-				 VALUES((SELECT id FROM sources WHERE name=?),
-				 				?,
-								?,(SELECT id FROM urls WHERE url=?)) ON CONFLICT(url) DO UPDATE
-								SET cleaned_url=excluded.cleaned_url;''',((source,source_root_id,url,url_cleaned) for url,url_cleaned,source_root_id in url_list))
+			self.cursor.executemany('''INSERT INTO urls_staging(rank,url,cleaned_url,source_root) VALUES(?,?,?,?);''',((i,url,url_cleaned,source_root_id) for i,(url,url_cleaned,source_root_id) in enumerate(url_list)))
 
-		self.connection.commit()
+			# the WHERE clauses are needed for SQLite to parse the upserts from SELECT statements
+			self.cursor.execute('''
+				INSERT INTO urls(source,source_root,url)
+				SELECT ?,MAX(s.source_root),s.cleaned_url FROM urls_staging s
+				WHERE s.cleaned_url IS NOT NULL
+				GROUP BY s.cleaned_url
+				ON CONFLICT(url) DO UPDATE
+					SET source=excluded.source,source_root=excluded.source_root
+				;''',(source_id,))
+			self.cursor.execute('''
+				UPDATE urls SET cleaned_url=id
+				WHERE url IN (SELECT s.cleaned_url FROM urls_staging s WHERE s.cleaned_url IS NOT NULL)
+				;''')
+			self.cursor.execute('''
+				INSERT INTO urls(source,source_root,url,cleaned_url)
+				SELECT ?,s.source_root,s.url,cu.id FROM urls_staging s
+				LEFT OUTER JOIN urls cu
+				ON cu.url=s.cleaned_url
+				WHERE s.rank IN (SELECT MAX(ss.rank) FROM urls_staging ss GROUP BY ss.url)
+				ON CONFLICT(url) DO UPDATE
+					SET cleaned_url=COALESCE(excluded.cleaned_url,urls.cleaned_url),
+						cleaned_at=CASE WHEN excluded.cleaned_url IS NULL OR excluded.cleaned_url=urls.cleaned_url THEN urls.cleaned_at ELSE NULL END,
+						source=CASE WHEN excluded.cleaned_url IS NULL THEN urls.source ELSE excluded.source END,
+						source_root=CASE WHEN excluded.cleaned_url IS NULL THEN urls.source_root ELSE excluded.source_root END
+				;''',(source_id,))
+
+		self.cursor.execute('''DELETE FROM urls_staging;''')
+		self.commit()
 
 	def register_url(self,source,repo_url,repo_id=None,clean_info=None): # DEPRECATED
 		'''
@@ -599,27 +912,28 @@ class Database(object):
 	# 	self.connection.commit()
 
 
-	def register_repositories(self,repo_info_list):
+	def register_repositories(self,repo_info_list,cloned=False):
 		'''
 		repo_info_list syntax:
 		source_id, owner, name, url
+		cloned is the value set for newly registered repositories
 		'''
 		if self.db_type == 'postgres':
 			extras.execute_batch(self.cursor,'''
-				INSERT INTO repositories(source,owner,name,url_id) VALUES(
-				%s,%s,%s,(SELECT id FROM urls WHERE url=%s)
+				INSERT INTO repositories(source,owner,name,url_id,cloned) VALUES(
+				%s,%s,%s,(SELECT id FROM urls WHERE url=%s),%s
 				) ON CONFLICT DO NOTHING
-				;''',repo_info_list)
+				;''',((*r,cloned) for r in repo_info_list))
 		else:
 			self.cursor.executemany('''
-				INSERT OR IGNORE INTO repositories(source,owner,name,url_id) VALUES(
-				?,?,?,(SELECT id FROM urls WHERE url=?)
+				INSERT OR IGNORE INTO repositories(source,owner,name,url_id,cloned) VALUES(
+				?,?,?,(SELECT id FROM urls WHERE url=?),?
 				)
-				;''',repo_info_list)
-		self.connection.commit()
+				;''',((*r,cloned) for r in repo_info_list))
+		self.commit()
 
 
-	def register_packages(self,source,package_list,autocommit=True):
+	def register_packages(self,source,package_list,update=False,autocommit=True):
 		'''
 		Registering packages from package list
 		URLs are supposed to be already filled
@@ -627,9 +941,18 @@ class Database(object):
 		syntax of package list:
 		package id (in source), package name, created_at (datetime.datetime),repo_url
 
+		With update=True, packages already present (same source and package id) are updated instead of ignored
 		'''
 		source_id = self.get_source_info(source=source)[0]
 		if self.db_type == 'postgres':
+			if update:
+				conflict_str = '''ON CONFLICT(source_id,insource_id) DO UPDATE SET
+					name=EXCLUDED.name,
+					created_at=EXCLUDED.created_at,
+					url_id=EXCLUDED.url_id,
+					repo_id=EXCLUDED.repo_id'''
+			else:
+				conflict_str = 'ON CONFLICT DO NOTHING'
 			extras.execute_batch(self.cursor,'''
 				INSERT INTO packages(repo_id,source_id,insource_id,name,created_at,url_id)
 				VALUES(
@@ -637,39 +960,109 @@ class Database(object):
 						INNER JOIN repositories r ON r.url_id=u.cleaned_url
 						AND u.url=%s),
 				%s,%s,%s,%s,(SELECT id FROM urls WHERE url=%s))
-				ON CONFLICT DO NOTHING
-				;''',((p[-1],source_id,*p) for p in package_list))
+				{}
+				;'''.format(conflict_str),((p[-1],source_id,*p) for p in package_list))
 		else:
+			if update:
+				insert_str = 'INSERT'
+				conflict_str = '''ON CONFLICT(source_id,insource_id) DO UPDATE SET
+					name=excluded.name,
+					created_at=excluded.created_at,
+					url_id=excluded.url_id,
+					repo_id=excluded.repo_id'''
+			else:
+				insert_str = 'INSERT OR IGNORE'
+				conflict_str = ''
 			self.cursor.executemany('''
-				INSERT OR IGNORE INTO packages(repo_id,source_id,insource_id,name,created_at,url_id)
+				{} INTO packages(repo_id,source_id,insource_id,name,created_at,url_id)
 				VALUES(
 					(SELECT r.id FROM urls u
 						INNER JOIN repositories r ON r.url_id=u.cleaned_url
 						AND u.url=?),?,?,?,?,(SELECT id FROM urls WHERE url=?))
-				;''',((p[-1],source_id,*p) for p in package_list))
+				{}
+				;'''.format(insert_str,conflict_str),((p[-1],source_id,*p) for p in package_list))
 		if autocommit:
-			self.connection.commit()
+			self.commit()
 
 	def get_repo_id(self,owner,name,source):
 		'''
 		Getting repo id, None if not in DB
 		'''
+		key = (source,owner,name)
+		try:
+			return self.id_cache['repositories'][key]
+		except KeyError:
+			pass
+		source_id = self.get_source_id(source=source)
+		cursor = self.connection.cursor() # independent cursor, lookups can happen while self.cursor is consuming a generator
 		if self.db_type == 'postgres':
-			self.cursor.execute(''' SELECT id FROM repositories WHERE
-									source=(SELECT id FROM sources WHERE name=%s)
+			cursor.execute(''' SELECT id FROM repositories WHERE
+									source=%s
 									AND owner=%s
-									AND name=%s;''',(source,owner,name))
+									AND name=%s;''',(source_id,owner,name))
 		else:
-			self.cursor.execute(''' SELECT id FROM repositories WHERE
-									source=(SELECT id FROM sources WHERE name=?)
+			cursor.execute(''' SELECT id FROM repositories WHERE
+									source=?
 									AND owner=?
-									AND name=?;''',(source,owner,name))
-		repo_id = self.cursor.fetchone()
+									AND name=?;''',(source_id,owner,name))
+		repo_id = cursor.fetchone()
 		if repo_id is None:
 			return None
 		else:
+			self.id_cache['repositories'][key] = repo_id[0]
 			return repo_id[0]
 
+	def get_source_id(self,source):
+		'''
+		Getting source id, None if not in DB
+		'''
+		try:
+			return self.get_source_info(source=source)[0]
+		except ValueError:
+			return None
+
+	def get_identity_type_id(self,identity_type):
+		'''
+		Getting identity type id, None if not in DB
+		'''
+		try:
+			return self.id_cache['identity_types'][identity_type]
+		except KeyError:
+			pass
+		cursor = self.connection.cursor()
+		if self.db_type == 'postgres':
+			cursor.execute('SELECT id FROM identity_types WHERE name=%s;',(identity_type,))
+		else:
+			cursor.execute('SELECT id FROM identity_types WHERE name=?;',(identity_type,))
+		ans = cursor.fetchone()
+		if ans is None:
+			return None
+		else:
+			self.id_cache['identity_types'][identity_type] = ans[0]
+			return ans[0]
+
+	def get_identity_id(self,identity,identity_type='email'):
+		'''
+		Getting identity id, None if not in DB
+		'''
+		key = (identity_type,identity)
+		try:
+			return self.id_cache['identities'][key]
+		except KeyError:
+			pass
+		identity_type_id = self.get_identity_type_id(identity_type=identity_type)
+		cursor = self.connection.cursor()
+		if self.db_type == 'postgres':
+			cursor.execute('SELECT id FROM identities WHERE identity_type_id=%s AND identity=%s;',(identity_type_id,identity))
+		else:
+			cursor.execute('SELECT id FROM identities WHERE identity_type_id=? AND identity=?;',(identity_type_id,identity))
+		ans = cursor.fetchone()
+		if ans is None:
+			return None
+		else:
+			self.id_cache['identities'][key] = ans[0]
+			return ans[0]
+
 	def submit_download_attempt(self,source,owner,repo,success,dl_time=None):
 		'''
 		Registers a repository if not already done, plus the download attempt
@@ -679,193 +1072,355 @@ class Database(object):
 
 		#creating if not existing
 		if repo_id is None:
+			source_id = self.get_source_id(source=source)
 			if self.db_type == 'postgres':
 				self.cursor.execute(''' INSERT INTO repositories(source,owner,name)
-					 VALUES((SELECT id FROM sources WHERE name=%s),
+					 VALUES(%s,
 									%s,
-									%s);''',(source,owner,repo))
+									%s);''',(source_id,owner,repo))
 			else:
 				self.cursor.execute(''' INSERT INTO repositories(source,owner,name)
-					 VALUES((SELECT id FROM sources WHERE name=?),
+					 VALUES(?,
 									?,
-									?);''',(source,owner,repo))
+									?);''',(source_id,owner,repo))
 			repo_id = self.get_repo_id(name=repo,source=source,owner=owner)
 
 		#inserting download attempt
+		self.insert_update(table='clones',repo_id=repo_id,success=success,updated_at=dl_time,autocommit=False)
 		if dl_time is None:
 			if self.db_type == 'postgres':
-				self.cursor.execute(''' INSERT INTO table_updates(repo_id,table_name,success)
-				 VALUES(%s,'clones',%s);''',(repo_id,success))
 				if success:
 					self.cursor.execute(''' UPDATE repositories SET updated_at=(SELECT CURRENT_TIMESTAMP), cloned=true
 				WHERE id=%s;''',(repo_id,))
 
 			else:
-				self.cursor.execute(''' INSERT INTO table_updates(repo_id,table_name,success)
-				 VALUES(?,'clones',?);''',(repo_id,success))
 				if success:
 					self.cursor.execute(''' UPDATE repositories SET updated_at=(SELECT CURRENT_TIMESTAMP), cloned=1
 				WHERE id=?;''',(repo_id,))
 		else:
 			if self.db_type == 'postgres':
-				self.cursor.execute(''' INSERT INTO table_updates(repo_id,table_name,success,updated_at)
-				 VALUES(%s,'clones',%s,%s);''',(repo_id,success,dl_time))
 				if success:
 					self.cursor.execute(''' UPDATE repositories SET updated_at=%s, cloned=true
 				WHERE id=%s;''',(dl_time,repo_id,))
 
 			else:
-				self.cursor.execute(''' INSERT INTO table_updates(repo_id,table_name,success,updated_at)
-				 VALUES(?,'clones',?,?);''',(repo_id,success,dl_time))
 				if success:
 					self.cursor.execute(''' UPDATE repositories SET updated_at=?, cloned=1
 				WHERE id=?;''',(dl_time,repo_id,))
-		self.connection.commit()
+		self.commit()
 
-	def get_repo_list(self,option='all'):
+	def submit_download_attempts(self,attempt_list,autocommit=True):
 		'''
-		Getting a list of source,source_urlroot,owner,name
+		Same as submit_download_attempt for a list of (repo_id,success,dl_time) of registered repositories, with one statement per table.
+		dl_time defaults to the current time.
 		'''
+		attempt_list = list(attempt_list)
+		if self.db_type == 'postgres':
+			extras.execute_batch(self.cursor,'''INSERT INTO table_updates(repo_id,table_name,success,updated_at)
+				VALUES(%s,'clones',%s,COALESCE(%s,CURRENT_TIMESTAMP))
+				;''',attempt_list)
+			extras.execute_batch(self.cursor,'''INSERT INTO table_updates_latest(repo_id,table_name,success,updated_at,last_success_at)
+				VALUES(%s,'clones',%s,COALESCE(%s,CURRENT_TIMESTAMP),CASE WHEN %s THEN COALESCE(%s,CURRENT_TIMESTAMP) ELSE NULL END)
+				ON CONFLICT (repo_id,table_name) WHERE identity_id IS NULL DO UPDATE SET
+					success=EXCLUDED.success,
+					latest_commit_time=EXCLUDED.latest_commit_time,
+					updated_at=EXCLUDED.updated_at,
+					last_success_at=COALESCE(EXCLUDED.last_success_at,table_updates_latest.last_success_at)
+				WHERE table_updates_latest.updated_at <= EXCLUDED.updated_at
+				;''',((repo_id,success,dl_time,success,dl_time) for repo_id,success,dl_time in attempt_list))
+			extras.execute_batch(self.cursor,'''UPDATE repositories SET updated_at=COALESCE(%s,CURRENT_TIMESTAMP), cloned=true WHERE id=%s;''',
+				((dl_time,repo_id) for repo_id,success,dl_time in attempt_list if success))
+		else:
+			self.cursor.executemany('''INSERT INTO table_updates(repo_id,table_name,success,updated_at)
+				VALUES(?,'clones',?,COALESCE(?,CURRENT_TIMESTAMP))
+				;''',attempt_list)
+			self.cursor.executemany('''INSERT INTO table_updates_latest(repo_id,table_name,success,updated_at,last_success_at)
+				VALUES(?,'clones',?,COALESCE(?,CURRENT_TIMESTAMP),CASE WHEN ? THEN COALESCE(?,CURRENT_TIMESTAMP) ELSE NULL END)
+				ON CONFLICT (repo_id,table_name) WHERE identity_id IS NULL DO UPDATE SET
+					success=EXCLUDED.success,
+					latest_commit_time=EXCLUDED.latest_commit_time,
+					updated_at=EXCLUDED.updated_at,
+					last_success_at=COALESCE(EXCLUDED.last_success_at,table_updates_latest.last_success_at)
+				WHERE table_updates_latest.updated_at <= EXCLUDED.updated_at
+				;''',((repo_id,success,dl_time,success,dl_time) for repo_id,success,dl_time in attempt_list))
+			self.cursor.executemany('''UPDATE repositories SET updated_at=COALESCE(?,CURRENT_TIMESTAMP), cloned=1 WHERE id=?;''',
+				((dl_time,repo_id) for repo_id,success,dl_time in attempt_list if success))
+		if autocommit:
+			self.commit()
+
+	def get_read_connection(self):
+		'''
+		Returns the connection used by iter_query.
+		For PostgreSQL, it is a second connection, opened at first use, so that reading happens in its own transaction and the main connection can write and commit meanwhile.
+		For SQLite, it is the main connection: a reader on another connection would hold a lock preventing the commits of the main one.
+		'''
+		if self.db_type == 'postgres':
+			if self.read_connection is None or self.read_connection.closed:
+				self.read_connection = psycopg2.connect(user=self.db_conninfo['db_user'],port=self.db_conninfo['port'],host=self.db_conninfo['host'],database=self.db_conninfo['db_name'],password=self.db_conninfo['password'])
+			return self.read_connection
+		else:
+			return self.connection
+
+	def iter_query(self,query,params=None,chunk_size=1000):
+		'''
+		Generator over the results of a query, fetched chunk_size rows at a time, so that memory usage and time to first result do not depend on the size of the result.
+		PostgreSQL uses a server-side (named) cursor, SQLite a dedicated cursor with fetchmany.
+		'''
+		connection = self.get_read_connection()
+		if self.db_type == 'postgres':
+			self.cursor_count += 1
+			cursor = connection.cursor(name='repo_tools_iter_{}_{}'.format(id(self),self.cursor_count))
+			cursor.itersize = chunk_size
+		else:
+			cursor = connection.cursor()
+		self.open_iterators += 1
+		try:
+			if params is None:
+				cursor.execute(query)
+			else:
+				cursor.execute(query,params)
+			while True:
+				rows = cursor.fetchmany(chunk_size)
+				if not rows:
+					break
+				for r in rows:
+					yield r
+		finally:
+			cursor.close()
+			self.open_iterators -= 1
+			# ending the read transaction once no other iterator uses it, so that later reads see new data
+			if self.db_type == 'postgres' and self.open_iterators == 0:
+				connection.rollback()
+
+	def repo_list_query(self,option='all'):
+		'''
+		Returns the query, parameters and row formatter (None to keep tuples) used by get_repo_list and iter_repo_list for a given option
+		'''
+		params = None
 		if option == 'all':
-			self.cursor.execute('''
+			query = '''
 				SELECT s.name,s.url_root,r.owner,r.name
 				FROM repositories r
 				INNER JOIN sources s
 				ON s.id=r.source
 				ORDER BY s.name,r.owner,r.name
-				;''')
-			return list(self.cursor.fetchall())
+				;'''
+			formatter = None
 		elif option == 'only_cloned':
-			self.cursor.execute('''
+			query = '''
 				SELECT s.name,s.url_root,r.owner,r.name
 				FROM repositories r
 				INNER JOIN sources s
 				ON s.id=r.source AND r.cloned
 				ORDER BY s.name,r.owner,r.name
-				;''')
-			return list(self.cursor.fetchall())
+				;'''
+			formatter = None
 		elif option == 'only_not_cloned':
-			self.cursor.execute('''
+			query = '''
 				SELECT s.name,s.url_root,r.owner,r.name
 				FROM repositories r
 				INNER JOIN sources s
 				ON s.id=r.source AND NOT r.cloned
 				ORDER BY s.name,r.owner,r.name
-				;''')
-			return list(self.cursor.fetchall())
+				;'''
+			formatter = None
+		elif option == 'retry_failed':
+			# not cloned, without failure or with a failure due for retry (permanent ones after max_retry_delay)
+			query = '''
+				SELECT s.name,s.url_root,r.owner,r.name
+				FROM repositories r
+				INNER JOIN sources s
+				ON s.id=r.source AND NOT r.cloned
+				LEFT JOIN clone_failures cf
+				ON cf.repo_id=r.id
+				WHERE cf.repo_id IS NULL OR cf.next_retry_at <= CURRENT_TIMESTAMP
+				ORDER BY s.name,r.owner,r.name
+				;'''
+			formatter = None
 		elif option == 'basicinfo_dict':
-			self.cursor.execute('''
+			query = '''
 				SELECT s.name,r.owner,r.name,r.id
 				FROM repositories r
 				INNER JOIN sources s
 				ON s.id=r.source
 				ORDER BY s.name,r.owner,r.name
-				;''')
-			return [{'source':r[0],'owner':r[1],'name':r[2],'repo_id':r[3]} for r in self.cursor.fetchall()]
+				;'''
+			formatter = lambda r: {'source':r[0],'owner':r[1],'name':r[2],'repo_id':r[3]}
 
 		elif option == 'basicinfo_dict_time':
 			if self.db_type == 'postgres':
-				self.cursor.execute('''
+				query = '''
 					SELECT s.name,r.owner,r.name,r.id,extract(epoch from r.latest_commit_time)
 					FROM repositories r
 					INNER JOIN sources s
 					ON s.id=r.source
 					ORDER BY s.name,r.owner,r.name
-					;''')
+					;'''
 			else:
-				self.cursor.execute('''
+				query = '''
 					SELECT s.name,r.owner,r.name,r.id,CAST(strftime('%s', r.latest_commit_time) AS INTEGER)
 					FROM repositories r
 					INNER JOIN sources s
 					ON s.id=r.source
 					ORDER BY s.name,r.owner,r.name
-					;''')
+					;'''
 
-			return [{'source':r[0],'owner':r[1],'name':r[2],'repo_id':r[3],'after_time':r[4]} for r in self.cursor.fetchall()]
+			formatter = lambda r: {'source':r[0],'owner':r[1],'name':r[2],'repo_id':r[3],'after_time':r[4]}
 		elif option == 'basicinfo_dict_cloned':
-			self.cursor.execute('''
+			query = '''
 				SELECT s.name,r.owner,r.name,r.id
 				FROM repositories r
 				INNER JOIN sources s
 				ON s.id=r.source AND r.cloned
 				ORDER BY s.name,r.owner,r.name
-				;''')
-			return [{'source':r[0],'owner':r[1],'name':r[2],'repo_id':r[3]} for r in self.cursor.fetchall()]
+				;'''
+			formatter = lambda r: {'source':r[0],'owner':r[1],'name':r[2],'repo_id':r[3]}
+
+		elif option == 'clone_usage':
+			# last clone/fetch and commits ingestion, ingested meaning that commits were filled after the last successful clone/fetch
+			query = '''
+				SELECT s.name,r.owner,r.name,r.id,tc.updated_at,tcm.updated_at,
+					(tcm.last_success_at IS NOT NULL AND (tc.last_success_at IS NULL OR tcm.last_success_at >= tc.last_success_at))
+				FROM repositories r
+				INNER JOIN sources s
+				ON s.id=r.source AND r.cloned
+				LEFT JOIN table_updates_latest tc
+				ON tc.repo_id=r.id AND tc.identity_id IS NULL AND tc.table_name='clones'
+				LEFT JOIN table_updates_latest tcm
+				ON tcm.repo_id=r.id AND tcm.identity_id IS NULL AND tcm.table_name='commits'
+				ORDER BY s.name,r.owner,r.name
+				;'''
+			formatter = lambda r: {'source':r[0],'owner':r[1],'name':r[2],'repo_id':r[3],'last_access':max([t for t in r[4:6] if t is not None],default=None),'ingested':bool(r[6])}
 
 		elif option == 'basicinfo_dict_time_cloned':
 			if self.db_type == 'postgres':
-				self.cursor.execute('''
+				query = '''
 					SELECT s.name,r.owner,r.name,r.id,extract(epoch from r.latest_commit_time)
 					FROM repositories r
 					INNER JOIN sources s
 					ON s.id=r.source AND r.cloned
 					ORDER BY s.name,r.owner,r.name
-					;''')
+					;'''
 			else:
-				self.cursor.execute('''
+				query = '''
 					SELECT s.name,r.owner,r.name,r.id,CAST(strftime('%s', r.latest_commit_time) AS INTEGER)
 					FROM repositories r
 					INNER JOIN sources s
 					ON s.id=r.source AND r.cloned
 					ORDER BY s.name,r.owner,r.name
-					;''')
+					;'''
 
-			return [{'source':r[0],'owner':r[1],'name':r[2],'repo_id':r[3],'after_time':r[4]} for r in self.cursor.fetchall()]
+			formatter = lambda r: {'source':r[0],'owner':r[1],'name':r[2],'repo_id':r[3],'after_time':r[4]}
 
 		elif option == 'starinfo_dict':
-			self.cursor.execute('''
+			query = '''
 				SELECT s.name,r.owner,r.name,r.id,tu.updated_at
 				FROM repositories r
 				INNER JOIN sources s
 				ON s.id=r.source
-				LEFT OUTER JOIN table_updates tu
-				ON tu.repo_id=r.id AND tu.table_name='stars'
+				LEFT OUTER JOIN table_updates_latest tu
+				ON tu.repo_id=r.id AND tu.identity_id IS NULL AND tu.table_name='stars'
 				ORDER BY s.name,r.owner,r.name
-				;''')
-			return [{'source':r[0],'owner':r[1],'name':r[2],'repo_id':r[3],'last_star_update':r[4]} for r in self.cursor.fetchall()]
+				;'''
+			formatter = lambda r: {'source':r[0],'owner':r[1],'name':r[2],'repo_id':r[3],'last_star_update':r[4]}
 
 		elif option == 'starinfo':
-			self.cursor.execute('''
+			query = '''
 				SELECT s.name,r.owner,r.name,r.id,tu.updated_at,tu.success
 				FROM repositories r
 				INNER JOIN sources s
 				ON s.id=r.source
-				LEFT OUTER JOIN table_updates tu
-				ON tu.repo_id=r.id AND tu.table_name='stars'
+				LEFT OUTER JOIN table_updates_latest tu
+				ON tu.repo_id=r.id AND tu.identity_id IS NULL AND tu.table_name='stars'
 				ORDER BY s.name,r.owner,r.name
-				;''')
-			return list(self.cursor.fetchall())
+				;'''
+			formatter = None
 
 		elif option == 'forkinfo':
-			self.cursor.execute('''
+			query = '''
 				SELECT s.name,r.owner,r.name,r.id,tu.updated_at,tu.success
 				FROM repositories r
 				INNER JOIN sources s
 				ON s.id=r.source
-				LEFT OUTER JOIN table_updates tu
-				ON tu.repo_id=r.id AND tu.table_name='forks'
+				LEFT OUTER JOIN table_updates_latest tu
+				ON tu.repo_id=r.id AND tu.identity_id IS NULL AND tu.table_name='forks'
 				ORDER BY s.name,r.owner,r.name
-				;''')
-			return list(self.cursor.fetchall())
+				;'''
+			formatter = None
 
 		elif option == 'no_dl':
 
-			self.cursor.execute('''
+			query = '''
 				SELECT s.name,s.url_root,r.owner,r.name
 				FROM repositories r
 				INNER JOIN sources s
 				ON s.id=r.source
-				LEFT JOIN table_updates tu
-				ON tu.repo_id=r.id AND tu.table_name='clones'
-				GROUP BY s.name,s.url_root,r.owner,r.name
-				HAVING COUNT(tu.repo_id)=0
+				LEFT JOIN table_updates_latest tu
+				ON tu.repo_id=r.id AND tu.identity_id IS NULL AND tu.table_name='clones'
+				WHERE tu.repo_id IS NULL
 				ORDER BY s.name,r.owner,r.name
 
-				;''')
-			return list(self.cursor.fetchall())
+				;'''
+			formatter = None
+
+		elif option == 'updateinfo':
+			# ages in seconds of the last successful clone/fetch and of the latest commit, number of stars in the last 30 days
+			if self.db_type == 'postgres':
+				query = '''
+					SELECT s.name,s.url_root,r.owner,r.name,
+						EXTRACT(EPOCH FROM (LOCALTIMESTAMP - tu.last_success_at)),
+						EXTRACT(EPOCH FROM (LOCALTIMESTAMP - r.latest_commit_time)),
+						(SELECT COUNT(*) FROM stars st WHERE st.repo_id=r.id AND st.starred_at > LOCALTIMESTAMP - INTERVAL '30 days')
+					FROM repositories r
+					INNER JOIN sources s
+					ON s.id=r.source
+					LEFT JOIN table_updates_latest tu
+					ON tu.repo_id=r.id AND tu.identity_id IS NULL AND tu.table_name='clones'
+					ORDER BY s.name,r.owner,r.name
+					;'''
+			else:
+				query = '''
+					SELECT s.name,s.url_root,r.owner,r.name,
+						CAST(strftime('%s','now') AS INTEGER) - CAST(strftime('%s',tu.last_success_at) AS INTEGER),
+						CAST(strftime('%s','now') AS INTEGER) - CAST(strftime('%s',r.latest_commit_time) AS INTEGER),
+						(SELECT COUNT(*) FROM stars st WHERE st.repo_id=r.id AND st.starred_at > datetime('now','-30 days'))
+					FROM repositories r
+					INNER JOIN sources s
+					ON s.id=r.source
+					LEFT JOIN table_updates_latest tu
+					ON tu.repo_id=r.id AND tu.identity_id IS NULL AND tu.table_name='clones'
+					ORDER BY s.name,r.owner,r.name
+					;'''
+			formatter = lambda r: {'source':r[0],'source_urlroot':r[1],'owner':r[2],'name':r[3],'fetch_age':r[4],'commit_age':r[5],'recent_stars':r[6]}
 
 		else:
 			raise ValueError('Unknown option for repo_list: {}'.format(option))
+		return query,params,formatter
+
+	def get_repo_list(self,option='all'):
+		'''
+		Getting a list of source,source_urlroot,owner,name
+		'''
+		query,params,formatter = self.repo_list_query(option=option)
+		if params is None:
+			self.cursor.execute(query)
+		else:
+			self.cursor.execute(query,params)
+		if formatter is None:
+			return list(self.cursor.fetchall())
+		else:
+			return [formatter(r) for r in self.cursor.fetchall()]
+
+	def iter_repo_list(self,option='all',chunk_size=1000):
+		'''
+		Same as get_repo_list, but returns a generator streaming the results (see iter_query)
+		'''
+		query,params,formatter = self.repo_list_query(option=option)
+		for r in self.iter_query(query=query,params=params,chunk_size=chunk_size):
+			if formatter is None:
+				yield r
+			else:
+				yield formatter(r)
 
 	def get_user_id(self,login):
 		'''
@@ -900,41 +1455,41 @@ class Database(object):
 			return ans[0]
 
 
-	def get_user_list(self,option='all',time_delay=24*3600):
+	def user_list_query(self,option='all',time_delay=24*3600):
 		'''
-		Getting a list of users depending on different conditions and patterns
-		time delay is used only for getting the followers, is in seconds, and returns logins that dont have a value for followers from less then 'time_delay' seconds ago
+		Returns the query, parameters and row formatter (None to keep tuples) used by get_user_list and iter_user_list for a given option
 		'''
+		params = None
 		if option == 'all':
-			self.cursor.execute('''
+			query = '''
 				SELECT u.id,u.email,u.github_login
 				FROM users u
-				;''')
-			return list(self.cursor.fetchall())
+				;'''
+			formatter = None
 		elif option == 'id_sha_all':
 			if self.db_type == 'postgres':
-				self.cursor.execute('''
+				query = '''
 					SELECT u.id,c.repo_id,c.sha
 					FROM users u
 					JOIN LATERAL (SELECT cc.sha,cc.repo_id FROM commits cc
 						WHERE cc.author_id=u.id ORDER BY cc.created_at DESC LIMIT 1) AS c
 					ON u.github_login IS NULL
-					;''')
+					;'''
 			else:
-				self.cursor.execute('''
+				query = '''
 					SELECT u.id,c.repo_id,c.sha
 					FROM users u
 					JOIN commits c
 						ON u.github_login IS NULL AND
 						c.id IN (SELECT cc.id FROM commits cc
 							WHERE cc.author_id=u.id ORDER BY cc.created_at DESC LIMIT 1)
-					;''')
+					;'''
 
-			return list(self.cursor.fetchall())
+			formatter = None
 
 		elif option == 'id_sha':
 			if self.db_type == 'postgres':
-				self.cursor.execute('''
+				query = '''
 					SELECT u.id,c.repo_id,c.sha
 					FROM (
 						SELECT uu.id FROM
@@ -948,9 +1503,9 @@ class Database(object):
 					JOIN LATERAL (SELECT cc.sha,cc.repo_id FROM commits cc
 						WHERE cc.author_id=u.id ORDER BY cc.created_at DESC LIMIT 1) AS c
 					ON true
-					;''')
+					;'''
 			else:
-				self.cursor.execute('''
+				query = '''
 					SELECT u.id,c.repo_id,c.sha
 					FROM (
 						SELECT uu.id FROM
@@ -965,13 +1520,13 @@ class Database(object):
 						ON
 						c.id IN (SELECT cc.id FROM commits cc
 							WHERE cc.author_id=u.id ORDER BY cc.created_at DESC LIMIT 1)
-					;''')
-			return list(self.cursor.fetchall())
+					;'''
+			formatter = None
 
 
 		elif option == 'id_sha_repoinfo_all':
 			if self.db_type == 'postgres':
-				self.cursor.execute('''
+				query = '''
 					SELECT u.id,c.repo_id,r.owner,r.name,c.sha
 					FROM users u
 					JOIN LATERAL (SELECT cc.sha,cc.repo_id FROM commits cc
@@ -979,9 +1534,9 @@ class Database(object):
 					ON u.github_login IS NULL
 					INNER JOIN repositories r
 					ON r.id=c.repo_id
-					;''')
+					;'''
 			else:
-				self.cursor.execute('''
+				query = '''
 					SELECT u.id,c.repo_id,r.owner,r.name,c.sha
 					FROM users u
 					JOIN commits c
@@ -990,13 +1545,13 @@ class Database(object):
 							WHERE cc.author_id=u.id ORDER BY cc.created_at DESC LIMIT 1)
 					INNER JOIN repositories r
 					ON r.id=c.repo_id
-					;''')
+					;'''
 
-			return list(self.cursor.fetchall())
+			formatter = None
 
 		elif option == 'id_sha_repoinfo':
 			if self.db_type == 'postgres':
-				self.cursor.execute('''
+				query = '''
 					SELECT u.id,c.repo_id,r.owner,r.name,c.sha
 					FROM (
 						SELECT uu.id FROM
@@ -1012,9 +1567,9 @@ class Database(object):
 					ON true
 					INNER JOIN repositories r
 					ON r.id=c.repo_id
-					;''')
+					;'''
 			else:
-				self.cursor.execute('''
+				query = '''
 					SELECT u.id,c.repo_id,r.owner,r.name,c.sha
 					FROM (
 						SELECT uu.id FROM
@@ -1031,12 +1586,12 @@ class Database(object):
 							WHERE cc.author_id=u.id ORDER BY cc.created_at DESC LIMIT 1)
 					INNER JOIN repositories r
 					ON r.id=c.repo_id
-					;''')
-			return list(self.cursor.fetchall())
+					;'''
+			formatter = None
 
 		elif option == 'logins':
 			if self.db_type == 'postgres':
-				self.cursor.execute('''
+				query = '''
 					SELECT u.github_login FROM
 						(SELECT DISTINCT uu.github_login FROM users uu
 						WHERE uu.github_login IS NOT NULL) AS u
@@ -1045,9 +1600,10 @@ class Database(object):
 					AND now() - f.created_at < %s*'1 second'::interval
 					GROUP BY u.github_login,f.github_login
 					HAVING f.github_login IS NULL
-					;''',(time_delay,))
+					;'''
+				params = (time_delay,)
 			else:
-				self.cursor.execute('''
+				query = '''
 					SELECT u.github_login FROM
 						(SELECT DISTINCT uu.github_login FROM users uu
 						WHERE uu.github_login IS NOT NULL) AS u
@@ -1056,12 +1612,40 @@ class Database(object):
 					AND (julianday('now') - julianday(f.created_at))*24*3600 < ?
 					GROUP BY u.github_login,f.github_login
 					HAVING f.github_login IS NULL
-					;''',(time_delay,))
+					;'''
+				params = (time_delay,)
 
-			return [r[0] for r in self.cursor.fetchall()]
+			formatter = lambda r: r[0]
 
 		else:
 			raise ValueError('Unknown option for user_list: {}'.format(option))
+		return query,params,formatter
+
+	def get_user_list(self,option='all',time_delay=24*3600):
+		'''
+		Getting a list of users depending on different conditions and patterns
+		time delay is used only for getting the followers, is in seconds, and returns logins that dont have a value for followers from less then 'time_delay' seconds ago
+		'''
+		query,params,formatter = self.user_list_query(option=option,time_delay=time_delay)
+		if params is None:
+			self.cursor.execute(query)
+		else:
+			self.cursor.execute(query,params)
+		if formatter is None:
+			return list(self.cursor.fetchall())
+		else:
+			return [formatter(r) for r in self.cursor.fetchall()]
+
+	def iter_user_list(self,option='all',time_delay=24*3600,chunk_size=1000):
+		'''
+		Same as get_user_list, but returns a generator streaming the results (see iter_query)
+		'''
+		query,params,formatter = self.user_list_query(option=option,time_delay=time_delay)
+		for r in self.iter_query(query=query,params=params,chunk_size=chunk_size):
+			if formatter is None:
+				yield r
+			else:
+				yield formatter(r)
 
 
 
@@ -1101,14 +1685,11 @@ class Database(object):
 		if not tracked_data['empty']:
 			repo_id = tracked_data['last_commit']['repo_id']
 			latest_commit_time = datetime.datetime.fromtimestamp(tracked_data['latest_commit_time'])
-			if self.db_type == 'postgres':
-				self.cursor.execute('''INSERT INTO table_updates(repo_id,table_name,latest_commit_time) VALUES(%s,'users',%s) ;''',(repo_id,latest_commit_time))
-			else:
-				self.cursor.execute('''INSERT INTO table_updates(repo_id,table_name,latest_commit_time) VALUES(?,'users',?) ;''',(repo_id,latest_commit_time))
+			self.insert_update(table='users',repo_id=repo_id,latest_commit_time=latest_commit_time,autocommit=False)
 
 
 		if autocommit:
-			self.connection.commit()
+			self.commit()
 
 	def fill_commits(self,commit_info_list,autocommit=True):
 		'''
@@ -1152,15 +1733,12 @@ class Database(object):
 		if not tracked_data['empty']:
 			repo_id = tracked_data['last_commit']['repo_id']
 			latest_commit_time = datetime.datetime.fromtimestamp(tracked_data['latest_commit_time'])
-			if self.db_type == 'postgres':
-				self.cursor.execute('''INSERT INTO table_updates(repo_id,table_name,latest_commit_time) VALUES(%s,'commits',%s) ;''',(repo_id,latest_commit_time))
-			else:
-				self.cursor.execute('''INSERT INTO table_updates(repo_id,table_name,latest_commit_time) VALUES(?,'commits',?) ;''',(repo_id,latest_commit_time))
+			self.insert_update(table='commits',repo_id=repo_id,latest_commit_time=latest_commit_time,autocommit=False)
 
 
 
 		if autocommit:
-			self.connection.commit()
+			self.commit()
 
 	def fill_commit_parents(self,commit_info_list,autocommit=True):
 		'''
@@ -1200,16 +1778,15 @@ class Database(object):
 		if not tracked_data['empty']:
 			repo_id = tracked_data['last_commit']['repo_id']
 			latest_commit_time = datetime.datetime.fromtimestamp(tracked_data['latest_commit_time'])
+			self.insert_update(table='commit_parents',repo_id=repo_id,latest_commit_time=latest_commit_time,autocommit=False)
 			if self.db_type == 'postgres':
-				self.cursor.execute('''INSERT INTO table_updates(repo_id,table_name,latest_commit_time) VALUES(%s,'commit_parents',%s) ;''',(repo_id,latest_commit_time))
 				self.cursor.execute('''UPDATE repositories SET latest_commit_time=%s WHERE id=%s;''',(latest_commit_time,repo_id))
 			else:
-				self.cursor.execute('''INSERT INTO table_updates(repo_id,table_name,latest_commit_time) VALUES(?,'commit_parents',?) ;''',(repo_id,latest_commit_time))
 				self.cursor.execute('''UPDATE repositories SET latest_commit_time=? WHERE id=?;''',(latest_commit_time,repo_id))
 
 
 		if autocommit:
-			self.connection.commit()
+			self.commit()
 
 
 	def fill_followers(self,followers_info_list,autocommit=True):
@@ -1228,7 +1805,7 @@ class Database(object):
 				VALUES(?,?)
 				;''',followers_info_list)
 		if autocommit:
-			self.connection.commit()
+			self.commit()
 
 	def create_indexes(self,table=None):
 		'''
@@ -1253,7 +1830,179 @@ class Database(object):
 		elif table == 'commit_parents' or table is None:
 			self.logger.info('Creating indexes for table commit_parents')
 			pass
-		self.connection.commit()
+		self.commit()
+
+	def compact_table_updates(self,older_than=365*24*3600,archive_file=None):
+		'''
+		Compacting the table_updates log: rows older than older_than seconds are counted in table_updates_summary (per repository or identity, and table_name),
+		then moved to table_updates_archive, or appended to the CSV file archive_file if provided.
+
+		The latest row and the latest successful row of each (repository or identity, table_name) are always kept, so that watermarks read from the log are preserved.
+		Returns the number of rows compacted.
+		'''
+		self.cursor.execute('''DROP TABLE IF EXISTS compacted_updates;''')
+		self.cursor.execute('''CREATE TEMP TABLE compacted_updates(id BIGINT PRIMARY KEY);''')
+		selection_query = '''
+			INSERT INTO compacted_updates(id)
+			SELECT t.id FROM (
+				SELECT tu.id,tu.updated_at,tu.success,
+					ROW_NUMBER() OVER (PARTITION BY tu.repo_id,CASE WHEN tu.repo_id IS NULL THEN tu.identity_id ELSE NULL END,tu.table_name ORDER BY tu.updated_at DESC,tu.id DESC) AS rn,
+					ROW_NUMBER() OVER (PARTITION BY tu.repo_id,CASE WHEN tu.repo_id IS NULL THEN tu.identity_id ELSE NULL END,tu.table_name,tu.success ORDER BY tu.updated_at DESC,tu.id DESC) AS rn_success
+				FROM table_updates tu
+				WHERE tu.repo_id IS NOT NULL OR tu.identity_id IS NOT NULL
+				) AS t
+			WHERE t.rn>1 AND NOT (t.success AND t.rn_success=1)
+			'''
+		if self.db_type == 'postgres':
+			self.cursor.execute(selection_query+''' AND t.updated_at < CURRENT_TIMESTAMP - %s*'1 second'::interval;''',(older_than,))
+		else:
+			self.cursor.execute(selection_query+''' AND (julianday('now') - julianday(t.updated_at))*24*3600 > ?;''',(older_than,))
+		self.cursor.execute('''SELECT COUNT(*) FROM compacted_updates;''')
+		nb_rows = self.cursor.fetchone()[0]
+
+		if nb_rows:
+			# (selected columns,grouping column,condition,conflict target); constants are not allowed in the GROUP BY clause by PostgreSQL
+			if self.db_type == 'postgres':
+				null_id = 'NULL::bigint'
+			else:
+				null_id = 'NULL'
+			entities = (
+				('tu.repo_id,{}'.format(null_id),'tu.repo_id','tu.repo_id IS NOT NULL','(repo_id,table_name) WHERE identity_id IS NULL'),
+				('{},tu.identity_id'.format(null_id),'tu.identity_id','tu.repo_id IS NULL','(identity_id,table_name) WHERE repo_id IS NULL'),
+				)
+			for entity,entity_group,entity_condition,conflict_target in entities:
+				if self.db_type == 'postgres':
+					self.cursor.execute('''
+						INSERT INTO table_updates_summary(repo_id,identity_id,table_name,updates_count,success_count,first_update_at,last_update_at,last_success_at)
+						SELECT {entity},tu.table_name,COUNT(*),SUM(CASE WHEN tu.success THEN 1 ELSE 0 END),MIN(tu.updated_at),MAX(tu.updated_at),MAX(CASE WHEN tu.success THEN tu.updated_at ELSE NULL END)
+						FROM table_updates tu
+						INNER JOIN compacted_updates c
+						ON c.id=tu.id AND {entity_condition}
+						GROUP BY {entity_group},tu.table_name
+						ON CONFLICT {conflict_target} DO UPDATE SET
+							updates_count=table_updates_summary.updates_count+EXCLUDED.updates_count,
+							success_count=table_updates_summary.success_count+EXCLUDED.success_count,
+							first_update_at=LEAST(table_updates_summary.first_update_at,EXCLUDED.first_update_at),
+							last_update_at=GREATEST(table_updates_summary.last_update_at,EXCLUDED.last_update_at),
+							last_success_at=GREATEST(table_updates_summary.last_success_at,EXCLUDED.last_success_at)
+						;'''.format(entity=entity,entity_group=entity_group,entity_condition=entity_condition,conflict_target=conflict_target))
+				else:
+					self.cursor.execute('''
+						INSERT INTO table_updates_summary(repo_id,identity_id,table_name,updates_count,success_count,first_update_at,last_update_at,last_success_at)
+						SELECT {entity},tu.table_name,COUNT(*),SUM(CASE WHEN tu.success THEN 1 ELSE 0 END),MIN(tu.updated_at),MAX(tu.updated_at),MAX(CASE WHEN tu.success THEN tu.updated_at ELSE NULL END)
+						FROM table_updates tu
+						INNER JOIN compacted_updates c
+						ON c.id=tu.id
+						WHERE {entity_condition} -- WHERE clause needed for the upsert syntax to be parsed by SQLite
+						GROUP BY {entity_group},tu.table_name
+						ON CONFLICT {conflict_target} DO UPDATE SET
+							updates_count=table_updates_summary.updates_count+EXCLUDED.updates_count,
+							success_count=table_updates_summary.success_count+EXCLUDED.success_count,
+							first_update_at=MIN(table_updates_summary.first_update_at,EXCLUDED.first_update_at),
+							last_update_at=MAX(table_updates_summary.last_update_at,EXCLUDED.last_update_at),
+							last_success_at=MAX(COALESCE(table_updates_summary.last_success_at,EXCLUDED.last_success_at),COALESCE(EXCLUDED.last_success_at,table_updates_summary.last_success_at))
+						;'''.format(entity=entity,entity_group=entity_group,entity_condition=entity_condition,conflict_target=conflict_target))
+
+			if archive_file is None:
+				self.cursor.execute('''
+					INSERT INTO table_updates_archive(id,repo_id,identity_id,table_name,updated_at,success,latest_commit_time)
+					SELECT tu.id,tu.repo_id,tu.identity_id,tu.table_name,tu.updated_at,tu.success,tu.latest_commit_time
+					FROM table_updates tu
+					INNER JOIN compacted_updates c
+					ON c.id=tu.id
+					;''')
+			else:
+				write_header = not os.path.exists(archive_file)
+				with open(archive_file,'a',newline='') as f:
+					writer = csv.writer(f)
+					if write_header:
+						writer.writerow(['id','repo_id','identity_id','table_name','updated_at','success','latest_commit_time'])
+					self.cursor.execute('''
+						SELECT tu.id,tu.repo_id,tu.identity_id,tu.table_name,tu.updated_at,tu.success,tu.latest_commit_time
+						FROM table_updates tu
+						INNER JOIN compacted_updates c
+						ON c.id=tu.id
+						ORDER BY tu.id
+						;''')
+					while True:
+						rows = self.cursor.fetchmany(1000)
+						if not rows:
+							break
+						writer.writerows(rows)
+
+			self.cursor.execute('''DELETE FROM table_updates WHERE id IN (SELECT id FROM compacted_updates);''')
+		self.cursor.execute('''DROP TABLE compacted_updates;''')
+		self.commit()
+		logger.info('Compacted {} rows of table_updates'.format(nb_rows))
+		return nb_rows
+
+	def get_last_full_update(self,update_type):
+		'''
+		Returns the time of the last full update of a given type (from the full_updates table), None if there is none
+		'''
+		if self.db_type == 'postgres':
+			self.cursor.execute('''SELECT MAX(updated_at) FROM full_updates WHERE update_type=%s;''',(update_type,))
+		else:
+			self.cursor.execute('''SELECT MAX(updated_at) FROM full_updates WHERE update_type=?;''',(update_type,))
+		return self.cursor.fetchone()[0]
+
+	def record_full_update(self,update_type,updated_at=None,autocommit=True):
+		'''
+		Records a full update of a given type, updated_at defaults to the current time
+		'''
+		if self.db_type == 'postgres':
+			self.cursor.execute('''INSERT INTO full_updates(update_type,updated_at) VALUES(%s,COALESCE(%s,CURRENT_TIMESTAMP));''',(update_type,updated_at))
+		else:
+			self.cursor.execute('''INSERT INTO full_updates(update_type,updated_at) VALUES(?,COALESCE(?,CURRENT_TIMESTAMP));''',(update_type,updated_at))
+		if autocommit:
+			self.commit()
+
+	def record_clone_failure(self,repo_id,permanent,error=None,retry_delay=3600,max_retry_delay=30*86400,autocommit=True):
+		'''
+		Records a failed clone or fetch of a repository, incrementing its number of attempts.
+		Transient failures can be retried after retry_delay*2**(attempts-1) seconds, at most max_retry_delay, permanent failures after max_retry_delay.
+		Returns the number of consecutive failed attempts.
+		'''
+		if self.db_type == 'postgres':
+			self.cursor.execute('''INSERT INTO clone_failures(repo_id,permanent,attempts,error,last_attempt_at)
+				VALUES(%s,%s,1,%s,CURRENT_TIMESTAMP)
+				ON CONFLICT(repo_id) DO UPDATE SET
+					permanent=EXCLUDED.permanent,
+					attempts=clone_failures.attempts+1,
+					error=EXCLUDED.error,
+					last_attempt_at=EXCLUDED.last_attempt_at
+				;''',(repo_id,permanent,error))
+			self.cursor.execute('''SELECT attempts FROM clone_failures WHERE repo_id=%s;''',(repo_id,))
+			attempts = self.cursor.fetchone()[0]
+			delay = max_retry_delay if permanent else min(retry_delay*2**(attempts-1),max_retry_delay)
+			self.cursor.execute('''UPDATE clone_failures SET next_retry_at=last_attempt_at+%s*INTERVAL '1 second' WHERE repo_id=%s;''',(delay,repo_id))
+		else:
+			self.cursor.execute('''INSERT INTO clone_failures(repo_id,permanent,attempts,error,last_attempt_at)
+				VALUES(?,?,1,?,CURRENT_TIMESTAMP)
+				ON CONFLICT(repo_id) DO UPDATE SET
+					permanent=EXCLUDED.permanent,
+					attempts=clone_failures.attempts+1,
+					error=EXCLUDED.error,
+					last_attempt_at=EXCLUDED.last_attempt_at
+				;''',(repo_id,permanent,error))
+			self.cursor.execute('''SELECT attempts FROM clone_failures WHERE repo_id=?;''',(repo_id,))
+			attempts = self.cursor.fetchone()[0]
+			delay = max_retry_delay if permanent else min(retry_delay*2**(attempts-1),max_retry_delay)
+			self.cursor.execute('''UPDATE clone_failures SET next_retry_at=datetime(last_attempt_at,'+'||?||' seconds') WHERE repo_id=?;''',(delay,repo_id))
+		if autocommit:
+			self.commit()
+		return attempts
+
+	def clear_clone_failure(self,repo_id,autocommit=True):
+		'''
+		Forgets past failures of a repository, after a successful clone or fetch
+		'''
+		if self.db_type == 'postgres':
+			self.cursor.execute('''DELETE FROM clone_failures WHERE repo_id=%s;''',(repo_id,))
+		else:
+			self.cursor.execute('''DELETE FROM clone_failures WHERE repo_id=?;''',(repo_id,))
+		if autocommit:
+			self.commit()
 
 	def get_last_dl(self,repo_id,success=None):
 		'''
@@ -1261,19 +2010,33 @@ class Database(object):
 		success None: no selection on success
 		succes bool: selection on success
 		'''
-		if self.db_type == 'postgres':
+		if success is None or success:
+			column = 'updated_at' if success is None else 'last_success_at'
+			if self.db_type == 'postgres':
+				self.cursor.execute('''
+					SELECT {}
+						FROM table_updates_latest
+						WHERE repo_id=%s AND identity_id IS NULL AND table_name='clones'
+					;'''.format(column),(repo_id,))
+			else:
+				self.cursor.execute('''
+					SELECT {}
+						FROM table_updates_latest
+						WHERE repo_id=? AND identity_id IS NULL AND table_name='clones'
+					;'''.format(column),(repo_id,))
+		elif self.db_type == 'postgres':
 			self.cursor.execute('''
 				SELECT MAX(updated_at)
 					FROM table_updates
-					WHERE repo_id=%s AND table_name='clones' AND (%s IS NULL OR success=%s)
-				;''',(repo_id,success,success))
+					WHERE repo_id=%s AND table_name='clones' AND success=%s
+				;''',(repo_id,success))
 		else:
 
 			self.cursor.execute('''
 				SELECT MAX(updated_at)
 					FROM table_updates
-					WHERE repo_id=? AND table_name='clones' AND (? IS NULL OR success=?)
-				;''',(repo_id,success,success))
+					WHERE repo_id=? AND table_name='clones' AND success=?
+				;''',(repo_id,success))
 		ans = self.cursor.fetchone()
 		if ans is not None:
 			return ans[0]
@@ -1282,14 +2045,20 @@ class Database(object):
 		'''
 		Returns source_urlroot if source exists, otherwise throws and error
 		'''
+		try:
+			return self.id_cache['sources'][source]
+		except KeyError:
+			pass
+		cursor = self.connection.cursor()
 		if self.db_type == 'postgres':
-			self.cursor.execute('SELECT id,url_root FROM sources WHERE name=%s;',(source,))
+			cursor.execute('SELECT id,url_root FROM sources WHERE name=%s;',(source,))
 		else:
-			self.cursor.execute('SELECT id,url_root FROM sources WHERE name=?;',(source,))
-		ans = self.cursor.fetchone()
+			cursor.execute('SELECT id,url_root FROM sources WHERE name=?;',(source,))
+		ans = cursor.fetchone()
 		if ans is None:
 			raise ValueError('Unregistered source {}'.format(source))
 		else:
+			self.id_cache['sources'][source] = ans
 			return ans
 
 	def get_last_star(self,source,repo,owner):
@@ -1377,33 +2146,90 @@ class Database(object):
 				;''',((s['starred_at'],s['login'],s['repo_id']) for s in stars_list))
 
 		if commit:
-			self.connection.commit()
+			self.commit()
 
 
-	def insert_update(self,table,repo_id=None,identity_id=None,success=True):
+	def insert_update(self,table,repo_id=None,identity_id=None,success=True,latest_commit_time=None,updated_at=None,autocommit=True):
 		'''
-		Inserting an update in table_updates
+		Inserting an update in table_updates, and keeping the corresponding row of table_updates_latest up to date
+		updated_at defaults to the current time
 		'''
 		if self.db_type == 'postgres':
-			self.cursor.execute('''INSERT INTO table_updates(repo_id,identity_id,table_name,success)
-				VALUES(%s,%s,%s,%s)
-				;''', (repo_id,identity_id,table,success))
+			self.cursor.execute('''INSERT INTO table_updates(repo_id,identity_id,table_name,success,latest_commit_time,updated_at)
+				VALUES(%s,%s,%s,%s,%s,COALESCE(%s,CURRENT_TIMESTAMP))
+				;''', (repo_id,identity_id,table,success,latest_commit_time,updated_at))
 		else:
-			self.cursor.execute('''INSERT INTO table_updates(repo_id,identity_id,table_name,success)
-				VALUES(?,?,?,?)
-				;''', (repo_id,identity_id,table,success))
-		self.connection.commit()
+			self.cursor.execute('''INSERT INTO table_updates(repo_id,identity_id,table_name,success,latest_commit_time,updated_at)
+				VALUES(?,?,?,?,?,COALESCE(?,CURRENT_TIMESTAMP))
+				;''', (repo_id,identity_id,table,success,latest_commit_time,updated_at))
+
+		# updates concerning both a repository and an identity are tracked for the repository
+		if repo_id is not None:
+			identity_id = None
+			conflict_target = '(repo_id,table_name) WHERE identity_id IS NULL'
+		else:
+			conflict_target = '(identity_id,table_name) WHERE repo_id IS NULL'
+		if repo_id is not None or identity_id is not None:
+			if self.db_type == 'postgres':
+				self.cursor.execute('''INSERT INTO table_updates_latest(repo_id,identity_id,table_name,success,latest_commit_time,updated_at,last_success_at)
+					VALUES(%s,%s,%s,%s,%s,COALESCE(%s,CURRENT_TIMESTAMP),CASE WHEN %s THEN COALESCE(%s,CURRENT_TIMESTAMP) ELSE NULL END)
+					ON CONFLICT {} DO UPDATE SET
+						success=EXCLUDED.success,
+						latest_commit_time=EXCLUDED.latest_commit_time,
+						updated_at=EXCLUDED.updated_at,
+						last_success_at=COALESCE(EXCLUDED.last_success_at,table_updates_latest.last_success_at)
+					WHERE table_updates_latest.updated_at <= EXCLUDED.updated_at
+					;'''.format(conflict_target), (repo_id,identity_id,table,success,latest_commit_time,updated_at,success,updated_at))
+			else:
+				self.cursor.execute('''INSERT INTO table_updates_latest(repo_id,identity_id,table_name,success,latest_commit_time,updated_at,last_success_at)
+					VALUES(?,?,?,?,?,COALESCE(?,CURRENT_TIMESTAMP),CASE WHEN ? THEN COALESCE(?,CURRENT_TIMESTAMP) ELSE NULL END)
+					ON CONFLICT {} DO UPDATE SET
+						success=EXCLUDED.success,
+						latest_commit_time=EXCLUDED.latest_commit_time,
+						updated_at=EXCLUDED.updated_at,
+						last_success_at=COALESCE(EXCLUDED.last_success_at,table_updates_latest.last_success_at)
+					WHERE table_updates_latest.updated_at <= EXCLUDED.updated_at
+					;'''.format(conflict_target), (repo_id,identity_id,table,success,latest_commit_time,updated_at,success,updated_at))
+		if autocommit:
+			self.commit()
 
-	def set_cloned(self,repo_id,autocommit=True):
+	def fill_table_updates_latest(self,force=False):
+		'''
+		Filling table_updates_latest from the table_updates log, with the latest update of each (repository or identity, table_name).
+		Done only if table_updates_latest is empty (e.g. on a database created before it existed), unless force is True.
+		'''
+		self.cursor.execute('''SELECT 1 FROM table_updates_latest LIMIT 1;''')
+		if self.cursor.fetchone() is not None:
+			if force:
+				self.cursor.execute('''DELETE FROM table_updates_latest;''')
+			else:
+				return
+		self.cursor.execute('''
+			INSERT INTO table_updates_latest(repo_id,identity_id,table_name,success,latest_commit_time,updated_at,last_success_at)
+			SELECT t.repo_id,t.identity_id,t.table_name,t.success,t.latest_commit_time,t.updated_at,t.last_success_at
+			FROM (
+				SELECT tu.repo_id,
+					CASE WHEN tu.repo_id IS NULL THEN tu.identity_id ELSE NULL END AS identity_id,
+					tu.table_name,tu.success,tu.latest_commit_time,tu.updated_at,
+					MAX(CASE WHEN tu.success THEN tu.updated_at ELSE NULL END) OVER (PARTITION BY tu.repo_id,CASE WHEN tu.repo_id IS NULL THEN tu.identity_id ELSE NULL END,tu.table_name) AS last_success_at,
+					ROW_NUMBER() OVER (PARTITION BY tu.repo_id,CASE WHEN tu.repo_id IS NULL THEN tu.identity_id ELSE NULL END,tu.table_name ORDER BY tu.updated_at DESC,tu.id DESC) AS rn
+				FROM table_updates tu
+				WHERE tu.repo_id IS NOT NULL OR tu.identity_id IS NOT NULL
+				) AS t
+			WHERE t.rn=1
+			;''')
+		self.commit(force=True)
+
+	def set_cloned(self,repo_id,cloned=True,autocommit=True):
 		'''
-		Setting cloned to true for a given repository
+		Setting cloned to true (or false, e.g. when the clone is removed) for a given repository
 		'''
 		if self.db_type == 'postgres':
-			self.cursor.execute('''UPDATE repositories SET cloned=true WHERE id=%s;''',(repo_id,))
+			self.cursor.execute('''UPDATE repositories SET cloned=%s WHERE id=%s;''',(cloned,repo_id))
 		else:
-			self.cursor.execute('''UPDATE repositories SET cloned=1 WHERE id=?;''',(repo_id,))
+			self.cursor.execute('''UPDATE repositories SET cloned=? WHERE id=?;''',(cloned,repo_id))
 		if autocommit:
-			self.connection.commit()
+			self.commit()
 
 	# def set_gh_login(self,user_id,login,autocommit=True):
 	# 	'''
@@ -1471,6 +2297,6 @@ class Database(object):
 
 
 		if autocommit:
-			self.connection.commit()
+			self.commit()
 
 
@@ -0,0 +1,94 @@
+'''
+Normalization of repository URLs into cleaned URLs https://<url_root>/<owner>/<name>, with the corresponding source id.
+
+Replaces the trial of every url_root in turn (repo_formatting): the host is parsed once and looked up in a dict of url roots,
+the path is canonicalized in one pass, and results are memoized.
+'''
+
+
+class UrlNormalizer(object):
+	'''
+	url_roots is a list of (source_id,url_root), as in the sources table.
+	Accepted URLs are url_root/, www.url_root/, and their http:// and https:// variants, followed by owner/name.
+	A trailing .git is removed from the name, as well as everything after owner/name.
+
+	Results are memoized, up to cache_size URLs (the cache is emptied when full).
+	'''
+	def __init__(self,url_roots,cache_size=10**6):
+		self.roots = {}
+		for source_id,url_root in url_roots:
+			# first source wins, as when trying roots in turn
+			self.roots.setdefault(url_root,source_id)
+		self.cache_size = cache_size
+		self.cache = {}
+
+	@classmethod
+	def from_db(cls,db,**kwargs):
+		'''
+		Builds a normalizer from the sources registered in the database
+		'''
+		db.cursor.execute('SELECT id,url_root FROM sources WHERE url_root IS NOT NULL;')
+		return cls(url_roots=list(db.cursor.fetchall()),**kwargs)
+
+	def normalize(self,url):
+		'''
+		Returns (cleaned_url,source_id), or (None,None) if the URL does not correspond to a known source or does not contain owner/name.
+		Returns None if url is None.
+		'''
+		if url is None:
+			return None
+		try:
+			return self.cache[url]
+		except KeyError:
+			pass
+		ans = self.parse(url)
+		if len(self.cache) >= self.cache_size:
+			self.cache = {}
+		self.cache[url] = ans
+		return ans
+
+	def parse(self,url):
+		'''
+		Parsing without memoization, see normalize
+		'''
+		if url.startswith('https://'):
+			rest = url[8:]
+		elif url.startswith('http://'):
+			rest = url[7:]
+		else:
+			rest = url
+		host,sep,path = rest.partition('/')
+		if not sep:
+			return None,None
+		if host in self.roots:
+			url_root = host
+		elif host.startswith('www.') and host[4:] in self.roots:
+			url_root = host[4:]
+		else:
+			return None,None
+		if url_root in path:
+			return None,None
+
+		components = [c for c in path.split('/') if c]
+		if len(components) < 2:
+			return None,None
+		owner,name = components[0],components[1]
+		if len(components) == 2 and name.endswith('.git'):
+			name = name[:-4]
+			if not name:
+				return None,None
+		return 'https://{}/{}/{}'.format(url_root,owner,name),self.roots[url_root]
+
+	def normalize_urls(self,url_list):
+		'''
+		Batch version of normalize, returns a list of (url,cleaned_url,source_id), the syntax expected by Database.register_urls.
+		None values in url_list are skipped.
+		'''
+		return [(url,*self.normalize(url)) for url in url_list if url is not None]
+
+
+def normalize_urls(url_list,url_roots):
+	'''
+	Normalizes a list of URLs with a given list of (source_id,url_root), see UrlNormalizer.normalize_urls
+	'''
+	return UrlNormalizer(url_roots=url_roots).normalize_urls(url_list)
@@ -36,6 +36,14 @@ def test_doublecleandb(testdb):
 	testdb.clean_db()
 	testdb.clean_db()
 
+def test_migrate_db(testdb):
+	testdb.cursor.execute('ALTER TABLE urls DROP COLUMN cleaned_at;')
+	testdb.commit()
+	testdb.init_db()
+	testdb.register_urls(source='GitHub',url_list=['https://github.com/test/test'])
+	testdb.cursor.execute('SELECT cleaned_at FROM urls;')
+	assert testdb.cursor.fetchall() == [(None,)]
+
 def test_source(testdb):
 	testdb.register_source(source='GitHub',source_urlroot='github.com')
 
@@ -54,4 +62,132 @@ def test_dl(testdb):
 	testdb.register_url(source='GitHub',repo_url='https://github.com/test/test')
 	testdb.register_repo(source='GitHub',repo='test',owner='test')
 	testdb.submit_download_attempt(source='GitHub',owner='test',repo='test',success=False)
-	testdb.submit_download_attempt(source='GitHub',owner='test',repo='test',success=True)
\ No newline at end of file
+	testdb.submit_download_attempt(source='GitHub',owner='test',repo='test',success=True)
+def test_id_cache(testdb):
+	testdb.register_source(source='GitHub',source_urlroot='github.com')
+	assert testdb.get_repo_id(source='GitHub',owner='test',name='test') is None
+	testdb.register_repo(source='GitHub',repo='test',owner='test')
+	repo_id = testdb.get_repo_id(source='GitHub',owner='test',name='test')
+	assert repo_id is not None
+	assert testdb.id_cache['repositories'][('GitHub','test','test')] == repo_id
+	assert testdb.get_source_id(source='GitHub') == testdb.get_source_info(source='GitHub')[0]
+	assert testdb.get_source_id(source='unregistered') is None
+	testdb.clean_db()
+	testdb.init_db()
+	assert testdb.get_repo_id(source='GitHub',owner='test',name='test') is None
+
+def test_iter_repo_list(testdb):
+	testdb.register_source(source='GitHub',source_urlroot='github.com')
+	for i in range(5):
+		testdb.register_repo(source='GitHub',repo='test{}'.format(i),owner='test')
+	assert list(testdb.iter_repo_list(option='basicinfo_dict',chunk_size=2)) == testdb.get_repo_list(option='basicinfo_dict')
+	# writing while iterating
+	for r in testdb.iter_repo_list(option='all',chunk_size=2):
+		testdb.submit_download_attempt(source=r[0],owner=r[2],repo=r[3],success=True)
+	assert list(testdb.iter_repo_list(option='no_dl')) == []
+
+def test_table_updates_latest(testdb):
+	testdb.register_source(source='GitHub',source_urlroot='github.com')
+	testdb.register_repo(source='GitHub',repo='test',owner='test')
+	repo_id = testdb.get_repo_id(source='GitHub',owner='test',name='test')
+	for success in (False,True,False):
+		testdb.insert_update(table='stars',repo_id=repo_id,success=success)
+	starinfo = testdb.get_repo_list(option='starinfo')
+	assert len(starinfo) == 1
+	assert not starinfo[0][5]
+	testdb.submit_download_attempt(source='GitHub',owner='test',repo='test',success=True,dl_time=datetime.datetime(2020,1,1))
+	testdb.submit_download_attempt(source='GitHub',owner='test',repo='test',success=False,dl_time=datetime.datetime(2020,1,2))
+	assert testdb.get_last_dl(repo_id=repo_id,success=True) == datetime.datetime(2020,1,1)
+	assert testdb.get_last_dl(repo_id=repo_id) == datetime.datetime(2020,1,2)
+	assert testdb.get_repo_list(option='no_dl') == []
+	# rebuilding from the log
+	testdb.fill_table_updates_latest(force=True)
+	assert testdb.get_last_dl(repo_id=repo_id,success=True) == datetime.datetime(2020,1,1)
+	assert len(testdb.get_repo_list(option='forkinfo')) == 1
+
+def test_compact_table_updates(testdb,tmp_path):
+	testdb.register_source(source='GitHub',source_urlroot='github.com')
+	testdb.register_repo(source='GitHub',repo='test',owner='test')
+	repo_id = testdb.get_repo_id(source='GitHub',owner='test',name='test')
+	for day in range(1,6):
+		testdb.submit_download_attempt(source='GitHub',owner='test',repo='test',success=(day!=5),dl_time=datetime.datetime(2020,1,day))
+	testdb.insert_update(table='stars',repo_id=repo_id)
+	testdb.cursor.execute('''INSERT INTO users(creation_identity) VALUES('a@a.a');''')
+	testdb.cursor.execute('''SELECT id FROM users;''')
+	user_id = testdb.cursor.fetchone()[0]
+	if testdb.db_type == 'postgres':
+		testdb.cursor.execute('''INSERT INTO identities(identity,user_id) VALUES('a@a.a',%s);''',(user_id,))
+	else:
+		testdb.cursor.execute('''INSERT INTO identities(identity,user_id) VALUES('a@a.a',?);''',(user_id,))
+	testdb.cursor.execute('''SELECT id FROM identities;''')
+	identity_id = testdb.cursor.fetchone()[0]
+	for day in range(1,5):
+		testdb.insert_update(table='followers',identity_id=identity_id,updated_at=datetime.datetime(2020,1,day))
+	assert testdb.compact_table_updates(older_than=24*3600) == 6
+	# latest update and latest success are kept
+	assert testdb.get_last_dl(repo_id=repo_id,success=True) == datetime.datetime(2020,1,4)
+	assert str(testdb.get_last_dl(repo_id=repo_id,success=False)).startswith('2020-01-05')
+	testdb.cursor.execute('''SELECT repo_id IS NULL,identity_id IS NULL,updates_count,success_count FROM table_updates_summary ORDER BY table_name;''')
+	assert [tuple(r) for r in testdb.cursor.fetchall()] == [(False,True,3,3),(True,False,3,3)]
+	testdb.cursor.execute('''SELECT COUNT(*) FROM table_updates_archive;''')
+	assert testdb.cursor.fetchone()[0] == 6
+	assert testdb.compact_table_updates(older_than=24*3600,archive_file=str(tmp_path/'archive.csv')) == 0
+
+def test_batch(testdb):
+	with testdb.batch(commit_every=2):
+		testdb.register_source(source='GitHub',source_urlroot='github.com')
+		for i in range(5):
+			testdb.register_repo(source='GitHub',repo='test{}'.format(i),owner='test')
+	assert len(testdb.get_repo_list()) == 5
+	with pytest.raises(RuntimeError):
+		with testdb.batch():
+			testdb.register_repo(source='GitHub',repo='rolled_back',owner='test')
+			assert testdb.get_repo_id(source='GitHub',owner='test',name='rolled_back') is not None
+			raise RuntimeError
+	assert testdb.get_repo_id(source='GitHub',owner='test',name='rolled_back') is None
+	assert len(testdb.get_repo_list()) == 5
+
+def get_urls(testdb):
+	testdb.cursor.execute('''SELECT u.url,cu.url,u.source,u.source_root FROM urls u LEFT OUTER JOIN urls cu ON cu.id=u.cleaned_url ORDER BY u.url;''')
+	return [tuple(r) for r in testdb.cursor.fetchall()]
+
+def test_register_urls(testdb):
+	testdb.register_source(source='GitHub',source_urlroot='github.com')
+	testdb.register_source(source='crates')
+	testdb.register_source(source='pypi')
+	gh_id,crates_id,pypi_id = [testdb.get_source_id(source=s) for s in ('GitHub','crates','pypi')]
+	# plain strings alongside tuples, duplicates resolved to the last occurrence, raw URL equal to its cleaned URL
+	testdb.register_urls(source='crates',url_list=[
+		'https://github.com/a/b.git',
+		('https://github.com/a/c',None,None),
+		('https://github.com/a/b.git','github.com/a/x',gh_id),
+		('https://github.com/a/b.git','github.com/a/b',gh_id),
+		('github.com/a/b','github.com/a/b',gh_id),
+		])
+	assert get_urls(testdb) == [
+		('github.com/a/b','github.com/a/b',crates_id,gh_id),
+		('github.com/a/x','github.com/a/x',crates_id,gh_id),
+		('https://github.com/a/b.git','github.com/a/b',crates_id,gh_id),
+		('https://github.com/a/c',None,crates_id,None),
+		]
+	# registering again without cleaned version keeps the cleaned version and sources
+	testdb.register_urls(source='pypi',url_list=['https://github.com/a/b.git','github.com/a/b'])
+	urls = {r[0]:r[1:] for r in get_urls(testdb)}
+	assert urls['github.com/a/b'] == ('github.com/a/b',crates_id,gh_id)
+	assert urls['https://github.com/a/b.git'] == ('github.com/a/b',crates_id,gh_id)
+	# a new cleaned version propagates source and source_root to existing rows
+	testdb.register_urls(source='pypi',url_list=[('https://github.com/a/c','github.com/a/c',gh_id)])
+	urls = {r[0]:r[1:] for r in get_urls(testdb)}
+	assert urls['github.com/a/c'] == ('github.com/a/c',pypi_id,gh_id)
+	assert urls['https://github.com/a/c'] == ('github.com/a/c',pypi_id,gh_id)
+
+def test_register_packages_update(testdb):
+	testdb.register_source(source='crates')
+	testdb.register_urls(source='crates',url_list=['https://github.com/test/old','https://github.com/test/new'])
+	testdb.register_packages(source='crates',package_list=[(1,'pkg',datetime.datetime(2020,1,1),'https://github.com/test/old')])
+	testdb.register_packages(source='crates',package_list=[(1,'pkg_renamed',datetime.datetime(2020,1,1),'https://github.com/test/new')])
+	testdb.cursor.execute('''SELECT name FROM packages;''')
+	assert testdb.cursor.fetchall() == [('pkg',)]
+	testdb.register_packages(source='crates',package_list=[(1,'pkg_renamed',datetime.datetime(2020,1,1),'https://github.com/test/new')],update=True)
+	testdb.cursor.execute('''SELECT p.name,u.url FROM packages p INNER JOIN urls u ON u.id=p.url_id;''')
+	assert testdb.cursor.fetchall() == [('pkg_renamed','https://github.com/test/new')]
@@ -0,0 +1,143 @@
+
+import repo_tools
+from repo_tools import fillers
+from repo_tools.data_cache import DataCache
+import pytest
+import hashlib
+import requests
+import os
+import threading
+from http import server
+
+#### Parameters
+files = {
+	'/file{}.bin'.format(i):os.urandom(100000+i) for i in range(3)
+	}
+requested_ranges = []
+
+def etag(content):
+	return '"{}"'.format(hashlib.sha256(content).hexdigest()[:16])
+
+class RangeHandler(server.BaseHTTPRequestHandler):
+	'''
+	Serves the content of files, supporting 'Range: bytes=start-' requests, conditional on If-Range if given
+	'''
+	def do_GET(self):
+		if self.path not in files:
+			self.send_error(404)
+			return
+		content = files[self.path]
+		range_header = self.headers.get('Range')
+		requested_ranges.append((self.path,range_header))
+		if range_header is None or self.headers.get('If-Range',etag(content)) != etag(content):
+			self.send_response(200)
+			start = 0
+		else:
+			start = int(range_header.split('=')[1].split('-')[0])
+			if start >= len(content):
+				self.send_error(416)
+				return
+			self.send_response(206)
+			self.send_header('Content-Range','bytes {}-{}/{}'.format(start,len(content)-1,len(content)))
+		self.send_header('Content-Length',str(len(content)-start))
+		self.send_header('ETag',etag(content))
+		self.end_headers()
+		self.wfile.write(content[start:])
+
+	def log_message(self,*args):
+		pass
+
+@pytest.fixture(scope='module')
+def http_server():
+	httpd = server.ThreadingHTTPServer(('127.0.0.1',0),RangeHandler)
+	thread = threading.Thread(target=httpd.serve_forever,daemon=True)
+	thread.start()
+	yield 'http://127.0.0.1:{}'.format(httpd.server_address[1])
+	httpd.shutdown()
+
+##############
+
+#### Tests
+
+def test_download(http_server,tmp_path):
+	destination = str(tmp_path/'file0.bin')
+	fillers.Filler().download(url=http_server+'/file0.bin',destination=destination,checksum=hashlib.sha256(files['/file0.bin']).hexdigest())
+	with open(destination,'rb') as f:
+		assert f.read() == files['/file0.bin']
+	assert not os.path.exists(destination+'.part')
+
+@pytest.mark.parametrize('part_version',['current','older','unknown'])
+def test_download_resume(http_server,tmp_path,part_version):
+	destination = str(tmp_path/'file1.bin')
+	# part of the current content, or of an older version of the file, or without validator
+	part_content = files['/file1.bin'] if part_version != 'older' else os.urandom(len(files['/file1.bin']))
+	with open(destination+'.part','wb') as f:
+		f.write(part_content[:1000])
+	if part_version != 'unknown':
+		with open(destination+'.part.validator','w') as f:
+			f.write(etag(part_content))
+	del requested_ranges[:]
+	fillers.Filler().download(url=http_server+'/file1.bin',destination=destination)
+	assert requested_ranges == [('/file1.bin','bytes=1000-' if part_version != 'unknown' else None)]
+	with open(destination,'rb') as f:
+		assert f.read() == files['/file1.bin']
+	assert not os.path.exists(destination+'.part.validator')
+
+def test_get_session():
+	assert fillers.filler.get_session() is fillers.filler.get_session()
+	assert fillers.filler.get_session(pool_maxsize=2).get_adapter('https://').__dict__['_pool_maxsize'] == 2
+
+def test_download_checksum(http_server,tmp_path):
+	destination = str(tmp_path/'file2.bin')
+	with pytest.raises(fillers.filler.DownloadError):
+		fillers.Filler().download(url=http_server+'/file2.bin',destination=destination,checksum='0'*64)
+	assert not os.path.exists(destination)
+	assert not os.path.exists(destination+'.part')
+
+def test_download_many(http_server,tmp_path):
+	downloads = [(http_server+name,str(tmp_path/name[1:])) for name in files]
+	assert fillers.Filler().download_many(downloads,workers=3) == [d[1] for d in downloads]
+	for name in files:
+		with open(str(tmp_path/name[1:]),'rb') as f:
+			assert f.read() == files[name]
+	with pytest.raises(requests.exceptions.HTTPError):
+		fillers.Filler().download_many([(http_server+'/missing.bin',str(tmp_path/'missing.bin'))],retries=0)
+
+def test_cached_download(http_server,tmp_path):
+	filler = fillers.Filler(data_folder=str(tmp_path))
+	del requested_ranges[:]
+	for _ in range(2):
+		filler.cached_download(url=http_server+'/file0.bin',destination=str(tmp_path/'file0.bin'),ttl=3600)
+	assert len(requested_ranges) == 1
+	with open(str(tmp_path/'file0.bin'),'rb') as f:
+		assert f.read() == files['/file0.bin']
+	# stale entry: fetched again, but stored once
+	filler.cached_download(url=http_server+'/file0.bin',destination=str(tmp_path/'file0.bin'),ttl=0)
+	assert len(requested_ranges) == 2
+	cache = DataCache(folder=str(tmp_path/'cache'))
+	assert len(os.listdir(str(tmp_path/'cache'/'objects'))) == 1
+	assert cache.size() == len(files['/file0.bin'])
+
+def test_data_cache_changed_content(tmp_path):
+	cache = DataCache(folder=str(tmp_path/'cache'))
+	for content in (b'old',b'new'):
+		def download(url,destination):
+			with open(destination,'wb') as f:
+				f.write(content)
+		path = cache.fetch(url='http://example.org/dump',download=download,ttl=0)
+	# the previous content is not left behind
+	assert os.listdir(str(tmp_path/'cache'/'objects')) == [os.path.basename(path)]
+	assert cache.size() == 3
+	# hits in a row do not rewrite the index
+	index_mtime = os.stat(cache.index_file).st_mtime_ns
+	assert cache.lookup(url='http://example.org/dump') == path
+	assert os.stat(cache.index_file).st_mtime_ns == index_mtime
+
+def test_data_cache_eviction(http_server,tmp_path):
+	filler = fillers.Filler(data_folder=str(tmp_path))
+	for name in files:
+		filler.cached_download(url=http_server+name,destination=str(tmp_path/name[1:]),max_size=250000)
+	cache = DataCache(folder=str(tmp_path/'cache'))
+	assert cache.size() <= 250000
+	assert cache.lookup(url=http_server+'/file0.bin') is None
+	assert cache.lookup(url=http_server+'/file2.bin') is not None
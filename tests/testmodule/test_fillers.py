@@ -1,10 +1,16 @@
 
 import repo_tools
-from repo_tools.fillers import generic,commit_info,github
+from repo_tools.fillers import generic,commit_info,github,crates
+from repo_tools import commit_graph
 import pytest
 import datetime
 import time
 import os
+import io
+import csv
+import tarfile
+import openpyxl
+import subprocess
 
 #### Parameters
 dbtype_list = [
@@ -31,6 +37,52 @@ def test_packages(testdb):
 	testdb.add_filler(generic.PackageFiller(package_list_file='packages.csv'))
 	testdb.fill_db()
 
+def test_packages_chunked(testdb):
+	f = generic.PackageFiller(package_list_file='packages.csv',chunk_size=2)
+	testdb.add_filler(f)
+	testdb.fill_db()
+	nb_packages = sum(len(chunk) for chunk in f.iter_package_chunks())
+	testdb.cursor.execute('SELECT COUNT(*) FROM packages;')
+	assert testdb.cursor.fetchone()[0] == nb_packages
+
+def make_crates_dump(filename,crates_rows):
+	csv_content = io.StringIO()
+	writer = csv.writer(csv_content)
+	writer.writerow(['created_at','description','id','name','repository','updated_at'])
+	for row in crates_rows:
+		writer.writerow(row)
+	with tarfile.open(filename,'w:gz') as tar:
+		for member_name,content in [('2020-01-01-000000/data/crates.csv',csv_content.getvalue()),('2020-01-01-000000/data/versions.csv','id,crate_id,num\n1,1,0.1.0\n')]:
+			data = content.encode('utf-8')
+			info = tarfile.TarInfo(name=member_name)
+			info.size = len(data)
+			tar.addfile(info,io.BytesIO(data))
+
+def test_crates_dump(testdb,tmp_path):
+	crates_rows = [
+		('2015-12-13 14:36:55.150432+00','first, with "quotes"\nand newline',1,'crate1','https://github.com/owner1/repo1','2016-01-01 00:00:00.1+00'),
+		('2015-12-14 14:36:55+00','',2,'crate2','','2016-01-02 00:00:00+00'),
+		]
+	make_crates_dump(str(tmp_path/'db-dump.tar.gz'),crates_rows)
+	f = crates.CratesFiller(dump_file='db-dump.tar.gz',data_folder=str(tmp_path),incremental=True,chunk_size=1)
+	assert [r['num'] for r in f.iter_tar_csv(orig_file=str(tmp_path/'db-dump.tar.gz'),member_name='data/versions.csv')] == ['0.1.0']
+	testdb.add_filler(f)
+	testdb.fill_db()
+	testdb.cursor.execute('SELECT insource_id,name,url_id IS NULL FROM packages ORDER BY insource_id;')
+	assert testdb.cursor.fetchall() == [(1,'crate1',False),(2,'crate2',True)]
+	assert str(testdb.get_last_full_update(update_type='packages_crates')).startswith('2016-01-02')
+
+	crates_rows[1] = ('2015-12-14 14:36:55+00','',2,'crate2','https://github.com/owner2/repo2','2017-01-01 00:00:00+00')
+	crates_rows.append(('2017-01-02 00:00:00+00','',3,'crate3','https://github.com/owner3/repo3','2017-01-02 00:00:00+00'))
+	make_crates_dump(str(tmp_path/'db-dump.tar.gz'),crates_rows)
+	f2 = crates.CratesFiller(dump_file='db-dump.tar.gz',data_folder=str(tmp_path),incremental=True,name='CratesFiller2')
+	testdb.add_filler(f2)
+	f2.prepare()
+	assert [p[0] for chunk in f2.iter_package_chunks() for p in chunk] == [2,3]
+	f2.apply()
+	testdb.cursor.execute('SELECT insource_id,name,url_id IS NULL FROM packages ORDER BY insource_id;')
+	assert testdb.cursor.fetchall() == [(1,'crate1',False),(2,'crate2',False),(3,'crate3',False)]
+
 def test_sources(testdb):
 	testdb.add_filler(generic.SourcesFiller(source='GitHub',source_urlroot='github.com'))
 	testdb.fill_db()
@@ -49,6 +101,40 @@ def test_repositories(testdb):
 	testdb.add_filler(generic.RepositoriesFiller())
 	testdb.fill_db()
 
+def test_repositories_incremental(testdb):
+	testdb.add_filler(generic.SourcesFiller(source=['GitHub',],source_urlroot=['github.com',]))
+	testdb.add_filler(generic.PackageFiller(package_list_file='packages.csv'))
+	testdb.add_filler(generic.RepositoriesFiller(chunk_size=2))
+	testdb.register_source(source='GitHub',source_urlroot='github.com')
+	testdb.register_urls(source='GitHub',url_list=['https://unknown.org/owner/repo'])
+	testdb.fill_db()
+	testdb.cursor.execute('SELECT COUNT(*) FROM repositories;')
+	nb_repos = testdb.cursor.fetchone()[0]
+	assert nb_repos > 0
+	testdb.cursor.execute('''SELECT cleaned_url IS NULL,cleaned_at IS NULL FROM urls WHERE url='https://unknown.org/owner/repo';''')
+	assert tuple(testdb.cursor.fetchone()) == (True,False)
+	testdb.cursor.execute('SELECT COUNT(*) FROM urls WHERE cleaned_at IS NULL;')
+	assert testdb.cursor.fetchone()[0] == 0
+	testdb.register_urls(source='GitHub',url_list=[('https://github.com/incremental_owner/incremental_repo.git',None,None)])
+	f = generic.RepositoriesFiller(incremental=True,chunk_size=2,name='IncrementalRepositoriesFiller')
+	testdb.add_filler(f)
+	f.prepare()
+	# URLs that could not be cleaned in the first run are not processed again
+	assert [url for first_id,last_id,chunk in f.iter_url_chunks() for url in chunk] == ['https://github.com/incremental_owner/incremental_repo.git']
+	f.apply()
+	testdb.cursor.execute('SELECT COUNT(*) FROM repositories;')
+	assert testdb.cursor.fetchone()[0] == nb_repos + 1
+	# registering the URL again (e.g. at the next package sync) keeps it linked
+	testdb.register_urls(source='GitHub',url_list=['https://github.com/incremental_owner/incremental_repo.git'])
+	testdb.cursor.execute('''SELECT cu.url FROM urls u INNER JOIN urls cu ON cu.id=u.cleaned_url WHERE u.url='https://github.com/incremental_owner/incremental_repo.git';''')
+	assert testdb.cursor.fetchone()[0] == 'https://github.com/incremental_owner/incremental_repo'
+	f.prepare()
+	assert list(f.iter_url_chunks()) == []
+	# a new cleaned version is processed again
+	testdb.register_urls(source='GitHub',url_list=[('https://github.com/incremental_owner/incremental_repo.git','https://github.com/incremental_owner/renamed_repo',testdb.get_source_id(source='GitHub'))])
+	f.prepare()
+	assert [url for first_id,last_id,chunk in f.iter_url_chunks() for url in chunk] == ['https://github.com/incremental_owner/incremental_repo.git','https://github.com/incremental_owner/renamed_repo']
+
 def test_clones_https(testdb):
 	testdb.add_filler(generic.SourcesFiller(source=['GitHub',],source_urlroot=['github.com',]))
 	testdb.add_filler(generic.PackageFiller(package_list_file='packages.csv'))
@@ -57,6 +143,295 @@ def test_clones_https(testdb):
 	# testdb.add_filler(generic.ClonesFiller(data_folder='dummy_clones',rm_first=True))
 	testdb.fill_db()
 
+def test_clones_workers(testdb):
+	testdb.add_filler(generic.SourcesFiller(source=['GitHub',],source_urlroot=['github.com',]))
+	testdb.add_filler(generic.PackageFiller(package_list_file='packages.csv'))
+	testdb.add_filler(generic.RepositoriesFiller())
+	testdb.add_filler(generic.ClonesFiller(data_folder='dummy_clones',workers=3,max_per_host=2,commit_every=2))
+	testdb.fill_db()
+	testdb.cursor.execute('''SELECT COUNT(*) FROM repositories r WHERE EXISTS (SELECT 1 FROM table_updates tu WHERE tu.repo_id=r.id AND tu.table_name='clones');''')
+	nb_attempted = testdb.cursor.fetchone()[0]
+	testdb.cursor.execute('SELECT COUNT(*) FROM repositories;')
+	assert nb_attempted == testdb.cursor.fetchone()[0]
+
+def make_git_repo(path,nb_commits):
+	env = dict(os.environ,GIT_AUTHOR_NAME='a',GIT_AUTHOR_EMAIL='a@a.a',GIT_COMMITTER_NAME='a',GIT_COMMITTER_EMAIL='a@a.a')
+	if not os.path.exists(path):
+		subprocess.check_call(['git','init','-q',path])
+		# allowing partial clones from this repository
+		subprocess.check_call(['git','-C',path,'config','uploadpack.allowfilter','true'])
+	for i in range(nb_commits):
+		with open(os.path.join(path,'file.txt'),'a') as f:
+			f.write('line {}\n'.format(i))
+		subprocess.check_call(['git','-C',path,'add','file.txt'],env=env)
+		subprocess.check_call(['git','-C',path,'commit','-q','-m','commit {}'.format(i)],env=env)
+	return path
+
+class LocalClonesFiller(generic.ClonesFiller):
+	'''
+	Clones from local repositories in self.remote_folder
+	'''
+	def build_url(self,name,owner,source_urlroot,ssh_mode):
+		return 'file://'+os.path.join(self.remote_folder,owner,name)
+
+@pytest.mark.parametrize('clone_mode',['full','bare','blobless'])
+def test_clone_modes(testdb,tmp_path,clone_mode):
+	remote_folder = str(tmp_path/'remotes')
+	make_git_repo(os.path.join(remote_folder,'owner','repo'),nb_commits=3)
+	testdb.register_source(source='GitHub',source_urlroot='github.com')
+	testdb.register_repo(source='GitHub',owner='owner',repo='repo')
+	f = LocalClonesFiller(data_folder=str(tmp_path/'clones'),clone_mode=clone_mode)
+	f.remote_folder = remote_folder
+	testdb.add_filler(f)
+	testdb.fill_db()
+	repo_folder = str(tmp_path/'clones'/'cloned_repos'/'GitHub'/'owner'/'repo')
+	assert os.path.exists(os.path.join(repo_folder,'file.txt')) == (clone_mode == 'full')
+	make_git_repo(os.path.join(remote_folder,'owner','repo'),nb_commits=1)
+	f.update_repo(source='GitHub',owner='owner',name='repo',source_urlroot='github.com')
+	cf = commit_info.CommitsFiller(data_folder=str(tmp_path/'clones'))
+	cf.db = testdb
+	commits = list(cf.list_commits(source='GitHub',owner='owner',name='repo'))
+	if clone_mode == 'full':
+		# fetching in a clone with working tree does not move local branches
+		assert len(commits) == 3
+	else:
+		assert len(commits) == 4
+	assert (commits[0]['insertions'] is None) == (clone_mode == 'blobless')
+
+@pytest.mark.parametrize('workers',[1,2])
+def test_clone_alternates(testdb,tmp_path,workers):
+	remote_folder = str(tmp_path/'remotes')
+	make_git_repo(os.path.join(remote_folder,'owner','root'),nb_commits=3)
+	subprocess.check_call(['git','clone','-q',os.path.join(remote_folder,'owner','root'),os.path.join(remote_folder,'forker','fork')])
+	make_git_repo(os.path.join(remote_folder,'forker','fork'),nb_commits=1)
+	testdb.register_source(source='GitHub',source_urlroot='github.com')
+	testdb.register_repo(source='GitHub',owner='forker',repo='fork')
+	testdb.register_repo(source='GitHub',owner='owner',repo='root')
+	fork_id = testdb.get_repo_id(source='GitHub',owner='forker',name='fork')
+	root_id = testdb.get_repo_id(source='GitHub',owner='owner',name='root')
+	if testdb.db_type == 'postgres':
+		testdb.cursor.execute('''INSERT INTO forks(forking_repo_id,forking_repo_url,forked_repo_id,fork_rank) VALUES(%s,'github.com/forker/fork',%s,1);''',(fork_id,root_id))
+	else:
+		testdb.cursor.execute('''INSERT INTO forks(forking_repo_id,forking_repo_url,forked_repo_id,fork_rank) VALUES(?,'github.com/forker/fork',?,1);''',(fork_id,root_id))
+	testdb.commit()
+	# with several workers, the fork is cloned once the root is, not concurrently
+	f = LocalClonesFiller(data_folder=str(tmp_path/'clones'),use_alternates=True,workers=workers)
+	f.remote_folder = remote_folder
+	testdb.add_filler(f)
+	testdb.fill_db()
+	fork_folder = str(tmp_path/'clones'/'cloned_repos'/'GitHub'/'forker'/'fork')
+	with open(os.path.join(fork_folder,'.git','objects','info','alternates'),'r') as alternates:
+		assert alternates.read().strip() == str(tmp_path/'clones'/'cloned_repos'/'GitHub'/'owner'/'root'/'.git'/'objects')
+	cf = commit_info.CommitsFiller(data_folder=str(tmp_path/'clones'))
+	cf.db = testdb
+	assert len(list(cf.list_commits(source='GitHub',owner='forker',name='fork'))) == 4
+
+def test_clones_update_priority(testdb,tmp_path):
+	testdb.register_source(source='GitHub',source_urlroot='github.com')
+	now = datetime.datetime.now()
+	# (name,days since last fetch,days since latest commit)
+	repos = [('new',None,1),('stale_active',10,1),('recent_active',1,1),('stale_inactive',5,1000)]
+	for name,fetch_days,commit_days in repos:
+		testdb.register_repo(source='GitHub',owner='owner',repo=name)
+		repo_id = testdb.get_repo_id(source='GitHub',owner='owner',name=name)
+		if fetch_days is not None:
+			testdb.insert_update(table='clones',repo_id=repo_id,updated_at=now-datetime.timedelta(days=fetch_days))
+		if testdb.db_type == 'postgres':
+			testdb.cursor.execute('UPDATE repositories SET latest_commit_time=%s WHERE id=%s;',(now-datetime.timedelta(days=commit_days),repo_id))
+		else:
+			testdb.cursor.execute('UPDATE repositories SET latest_commit_time=? WHERE id=?;',(now-datetime.timedelta(days=commit_days),repo_id))
+	testdb.commit()
+	f = generic.ClonesFiller(data_folder=str(tmp_path),update=True)
+	f.db = testdb
+	ranked = lambda: [r['name'] for r in sorted(testdb.get_repo_list(option='updateinfo'),key=f.update_priority,reverse=True)]
+	assert ranked() == ['new','stale_active','recent_active','stale_inactive']
+	# recent stars make a dormant repo worth fetching
+	stale_inactive_id = testdb.get_repo_id(source='GitHub',owner='owner',name='stale_inactive')
+	for i in range(60):
+		if testdb.db_type == 'postgres':
+			testdb.cursor.execute('INSERT INTO stars(repo_id,login,starred_at) VALUES(%s,%s,%s);',(stale_inactive_id,'user{}'.format(i),now-datetime.timedelta(days=2)))
+		else:
+			testdb.cursor.execute('INSERT INTO stars(repo_id,login,starred_at) VALUES(?,?,?);',(stale_inactive_id,'user{}'.format(i),now-datetime.timedelta(days=2)))
+	testdb.commit()
+	assert ranked() == ['new','stale_inactive','stale_active','recent_active']
+	# no time left: nothing is fetched
+	f = LocalClonesFiller(data_folder=str(tmp_path),update=True,time_budget=0)
+	f.remote_folder = str(tmp_path/'remotes')
+	testdb.add_filler(f)
+	testdb.fill_db()
+	assert not os.path.exists(str(tmp_path/'cloned_repos'/'GitHub'/'owner'/'new'))
+
+def test_clones_retry_failed(testdb,tmp_path):
+	remote_folder = str(tmp_path/'remotes')
+	testdb.register_source(source='GitHub',source_urlroot='github.com')
+	for name in ('gone','flaky','slow'):
+		testdb.register_repo(source='GitHub',owner='owner',repo=name)
+	gone_id,flaky_id,slow_id = [testdb.get_repo_id(source='GitHub',owner='owner',name=name) for name in ('gone','flaky','slow')]
+	testdb.record_clone_failure(repo_id=slow_id,permanent=False,error='timed out')
+	f = LocalClonesFiller(data_folder=str(tmp_path),failed=True,retry_delay=0)
+	f.remote_folder = remote_folder
+	f.db = testdb
+	f.prepare()
+	f.apply()
+	testdb.cursor.execute('SELECT repo_id,permanent,attempts FROM clone_failures ORDER BY repo_id;')
+	assert testdb.cursor.fetchall() == [(gone_id,False,1),(flaky_id,False,1),(slow_id,False,1)]
+	testdb.record_clone_failure(repo_id=gone_id,permanent=f.is_permanent_error("fatal: repository 'https://github.com/owner/gone.git/' not found"))
+	assert testdb.get_repo_list(option='retry_failed') == [('GitHub','github.com','owner','flaky')]
+	make_git_repo(os.path.join(remote_folder,'owner','flaky'),nb_commits=1)
+	f.apply()
+	testdb.cursor.execute('SELECT repo_id,permanent,attempts FROM clone_failures ORDER BY repo_id;')
+	assert testdb.cursor.fetchall() == [(gone_id,True,2),(slow_id,False,1)]
+	assert testdb.get_repo_list(option='retry_failed') == []
+	assert not f.is_permanent_error('unexpected http status code: 502')
+	# permanent failures expire after max_retry_delay
+	testdb.record_clone_failure(repo_id=gone_id,permanent=True,max_retry_delay=0)
+	assert testdb.get_repo_list(option='retry_failed') == [('GitHub','github.com','owner','gone')]
+	# authentication errors are permanent over HTTPS, transient with an SSH key
+	assert f.is_permanent_error('fatal: Authentication failed for https://github.com/owner/gone.git/',source='GitHub')
+	f.ssh_sources = {'GitHub':f.ssh_key}
+	assert not f.is_permanent_error('git@github.com: Permission denied (publickey).',source='GitHub')
+
+def test_clones_quota(testdb,tmp_path):
+	remote_folder = str(tmp_path/'remotes')
+	testdb.register_source(source='GitHub',source_urlroot='github.com')
+	for name in ('a','b','c','d'):
+		make_git_repo(os.path.join(remote_folder,'owner',name),nb_commits=2)
+		testdb.register_repo(source='GitHub',owner='owner',repo=name)
+	f = LocalClonesFiller(data_folder=str(tmp_path/'clones'))
+	f.remote_folder = remote_folder
+	testdb.add_filler(f)
+	testdb.add_filler(commit_info.CommitsFiller(data_folder=str(tmp_path/'clones')))
+	testdb.fill_db()
+	repo_ids = {name:testdb.get_repo_id(source='GitHub',owner='owner',name=name) for name in ('a','b','c','d')}
+	later = datetime.datetime.now()+datetime.timedelta(days=2)
+	# b accessed recently, d fetched again but its commits not ingested yet, a (least recently used with c) used as alternates by c
+	testdb.insert_update(table='commits',repo_id=repo_ids['b'],updated_at=later)
+	testdb.insert_update(table='clones',repo_id=repo_ids['d'],updated_at=later)
+	cloned_folder = str(tmp_path/'clones'/'cloned_repos'/'GitHub'/'owner')
+	with open(os.path.join(cloned_folder,'c','.git','objects','info','alternates'),'w') as alternates:
+		alternates.write(os.path.join(cloned_folder,'a','.git','objects')+'\n')
+	qf = generic.ClonesQuotaFiller(data_folder=str(tmp_path/'clones'),quota=0)
+	qf.db = testdb
+	qf.logger = testdb.logger
+	qf.quota = sum(qf.folder_size(os.path.join(cloned_folder,name)) for name in ('a','b','c','d'))-1
+	assert qf.enforce_quota() == 1
+	assert sorted(os.listdir(cloned_folder)) == ['a','b','d']
+	# a is not used as alternates anymore
+	qf.quota = 0
+	with testdb.batch(commit_every=100):
+		assert qf.enforce_quota() == 2
+		assert sorted(os.listdir(cloned_folder)) == ['d']
+		# removals are committed even inside a batch, as seen from another connection
+		other_db = repo_tools.repo_database.Database(db_name='travis_ci_test_repo_tools',db_type=testdb.db_type)
+		other_db.cursor.execute('SELECT name FROM repositories WHERE cloned ORDER BY name;')
+		assert [r[0] for r in other_db.cursor.fetchall()] == ['d']
+		other_db.connection.close()
+
+def test_repack(testdb,tmp_path):
+	remote_folder = str(tmp_path/'remotes')
+	make_git_repo(os.path.join(remote_folder,'owner','repo'),nb_commits=3)
+	testdb.register_source(source='GitHub',source_urlroot='github.com')
+	testdb.register_repo(source='GitHub',owner='owner',repo='repo')
+	f = LocalClonesFiller(data_folder=str(tmp_path/'clones'))
+	f.remote_folder = remote_folder
+	testdb.add_filler(f)
+	testdb.fill_db()
+	for _ in range(3):
+		make_git_repo(os.path.join(remote_folder,'owner','repo'),nb_commits=1)
+		f.update_repo(source='GitHub',owner='owner',name='repo',source_urlroot='github.com')
+	rf = generic.RepackFiller(data_folder=str(tmp_path/'clones'),max_packs=1,max_loose=0,workers=2)
+	rf.db = testdb
+	rf.logger = testdb.logger
+	git_dir = rf.git_dir(source='GitHub',owner='owner',name='repo')
+	assert rf.count_packs(git_dir)+rf.count_loose(git_dir) > 1
+	assert rf.repack_all() == 1
+	assert rf.count_packs(git_dir) == 1
+	assert rf.count_loose(git_dir) == 0
+	assert rf.has_commit_graph(git_dir)
+	assert rf.repack_all() == 0
+	cf = commit_info.CommitsFiller(data_folder=str(tmp_path/'clones'))
+	cf.db = testdb
+	assert len(list(cf.list_commits(source='GitHub',owner='owner',name='repo'))) == 3
+
+def test_commit_graph(testdb,tmp_path):
+	remote = make_git_repo(str(tmp_path/'remotes'/'owner'/'repo'),nb_commits=2)
+	git = ['git','-C',remote,'-c','user.name=a','-c','user.email=a@a.a']
+	branch = subprocess.check_output(git+['symbolic-ref','--short','HEAD']).decode().strip()
+	for b in ('x','y','z'):
+		subprocess.check_call(git+['checkout','-q','-b',b,branch+'~1'])
+		with open(os.path.join(remote,b),'w') as f:
+			f.write(b)
+		subprocess.check_call(git+['add',b])
+		subprocess.check_call(git+['commit','-q','-m',b])
+	subprocess.check_call(git+['checkout','-q',branch])
+	# octopus merge, stored with extra edges in the commit graph
+	subprocess.check_call(git+['merge','-q','--no-edit','x','y','z'])
+	testdb.register_source(source='GitHub',source_urlroot='github.com')
+	testdb.register_repo(source='GitHub',owner='owner',repo='repo')
+	f = LocalClonesFiller(data_folder=str(tmp_path/'clones'),clone_mode='bare')
+	f.remote_folder = str(tmp_path/'remotes')
+	testdb.add_filler(f)
+	testdb.fill_db()
+	cf = commit_info.CommitsFiller(data_folder=str(tmp_path/'clones'))
+	cf.db = testdb
+	cf.logger = testdb.logger
+	cf_nograph = commit_info.CommitsFiller(data_folder=str(tmp_path/'clones'),use_commit_graph=False)
+	cf_nograph.db = testdb
+	list_commits = lambda filler:list(filler.list_commits(source='GitHub',owner='owner',name='repo',topology_only=True))
+	commits = list_commits(cf)
+	assert os.path.exists(str(tmp_path/'clones'/'cloned_repos'/'GitHub'/'owner'/'repo'/'objects'/'info'/'commit-graph'))
+	assert len(commits) == 6
+	assert [len(c['parents']) for c in commits if len(c['parents']) > 1] == [4]
+	assert sorted(commits,key=lambda c:c['sha']) == sorted(list_commits(cf_nograph),key=lambda c:c['sha'])
+	assert [c['time'] for c in commits] == sorted([c['time'] for c in commits],reverse=True)
+	# outdated commit graph is written again
+	make_git_repo(remote,nb_commits=1)
+	f.update_repo(source='GitHub',owner='owner',name='repo',source_urlroot='github.com')
+	repo_obj = cf.get_repo(source='GitHub',owner='owner',name='repo')
+	with cf.get_commit_graph(repo_obj) as graph:
+		assert graph.position(repo_obj.head.target.raw) is not None
+	assert len(list_commits(cf)) == 7
+	# empty or truncated commit graph: pygit2 walk
+	graph_file = str(tmp_path/'clones'/'cloned_repos'/'GitHub'/'owner'/'repo'/'objects'/'info'/'commit-graph')
+	with open(graph_file,'rb') as graph_f:
+		graph_content = graph_f.read()
+	for corrupt_content in (b'',graph_content[:100],graph_content[:-300]):
+		os.chmod(graph_file,0o644)
+		with open(graph_file,'wb') as graph_f:
+			graph_f.write(corrupt_content)
+		with pytest.raises(commit_graph.CommitGraphError):
+			commit_graph.CommitGraph.from_git_dir(str(tmp_path/'clones'/'cloned_repos'/'GitHub'/'owner'/'repo'))
+		assert cf.get_commit_graph(repo_obj) is None
+		assert len(list_commits(cf)) == 7
+	# parent position out of range, found during the walk: the walk goes on with pygit2
+	with open(graph_file,'wb') as graph_f:
+		graph_f.write(graph_content)
+	layer = commit_graph.CommitGraphLayer(graph_file)
+	parent_offset = layer.cdat_offset+layer.hash_len
+	layer.close()
+	with open(graph_file,'wb') as graph_f:
+		graph_f.write(graph_content[:parent_offset]+(0x0fffffff).to_bytes(4,'big')+graph_content[parent_offset+4:])
+	commits = list_commits(cf)
+	assert len(commits) == 7
+	assert len(set(c['sha'] for c in commits)) == 7
+
+def test_commit_parents_missing(testdb,tmp_path):
+	make_git_repo(str(tmp_path/'remotes'/'owner'/'repo'),nb_commits=2)
+	testdb.register_source(source='GitHub',source_urlroot='github.com')
+	testdb.register_repo(source='GitHub',owner='owner',repo='repo')
+	f = LocalClonesFiller(data_folder=str(tmp_path/'clones'))
+	f.remote_folder = str(tmp_path/'remotes')
+	testdb.add_filler(f)
+	cf = commit_info.CommitsFiller(data_folder=str(tmp_path/'clones'))
+	testdb.add_filler(cf)
+	testdb.fill_db()
+	commits = list(cf.list_commits(source='GitHub',owner='owner',name='repo',topology_only=True))
+	# parent outside of the ingested history: edge skipped and counted
+	commits[-1]['parents'] = ['0'*40]
+	assert cf.fill_commit_parents(commits) == 1
+	testdb.cursor.execute('SELECT COUNT(*),SUM(CASE WHEN parent_id IS NULL THEN 1 ELSE 0 END) FROM commit_parents;')
+	assert tuple(testdb.cursor.fetchone()) == (1,0)
+
 # def test_clones_ssh(testdb):
 # 	testdb.add_filler(generic.SourcesFiller(source=['GitHub',],source_urlroot=['github.com',]))
 # 	testdb.add_filler(generic.PackageFiller(package_list_file='packages.csv'))
@@ -72,6 +447,24 @@ def test_commits(testdb):
 	testdb.add_filler(commit_info.CommitsFiller(data_folder='dummy_clones'))
 	testdb.fill_db()
 
+def test_fill_db_workers(testdb):
+	testdb.add_filler(generic.SourcesFiller(source=['GitHub',],source_urlroot=['github.com',]))
+	testdb.add_filler(generic.PackageFiller(package_list_file='packages.csv'))
+	testdb.add_filler(generic.RepositoriesFiller())
+	testdb.add_filler(generic.ClonesFiller(data_folder='dummy_clones'))
+	testdb.add_filler(commit_info.CommitsFiller(data_folder='dummy_clones'))
+	testdb.add_filler(generic.UpdatesCompactionFiller())
+	testdb.add_filler(github.StarsFiller(fail_on_wait=True,workers=2,requires=('RepositoriesFiller',)))
+	dependencies = testdb.filler_dependencies()
+	assert dependencies['ClonesFiller'] == {'RepositoriesFiller'}
+	assert dependencies['CommitsFiller'] == {'RepositoriesFiller','ClonesFiller'}
+	assert dependencies['UpdatesCompactionFiller'] == {f.name for f in testdb.fillers[:5]}
+	assert dependencies['StarsFiller'] == {'RepositoriesFiller','UpdatesCompactionFiller'}
+	testdb.fillers.pop()
+	testdb.fill_db(workers=3)
+	testdb.cursor.execute('SELECT COUNT(*) FROM repositories;')
+	assert testdb.cursor.fetchone()[0] > 0
+
 def test_github(testdb):
 	testdb.add_filler(generic.SourcesFiller(source=['GitHub',],source_urlroot=['github.com',]))
 	testdb.add_filler(generic.PackageFiller(package_list_file='packages.csv'))
@@ -83,3 +476,19 @@ def test_github(testdb):
 	testdb.add_filler(github.StarsFiller(fail_on_wait=True,workers=2))
 	testdb.add_filler(github.FollowersFiller(fail_on_wait=True,workers=2))
 	testdb.fill_db()
+
+def test_packages_xlsx(testdb,tmp_path):
+	wb = openpyxl.Workbook()
+	ws = wb.active
+	ws.append(['name','created_at','repository'])
+	ws.append(['pkg1',datetime.datetime(2020,1,1),'https://github.com/owner1/repo1'])
+	ws.append(['pkg2',datetime.datetime(2020,1,2),None])
+	wb.save(str(tmp_path/'packages.xlsx'))
+	f = generic.PackageFiller(package_list_file='packages.xlsx',data_folder=str(tmp_path),chunk_size=1)
+	f.convert_xlsx(orig_file=str(tmp_path/'packages.xlsx'),destination=str(tmp_path/'packages.csv'))
+	with open(str(tmp_path/'packages.csv'),'r') as csvfile:
+		assert csvfile.read().splitlines() == ['pkg1,2020-01-01 00:00:00,https://github.com/owner1/repo1','pkg2,2020-01-02 00:00:00,']
+	testdb.add_filler(f)
+	testdb.fill_db()
+	testdb.cursor.execute('SELECT name,url_id IS NULL FROM packages ORDER BY name;')
+	assert testdb.cursor.fetchall() == [('pkg1',False),('pkg2',True)]
@@ -0,0 +1,73 @@
+
+import repo_tools
+from repo_tools.repo_crawler import RepoCrawler
+import pytest
+import os
+import datetime
+import subprocess
+
+#### Parameters
+dbtype_list = [
+	'sqlite',
+	'postgres'
+	]
+
+@pytest.fixture(params=dbtype_list)
+def testdb(request):
+	db = repo_tools.repo_database.Database(db_name='travis_ci_test_repo_tools',db_type=request.param)
+	db.clean_db()
+	db.init_db()
+	return db
+
+@pytest.fixture
+def crawler(testdb,tmp_path):
+	return RepoCrawler(folder=str(tmp_path),db=testdb)
+
+##############
+
+#### Tests
+
+def test_clean_url_new_source(crawler):
+	crawler.db.register_source(source='GitHub',source_urlroot='github.com')
+	assert crawler.clean_url('https://gitlab.com/owner/repo') == (None,None)
+	crawler.bulk_add_list(['https://gitlab.com/owner/repo'],source='GitLab',source_urlroot='gitlab.com')
+	assert crawler.db.get_repo_id(source='GitLab',owner='owner',name='repo') is not None
+	crawler.add_list(['https://bitbucket.org/owner/repo2'],source='Bitbucket',source_urlroot='bitbucket.org')
+	assert crawler.clean_url('https://bitbucket.org/owner/repo2')[0] == 'https://bitbucket.org/owner/repo2'
+
+def make_git_repo(path):
+	env = dict(os.environ,GIT_AUTHOR_NAME='a',GIT_AUTHOR_EMAIL='a@a.a',GIT_COMMITTER_NAME='a',GIT_COMMITTER_EMAIL='a@a.a',GIT_COMMITTER_DATE='2020-01-02T00:00:00')
+	subprocess.check_call(['git','init','-q',path])
+	with open(os.path.join(path,'file.txt'),'w') as f:
+		f.write('line\n')
+	subprocess.check_call(['git','-C',path,'add','file.txt'],env=env)
+	subprocess.check_call(['git','-C',path,'commit','-q','-m','commit'],env=env)
+	return path
+
+def test_bulk_add_list_skips(crawler):
+	crawler.db.register_source(source='GitLab',source_urlroot='gitlab.com')
+	crawler.bulk_add_list(['https://github.com/owner/repo','https://gitlab.com/owner/foreign','github.com/owner',None],source='GitHub',source_urlroot='github.com')
+	# foreign source and syntax error: URLs registered, repositories skipped
+	assert [r[2:] for r in crawler.db.get_repo_list()] == [('owner','repo')]
+	crawler.db.cursor.execute('SELECT url FROM urls;')
+	assert {'https://github.com/owner/repo','https://gitlab.com/owner/foreign','github.com/owner'} <= {r[0] for r in crawler.db.cursor.fetchall()}
+
+def test_bulk_add_all_from_folder(crawler,tmp_path):
+	crawler.db.register_source(source='GitHub',source_urlroot='github.com')
+	cloned_folder = tmp_path/'cloned_repos'/'GitHub'
+	make_git_repo(str(cloned_folder/'owner'/'repo.git'))
+	os.makedirs(str(cloned_folder/'owner'/'empty_repo'))
+	os.makedirs(str(cloned_folder/'empty_owner'))
+	assert sorted(crawler.scan_cloned_repos(clean=False,rename=False)['GitHub']) == [('owner','empty_repo'),('owner','repo.git')]
+	crawler.bulk_add_all_from_folder()
+	# renamed and cleaned
+	assert sorted(os.listdir(str(cloned_folder))) == ['owner']
+	assert os.listdir(str(cloned_folder/'owner')) == ['repo']
+	repo_id = crawler.db.get_repo_id(source='GitHub',owner='owner',name='repo')
+	assert crawler.db.get_repo_list(option='only_not_cloned') == []
+	last_dl = crawler.db.get_last_dl(repo_id=repo_id,success=True)
+	assert last_dl == datetime.datetime.fromtimestamp(crawler.get_repo(source='GitHub',owner='owner',name='repo').revparse_single('HEAD').commit_time)
+	# already downloaded: no new attempt
+	crawler.bulk_add_all_from_folder()
+	crawler.db.cursor.execute('''SELECT COUNT(*) FROM table_updates WHERE table_name='clones';''')
+	assert crawler.db.cursor.fetchone()[0] == 1
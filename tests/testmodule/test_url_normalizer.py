@@ -0,0 +1,26 @@
+
+import repo_tools
+from repo_tools.url_normalizer import UrlNormalizer, normalize_urls
+import pytest
+
+url_roots = [(1,'github.com'),(2,'gitlab.com')]
+
+@pytest.mark.parametrize('url,expected',[
+	('https://github.com/owner/name',('https://github.com/owner/name',1)),
+	('http://www.gitlab.com/owner/name.git/',('https://gitlab.com/owner/name',2)),
+	('github.com/owner//name/tree/master',('https://github.com/owner/name',1)),
+	('https://github.com/owner',(None,None)),
+	('https://crates.io/owner/name',(None,None)),
+	('https://github.com/owner/github.com',(None,None)),
+	(None,None),
+	])
+def test_normalize(url,expected):
+	assert UrlNormalizer(url_roots=url_roots).normalize(url) == expected
+
+def test_normalize_urls():
+	urls = ['https://github.com/owner/name','https://github.com/owner/name',None,'x']
+	assert normalize_urls(urls,url_roots=url_roots) == [
+		('https://github.com/owner/name','https://github.com/owner/name',1),
+		('https://github.com/owner/name','https://github.com/owner/name',1),
+		('x',None,None),
+		]